@@ -6,13 +6,21 @@ import json
 from dotenv import load_dotenv
 from pathlib import Path
 import math
-
-from llm import llm_utils
+import time
 
 # Add the main folder (parent of `app/`) to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from similarity.similarity_utils import search_rdf_index, compute_hits_at_n
+from llm import llm_utils
+from llm.response_cache import get_response_cache
+from similarity.similarity_utils import candidates_file_for, similarity_indices
+from similarity.candidates_io import read_summary
+from similarity.backends import get_search_backend
+from similarity.search_cache import invalidate_index
+from similarity.candidates_store import open_candidates_store
+from similarity.jobs import JobRegistry
+from instrumentation import registry as metrics_registry
+from instrumentation.metrics import JsonExporter, PrometheusExporter
 
 load_dotenv()
 
@@ -23,6 +31,67 @@ def load_similarity_config():
     with open(config_path, 'r') as f:
         return json.load(f)
 
+# The store is memory-mapped, so it is shared across reruns and sessions; mtime invalidates it when the file changes
+@st.cache_resource
+def load_candidates_store(file_path, mtime):
+    return open_candidates_store(file_path)
+
+# Evaluations run in background threads of the server process, the registry is shared by all sessions,
+# so a rerun or another user's click follows the running job and finished results stay available
+@st.cache_resource
+def get_job_registry():
+    return JobRegistry()
+
+def show_hits_table(hits_scores, mapping_size):
+    # Prepare DataFrame: one row with all values
+    hits_row = {f"Hits@{k}": v for k, v in hits_scores.items()}
+    hits_row["Mapping size"] = mapping_size
+    hits_df = pd.DataFrame([hits_row])
+
+    # Reorder columns: 'Mapping size' first
+    cols = ["Mapping size"] + [f"Hits@{k}" for k in sorted(hits_scores.keys())]
+    hits_df = hits_df[cols]
+
+    # Apply green gradient styling to Hits@K columns (vmin/vmax fixed to 0–100)
+    styled_hits_df = (
+        hits_df.style.format(precision=2)
+        .background_gradient(cmap='BuGn', axis=1, subset=cols[1:], vmin=0, vmax=100)
+        .hide(axis='index')  # Hide row index
+    )
+
+    st.dataframe(styled_hits_df, use_container_width=True)
+
+
+def show_cascade_report(report):
+    reasons = ", ".join(f"{reason}: {count}" for reason, count in report["escalation_reasons"].items())
+    st.caption(f"Escalated {report['escalated']} of {report['entities']} entities "
+               f"({100 * report['escalated_share']:.1f}%) to {report['escalation_model']}"
+               + (f" ({reasons})" if reasons else "") + ".")
+    if report["cost_saved_share"] is not None:
+        st.caption(f"Cost ${report['cascade_cost_usd']:.4f} instead of ${report['baseline_cost_usd']:.4f} with "
+                   f"{report['escalation_model']} only (saved {100 * report['cost_saved_share']:.1f}%).")
+    if report["latency_saved_per_entity_s"] is not None:
+        st.caption(f"Latency per entity {1000 * report['cascade_latency_per_entity_s']:.0f} ms instead of "
+                   f"{1000 * report['baseline_latency_per_entity_s']:.0f} ms.")
+
+# Polls the running job every second without rerunning the whole page
+@st.fragment(run_every=1.0)
+def show_running_hits_job(selected_pair, selected_mapping):
+    job = get_job_registry().get(selected_pair, selected_mapping)
+    if not job.running:
+        # full rerun to show the final results and stop polling
+        st.rerun()
+    state = job.snapshot()
+    done, total = state["done"], state["total"]
+    elapsed_time = time.time() - state["started_at"]
+    if not total:
+        st.progress(0.0, text=f"Loading ontologies and mappings ({elapsed_time:.0f}s)")
+        return
+    st.progress(done / total, text=f"Computing Hits@K: {done} of {total} queries ({elapsed_time:.0f}s)")
+    if state["partial_hits"]:
+        show_hits_table(state["partial_hits"], total)
+        st.caption(f"Partial results over {done} queries. MRR: {state['partial_mrr']:.4f}")
+
 def load_candidate_results():
     candidates_results_folder = Path("../data/candidates/")
     files = [f.name for f in candidates_results_folder.iterdir() if f.is_file()]
@@ -45,7 +114,7 @@ if task == "Candidates Finder":
     search_term = st.text_input("Enter entity label:", "", help="Label of an entity to search equivalent for")
 
     # Input: index to use
-    index_options = ["doid_labels", "mesh_labels"]
+    index_options = list(similarity_indices.values())
     index_name = st.selectbox("Choose similarity index:", index_options,
                               help="Choose against which similarity index to search")
 
@@ -54,11 +123,13 @@ if task == "Candidates Finder":
 
     # Search button
     if st.button("Search Candidates") and search_term:
-        with st.spinner("Searching GraphDB index..."):
-            df_results = search_rdf_index(
+        with st.spinner("Searching similarity index..."):
+            backend, backend_index_name = get_search_backend(index_name)
+            ontology = next(kg for kg, name in similarity_indices.items() if name == index_name)
+            df_results = backend.search(
                 search_term,
-                index_name,
-                index_name.replace("_labels", "_id"),
+                backend_index_name,
+                ontology.lower() + "_id",
                 top_k=top_k
             )
 
@@ -93,33 +164,68 @@ elif task == "Similarity Search Evaluation":
     save_candidates = st.checkbox("Save candidates data", value=True,
                                   help="Persists generated candidates data to be used by the LLM classification task")
 
-    if st.button("Compute Hits@K"):
-        with st.spinner("Computing Hits@K..."):
-            hits_scores, mapping_size, elapsed_time = compute_hits_at_n(selected_pair, selected_mapping, save_candidates)
+    resume = st.checkbox("Resume interrupted run", value=False,
+                         help="Keeps the candidates already saved by a previous run and only searches the missing ids")
 
-            if not hits_scores:
-                st.warning("No results returned.")
-            else:
-                st.success("Hits@K Results:")
-
-                # Prepare DataFrame: one row with all values
-                hits_row = {f"Hits@{k}": v for k, v in hits_scores.items()}
-                hits_row["Mapping size"] = mapping_size
-                hits_df = pd.DataFrame([hits_row])
-
-                # Reorder columns: 'Mapping size' first
-                cols = ["Mapping size"] + [f"Hits@{k}" for k in sorted(hits_scores.keys())]
-                hits_df = hits_df[cols]
-
-                # Apply green gradient styling to Hits@K columns (vmin/vmax fixed to 0–100)
-                styled_hits_df = (
-                    hits_df.style.format(precision=2)
-                    .background_gradient(cmap='BuGn', axis=1, subset=cols[1:], vmin=0, vmax=100)
-                    .hide(axis='index')  # Hide row index
-                )
+    incremental = st.checkbox("Only search new or changed mappings", value=False,
+                              help="Reuses the saved candidates of unchanged mapping rows and rewrites the candidates "
+                                   "file with the same content as a full run")
+
+    exact_match = st.checkbox("Resolve exact label matches without searching", value=False,
+                              help="Source labels equal to a single target label (ignoring case, punctuation and word "
+                                   "order) get that target as their only candidate without a similarity search")
+
+    local_labels = st.checkbox("Take candidate labels from the label table", value=False,
+                               help="GraphDB only returns the ids and scores of the candidates, their labels are "
+                                    "looked up in the local label table of the target ontology")
 
-                st.dataframe(styled_hits_df, use_container_width=True)
-                st.caption(f"Computed in {elapsed_time:.2f} seconds.")
+    max_workers = st.slider("Concurrent searches", 1, 32, 8,
+                            help="Number of similarity searches sent to GraphDB in parallel")
+
+    batch_size = st.number_input("Search batch size", min_value=0, max_value=500, value=0, step=10,
+                                 help="Number of labels searched in a single SPARQL request (0 sends one request per label)")
+
+    use_cache = st.checkbox("Use search cache", value=True,
+                            help="Reuses similarity search results persisted by previous runs")
+
+    with st.expander("Search cache maintenance"):
+        index_to_invalidate = st.selectbox("Similarity index:", list(similarity_indices.values()),
+                                           help="Drop cached results after the similarity index was rebuilt")
+        if st.button("Invalidate cached results"):
+            removed = invalidate_index(index_to_invalidate)
+            st.info(f"Removed {removed} cached searches for {index_to_invalidate}.")
+
+    if st.button("Compute Hits@K"):
+        options = dict(save_candidates=save_candidates,
+                       max_workers=max_workers,
+                       batch_size=batch_size or None,
+                       use_cache=use_cache,
+                       resume=resume and save_candidates,
+                       incremental=incremental and save_candidates,
+                       exact_match=exact_match,
+                       local_labels=local_labels)
+        job = get_job_registry().submit(selected_pair, selected_mapping, **options)
+        if job.options != options:
+            st.info("Following the evaluation already running for this mapping (started with its own settings).")
+
+    job = get_job_registry().get(selected_pair, selected_mapping)
+    if job is not None and job.running:
+        show_running_hits_job(selected_pair, selected_mapping)
+    elif job is not None:
+        state = job.snapshot()
+        if state["status"] == "failed":
+            st.error(f"Hits@K computation failed: {state['error']}")
+        elif not state["result"] or not state["result"][0]:
+            st.warning("No results returned.")
+        else:
+            hits_scores, mapping_size, elapsed_time, mrr = state["result"]
+            st.success("Hits@K Results:")
+            show_hits_table(hits_scores, mapping_size)
+            st.caption(f"MRR: {mrr:.4f}. Computed in {elapsed_time:.2f} seconds.")
+            if job.options.get("exact_match") and job.options.get("save_candidates"):
+                exact_matches = read_summary(candidates_file_for(selected_pair, selected_mapping)).get("exact_matches")
+                if exact_matches is not None:
+                    st.caption(f"Exact match fast path resolved {exact_matches} queries without a similarity search.")
 
 # Task 3 LLM classification
 elif task == "LLM classification":
@@ -127,7 +233,12 @@ elif task == "LLM classification":
 
     # Saved candidates results
     candidates_results = load_candidate_results()
-    candidates_results_names = [f.replace(".json","") for f in candidates_results if f.endswith(".json")]
+    # JSON Lines results take precedence over legacy .json results with the same name
+    candidates_files = {}
+    for f in sorted(candidates_results):
+        if (f.endswith(".jsonl") or f.endswith(".json")) and not f.endswith(".summary.json"):
+            candidates_files[os.path.splitext(f)[0]] = f
+    candidates_results_names = list(candidates_files.keys())
     candidates_result = st.selectbox("Choose candidates results:", candidates_results_names,
                                      help="Choose candidates results generated from the task Similarity Search.")
 
@@ -145,25 +256,52 @@ elif task == "LLM classification":
     extended_prompt = st.checkbox("Use extended prompt", value=False,
                                   help="Uses more detailed prompts with all altLabel and parent classes for the source and all the candidates.")
 
-    current_page = 1
+    max_in_flight = st.slider("Concurrent requests", 1, 32, 8,
+                              help="Maximum number of prompts sent to OpenAI at the same time")
+
+    use_response_cache = st.checkbox("Use LLM response cache", value=True,
+                                     help="Reuses answers to identical prompts from previous runs instead of sending them again")
+
+    max_prompt_tokens = st.number_input("Prompt token budget", min_value=0, value=0, step=100,
+                                        help="Maximum tokens per prompt, 0 for no limit. Over-budget prompts first lose "
+                                             "the extended labels, then the lowest scoring candidates.")
+
+    escalation_model = st.selectbox("Escalate uncertain answers to:", ["None"] + [m for m in model_options if m != model],
+                                    help="Cascade: the chosen model answers first, answers that are not a candidate ID "
+                                         "or have low confidence are sent again to this model.")
+    min_probability, min_score_margin = 0.9, 0.0
+    if escalation_model != "None":
+        min_probability = st.slider("Minimum answer probability", 0.0, 1.0, 0.9, 0.01,
+                                    help="Answers whose token logprobs give a lower probability are escalated")
+        min_score_margin = st.number_input("Minimum score margin of the top candidates", min_value=0.0, max_value=1.0,
+                                           value=0.0, step=0.01,
+                                           help="Entities whose two best candidates are closer in similarity score "
+                                                "are escalated, 0 disables the check")
+    escalation = (escalation_model, min_probability, min_score_margin) if escalation_model != "None" else None
+
+    # the cascade scores every answer by its own logprobs, so it sends one entity per request
+    pack_size = st.slider("Entities per request", 1, 10, 1, disabled=escalation is not None,
+                          help="Source entities classified together in one prompt with a JSON answer. "
+                               "Invalid or missing answers are re-sent one entity at a time, packs over the prompt "
+                               "token budget are split.")
+    if escalation is not None:
+        pack_size = 1
+        st.caption("With escalation every entity is sent in its own request.")
+
+    answer_exact_matches = st.checkbox("Answer exact label matches without the LLM", value=False,
+                                       help="Source labels equal to a single target label (ignoring case, punctuation "
+                                            "and word order) are answered with that target without a prompt")
 
-    file_path = f"../data/candidates/{candidates_result}.json"
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    current_page = 1
 
-    candidates_data = data.get("candidates", {})
+    file_path = f"../data/candidates/{candidates_files[candidates_result]}"
 
-    filtered_candidates_data = {
-        kg1_id: entry
-        for kg1_id, entry in candidates_data.items()
-        if entry.get("equivalent_id") in {c[target_id_name] for c in entry.get("candidates", [])}
-    }
+    candidates_store = load_candidates_store(file_path, os.path.getmtime(file_path))
 
-    print(f"{candidates_result} contains {len(filtered_candidates_data)} classifiable ids.")
+    print(f"{candidates_result} contains {candidates_store.num_classifiable} classifiable ids.")
 
     page_size = 10
-    total_pages = math.ceil(len(filtered_candidates_data) / page_size)
+    total_pages = math.ceil(candidates_store.num_classifiable / page_size)
 
     # Session state to track page
     if "current_page" not in st.session_state:
@@ -171,10 +309,7 @@ elif task == "LLM classification":
 
     # Get current page slice
     start_idx = (st.session_state.current_page - 1) * page_size
-    end_idx = start_idx + page_size
-    keys = list(filtered_candidates_data.keys())
-    page_keys = keys[start_idx:end_idx]
-    page_data = {k: filtered_candidates_data[k] for k in page_keys}
+    page_data = candidates_store.page(start_idx, page_size)
 
     # Track previous selections to reset cache when inputs change
     if "last_candidates_result" not in st.session_state:
@@ -183,32 +318,65 @@ elif task == "LLM classification":
         st.session_state.last_model = model
     if "last_extended_prompt" not in st.session_state:
         st.session_state.last_extended_prompt = extended_prompt
+    if "last_max_prompt_tokens" not in st.session_state:
+        st.session_state.last_max_prompt_tokens = max_prompt_tokens
+    if "last_escalation" not in st.session_state:
+        st.session_state.last_escalation = escalation
+    if "last_answer_exact_matches" not in st.session_state:
+        st.session_state.last_answer_exact_matches = answer_exact_matches
+    if "last_pack_size" not in st.session_state:
+        st.session_state.last_pack_size = pack_size
 
     # Reset classified results if inputs changed
     if (
             st.session_state.last_candidates_result != candidates_result or
             st.session_state.last_model != model or
-            st.session_state.last_extended_prompt != extended_prompt
+            st.session_state.last_extended_prompt != extended_prompt or
+            st.session_state.last_max_prompt_tokens != max_prompt_tokens or
+            st.session_state.last_escalation != escalation or
+            st.session_state.last_answer_exact_matches != answer_exact_matches or
+            st.session_state.last_pack_size != pack_size
     ):
         st.session_state.classified_pages = {}  # Clear the cache
+        st.session_state.cascade_reports = {}
         st.session_state.current_page = 1  # Optionally reset to page 1
 
         # Update tracked inputs
         st.session_state.last_candidates_result = candidates_result
         st.session_state.last_model = model
         st.session_state.last_extended_prompt = extended_prompt
+        st.session_state.last_max_prompt_tokens = max_prompt_tokens
+        st.session_state.last_escalation = escalation
+        st.session_state.last_answer_exact_matches = answer_exact_matches
+        st.session_state.last_pack_size = pack_size
 
 
     # Session state to cache results
     if "classified_pages" not in st.session_state:
         st.session_state.classified_pages = {}
+    if "cascade_reports" not in st.session_state:
+        st.session_state.cascade_reports = {}
 
     # Trigger LLM classification
     if st.button("Classify"):
         with st.spinner("Sending prompts to OpenAI..."):
             if st.session_state.current_page not in st.session_state.classified_pages:
-                result_df, score = llm_utils.classify(page_data, model, source, target, extended_prompt)
+                cascade_report = None
+                if escalation is not None:
+                    result_df, score, cascade_report = llm_utils.classify_cascade(
+                        page_data, model, escalation_model, source, target, extended_prompt,
+                        max_in_flight=max_in_flight, use_cache=use_response_cache,
+                        max_prompt_tokens=max_prompt_tokens or None, min_probability=min_probability,
+                        min_score_margin=min_score_margin or None, exact_match=answer_exact_matches)
+                else:
+                    result_df, score = llm_utils.classify(page_data, model, source, target, extended_prompt,
+                                                          max_in_flight=max_in_flight,
+                                                          use_cache=use_response_cache,
+                                                          max_prompt_tokens=max_prompt_tokens or None,
+                                                          pack_size=pack_size,
+                                                          exact_match=answer_exact_matches)
                 st.session_state.classified_pages[st.session_state.current_page] = (result_df, score)
+                st.session_state.cascade_reports[st.session_state.current_page] = cascade_report
             else:
                 result_df, score = st.session_state.classified_pages[st.session_state.current_page]
 
@@ -229,6 +397,20 @@ elif task == "LLM classification":
             st.success(f"Page success rate: {100 * score:.2f}%")
             st.info(f"Cumulative success rate for first {len(st.session_state.classified_pages)} pages: {100 * cumulative_score:.2f}%")
 
+            if "Answered By" in result_df:
+                exact_answers = int((result_df["Answered By"] == "exact match").sum())
+                st.caption(f"Exact match fast path answered {exact_answers} of {len(result_df)} entities "
+                           f"without the LLM.")
+
+            cascade_report = st.session_state.cascade_reports.get(st.session_state.current_page)
+            if cascade_report:
+                show_cascade_report(cascade_report)
+
+            if use_response_cache:
+                cache_stats = get_response_cache().stats()
+                st.caption(f"LLM response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                           f"{cache_stats['entries']} stored answers.")
+
     # Navigation controls
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -239,4 +421,40 @@ elif task == "LLM classification":
             st.session_state.current_page += 1
 
     # Show pagination info
-    st.caption(f"Page {st.session_state.current_page} of {total_pages}")
\ No newline at end of file
+    st.caption(f"Page {st.session_state.current_page} of {total_pages}")
+# Timings, token usage and cache hits of everything run by this server process
+with st.sidebar.expander("📈 Run metrics"):
+    metrics_snapshot = metrics_registry.snapshot()
+
+    def format_labels(labels):
+        return ", ".join(f"{key}={value}" for key, value in labels.items())
+
+    if not metrics_snapshot["histograms"] and not metrics_snapshot["counters"]:
+        st.caption("Nothing recorded yet.")
+    else:
+        token_totals = {}
+        for counter in metrics_snapshot["counters"]:
+            if counter["name"] in ("llm_prompt_tokens_total", "llm_completion_tokens_total"):
+                token_totals[counter["name"]] = token_totals.get(counter["name"], 0) + counter["value"]
+        st.caption(f"LLM tokens: {token_totals.get('llm_prompt_tokens_total', 0)} prompt, "
+                   f"{token_totals.get('llm_completion_tokens_total', 0)} completion")
+
+        st.dataframe(pd.DataFrame([{
+            "Stage": f"{h['name'].removesuffix('_seconds')} ({format_labels(h['labels'])})",
+            "Calls": h["count"],
+            "Total s": round(h["sum"], 2),
+            "Mean ms": round(1000 * h["sum"] / h["count"], 1),
+            "p50 ms": round(1000 * h["p50"], 1),
+            "p99 ms": round(1000 * h["p99"], 1),
+        } for h in metrics_snapshot["histograms"]]), hide_index=True, use_container_width=True)
+
+        st.dataframe(pd.DataFrame([{
+            "Counter": c["name"], "Labels": format_labels(c["labels"]), "Value": c["value"]
+        } for c in metrics_snapshot["counters"]]), hide_index=True, use_container_width=True)
+
+    st.download_button("Export JSON", JsonExporter().render(metrics_snapshot), file_name="metrics.json")
+    st.download_button("Export Prometheus", PrometheusExporter().render(metrics_snapshot),
+                       file_name="metrics.prom")
+    if st.button("Reset metrics"):
+        metrics_registry.reset()
+        st.rerun()
@@ -0,0 +1,170 @@
+"""
+Headless evaluation of every pair and mapping of data/similarity_config.json.
+
+Runs compute_hits_at_n (and optionally the LLM classification of the generated candidates) for all mappings
+in parallel worker processes and writes one consolidated results table with timings.
+
+Example usage (from the app folder):
+    python run_evaluations.py --processes 8 --graphdb-jobs 2 --classify --model gpt-4o-mini --classify-limit 200
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+# Add the main folder (parent of `app/`) to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from similarity.backends import LOCAL_INDEX_PREFIX
+from similarity.candidates_io import read_summary
+from similarity.candidates_store import open_candidates_store
+from similarity.lsh import LSH_INDEX_PREFIX
+from similarity.similarity_utils import candidates_file_for, compute_hits_at_n, similarity_indices
+
+SIMILARITY_CONFIG_FILE = "../data/similarity_config.json"
+RESULTS_DIR = "../data/results/"
+
+
+def search_backend_of(selected_pair):
+    """Name of the search backend used for a pair, evaluations on the same backend share its concurrency cap."""
+    index_name = similarity_indices.get(selected_pair.split("-")[1], "")
+    return "local" if index_name.startswith((LOCAL_INDEX_PREFIX, LSH_INDEX_PREFIX)) else "graphdb"
+
+
+def run_evaluation(selected_pair, selected_mapping, options, limits):
+    """
+    Evaluates one pair and mapping in a worker process.
+
+    :param options: Parsed command line arguments
+    :param limits: Dictionary of backend name to a semaphore shared by all worker processes
+    :return: One row of the results table
+    """
+    row = {"pair": selected_pair, "mapping": selected_mapping}
+    try:
+        with limits[search_backend_of(selected_pair)]:
+            result = compute_hits_at_n(selected_pair, selected_mapping, save_candidates=True,
+                                       max_workers=options.max_workers, batch_size=options.batch_size,
+                                       use_cache=options.use_cache, incremental=options.incremental,
+                                       exact_match=options.exact_match, local_labels=options.local_labels)
+        if not result:
+            row["error"] = "no similarity index"
+            return row
+
+        hits_scores, mapping_size, elapsed_time, mrr = result
+        row["mapping_size"] = mapping_size
+        row.update({f"Hits@{k}": v for k, v in hits_scores.items()})
+        row["MRR"] = mrr
+        row["search_seconds"] = round(elapsed_time, 2)
+        if options.exact_match:
+            summary = read_summary(candidates_file_for(selected_pair, selected_mapping))
+            row["exact_matches"] = summary.get("exact_matches")
+
+        if options.classify:
+            # imported here, the OpenAI client is only needed when classifying
+            from llm import llm_utils
+
+            source, target = selected_pair.split("-")
+            candidates_store = open_candidates_store(candidates_file_for(selected_pair, selected_mapping))
+            data = candidates_store.page(0, options.classify_limit or candidates_store.num_classifiable)
+            with limits["openai"]:
+                start_time = time.time()
+                if options.escalation_model:
+                    _, score, report = llm_utils.classify_cascade(data, options.model, options.escalation_model,
+                                                                  source, target, options.extended_prompt,
+                                                                  max_in_flight=options.max_in_flight,
+                                                                  min_probability=options.min_probability,
+                                                                  exact_match=options.exact_match)
+                    row["escalated_share"] = report["escalated_share"]
+                    row["cost_saved_share"] = report["cost_saved_share"]
+                else:
+                    batch_requests_file = None
+                    if options.batch:
+                        batch_requests_file = "../data/batches/" + selected_pair + "_" + \
+                                              selected_mapping.replace(".csv", ".jsonl")
+                    _, score = llm_utils.classify(data, options.model, source, target, options.extended_prompt,
+                                                  max_in_flight=options.max_in_flight, exact_match=options.exact_match,
+                                                  batch_requests_file=batch_requests_file)
+            row["classified"] = len(data)
+            row["llm_accuracy"] = round(score, 4)
+            row["llm_seconds"] = round(time.time() - start_time, 2)
+    except Exception as e:
+        print(f"Evaluation of {selected_pair} {selected_mapping} failed: {e}")
+        row["error"] = str(e)
+    return row
+
+
+def run_all(options):
+    with open(SIMILARITY_CONFIG_FILE, "r") as f:
+        config = json.load(f)
+    evaluations = [(pair, mapping) for pair, mappings in config.items() for mapping in mappings]
+
+    start_time = time.time()
+    rows = []
+    with multiprocessing.Manager() as manager:
+        limits = {"graphdb": manager.BoundedSemaphore(options.graphdb_jobs),
+                  "local": manager.BoundedSemaphore(options.processes),
+                  "openai": manager.BoundedSemaphore(options.openai_jobs)}
+        with ProcessPoolExecutor(max_workers=options.processes) as executor:
+            futures = [executor.submit(run_evaluation, pair, mapping, options, limits)
+                       for pair, mapping in evaluations]
+            for future in as_completed(futures):
+                row = future.result()
+                print(f"Finished {row['pair']} {row['mapping']} ({len(rows) + 1} of {len(evaluations)})")
+                rows.append(row)
+
+    # config order, independent of the completion order
+    order = {evaluation: i for i, evaluation in enumerate(evaluations)}
+    results_df = pd.DataFrame(sorted(rows, key=lambda r: order[(r["pair"], r["mapping"])]))
+
+    output_file = options.output or os.path.join(RESULTS_DIR, time.strftime("evaluation_%Y%m%d_%H%M%S.csv"))
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    results_df.to_csv(output_file, index=False)
+
+    print(results_df.to_string(index=False))
+    print(f"{len(evaluations)} evaluations in {time.time() - start_time:.2f} seconds, results written to {output_file}")
+    return results_df
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate every pair and mapping of similarity_config.json")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="Number of evaluations running in parallel")
+    parser.add_argument("--graphdb-jobs", type=int, default=2,
+                        help="Maximum evaluations searching GraphDB at the same time")
+    parser.add_argument("--openai-jobs", type=int, default=1,
+                        help="Maximum evaluations classifying with OpenAI at the same time")
+    parser.add_argument("--max-workers", type=int, default=8, help="Concurrent searches per evaluation")
+    parser.add_argument("--batch-size", type=int, default=None, help="Labels per batched search request")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="Do not use the search cache")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only search the mapping rows that are new or changed since the saved candidates")
+    parser.add_argument("--exact-match", action="store_true",
+                        help="Resolve labels matching a single target label without similarity search or LLM")
+    parser.add_argument("--local-labels", action="store_true",
+                        help="Only fetch candidate ids and scores from GraphDB, labels come from the label tables")
+    parser.add_argument("--classify", action="store_true", help="Classify the generated candidates with the LLM")
+    parser.add_argument("--model", default="gpt-4o-mini", help="OpenAI model used with --classify")
+    parser.add_argument("--escalation-model", default=None,
+                        help="With --classify, escalate uncertain answers of --model to this model")
+    parser.add_argument("--min-probability", type=float, default=0.9,
+                        help="Answers with a lower logprob probability are escalated (with --escalation-model)")
+    parser.add_argument("--batch", action="store_true",
+                        help="With --classify, send the prompts offline through the batch API and wait for the results")
+    parser.add_argument("--extended-prompt", action="store_true", help="Use the extended prompts with --classify")
+    parser.add_argument("--classify-limit", type=int, default=None,
+                        help="Classify only the first N classifiable entities of every mapping")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="Concurrent OpenAI requests per evaluation")
+    parser.add_argument("--output", default=None, help="Results csv (default: data/results/evaluation_<time>.csv)")
+    options = parser.parse_args(argv)
+    if options.batch and options.escalation_model:
+        parser.error("--batch cannot be combined with --escalation-model, the cascade needs online answers")
+    return options
+
+
+if __name__ == "__main__":
+    run_all(parse_args())
@@ -0,0 +1,265 @@
+"""
+Throughput benchmarks of the pipeline stages against local GraphDB and OpenAI stand-ins.
+
+Generates a synthetic ontology pair at the chosen scale in a temporary workspace and reports, per stage,
+operations/sec, p50/p99 latency of the individual calls and the peak Python memory.
+
+Example usage (from the project folder):
+    python -m benchmarks.run_benchmarks --scale medium --latency-ms 20 --error-rate 0.01 --output bench.json
+"""
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# the OpenAI client of llm_utils is created on import, the benchmarks point it to the chat stand-in
+os.environ.setdefault("OPENAI_API_KEY", "stand-in")
+
+from instrumentation import export_metrics, registry as metrics
+from llm import llm_utils
+from similarity import label_table
+from similarity import similarity_utils
+from similarity.backends import GraphDBBackend
+from similarity.candidates_store import open_candidates_store
+
+from .stand_ins import ChatStandInHandler, SparqlStandInHandler, start_stand_in, stop_stand_in
+from .synthetic import SCALES, SOURCE_ONTOLOGY, TARGET_ONTOLOGY, generate_dataset
+
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def timed(fn, latencies, errors=None):
+    """
+    Wraps fn to append the duration of every call to latencies.
+    With errors, the exceptions of failed calls are appended to it and the call returns None instead of raising.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append(e)
+        finally:
+            latencies.append(time.perf_counter() - start_time)
+    return wrapper
+
+
+def recorded_errors():
+    """
+    Number of failed SPARQL queries, LLM requests and batch API requests counted so far, including those retried
+    or skipped.
+    """
+    return sum(counter["value"] for counter in metrics.snapshot()["counters"]
+               if counter["name"] == "sparql_query_errors_total"
+               or (counter["name"] in ("llm_requests_total", "llm_batch_requests_total")
+                   and counter["labels"].get("status") != "ok"))
+
+
+def measure(name, stage_fn, trace_memory=True):
+    """
+    Runs one stage and returns its result row, a failing stage is reported instead of aborting the run.
+
+    :param stage_fn: Function taking the lists to append call latencies and failed call exceptions to
+                     (see timed), returning the number of operations
+    """
+    latencies = []
+    errors = []
+    errors_before = recorded_errors()
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        operations = stage_fn(latencies, errors)
+    except Exception as e:
+        print(f"{name} failed: {e!r}")
+        errors.append(e)
+        operations = 0
+    elapsed_time = time.perf_counter() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    if trace_memory:
+        tracemalloc.stop()
+
+    row = {"stage": name,
+           "operations": operations,
+           "seconds": round(elapsed_time, 3),
+           "ops/sec": round(operations / elapsed_time, 1) if elapsed_time else None,
+           "calls": len(latencies),
+           "errors": len(errors) + recorded_errors() - errors_before,
+           "p50 ms": round(float(np.percentile(latencies, 50)) * 1000, 2) if latencies else None,
+           "p99 ms": round(float(np.percentile(latencies, 99)) * 1000, 2) if latencies else None,
+           "peak MB": round(peak_memory / 2 ** 20, 1) if trace_memory else None}
+    print(f"{name}: {row}")
+    return row
+
+
+def run_benchmarks(options):
+    workspace = tempfile.mkdtemp(prefix="entity_alignment_bench_")
+    previous_dir = os.getcwd()
+    stand_ins = []
+    try:
+        # the app resolves data and queries relative to its own folder
+        os.makedirs(os.path.join(workspace, "app"))
+        shutil.copytree(os.path.join(PROJECT_DIR, "queries"), os.path.join(workspace, "queries"))
+        selected_pair, selected_mapping = generate_dataset(os.path.join(workspace, "data"), SCALES[options.scale])
+        os.chdir(os.path.join(workspace, "app"))
+
+        source_file = "../data/datasets/csv/" + SOURCE_ONTOLOGY + ".csv"
+        target_file = "../data/datasets/csv/" + TARGET_ONTOLOGY + ".csv"
+        index_name = similarity_utils.similarity_indices[TARGET_ONTOLOGY]
+        stand_in_options = dict(latency_ms=options.latency_ms, error_rate=options.error_rate)
+
+        sparql_process, sparql_url = start_stand_in(
+            SparqlStandInHandler, ontology_files={"doid_labels": source_file, "mesh_labels": target_file},
+            **stand_in_options)
+        chat_process, chat_url = start_stand_in(ChatStandInHandler, **stand_in_options)
+        stand_ins = [sparql_process, chat_process]
+        endpoint = sparql_url + "/repositories/bench"
+        llm_utils.SPARQL_ENDPOINT = endpoint
+        llm_utils.client = llm_utils.openai.OpenAI(base_url=chat_url + "/v1", api_key="stand-in")
+
+        source_labels = similarity_utils.read_class_id_to_pref_label(source_file)
+        search_terms = list(source_labels.values())[:options.queries]
+        # with --local-labels the searches only fetch ids and scores, labels come from the target label table
+        search_labels = label_table.load_labels(target_file) if options.local_labels else None
+        trace_memory = not options.no_memory
+        rows = []
+
+        def csv_loading(latencies, errors):
+            for _ in range(3):
+                timed(similarity_utils.read_class_id_to_pref_label, latencies)(target_file)
+            return 3
+
+        def label_table_build(latencies, errors):
+            timed(label_table.LabelTable.build, latencies)(target_file)
+            return 1
+
+        def label_table_load(latencies, errors):
+            for _ in range(3):
+                label_table._open_tables.clear()
+                timed(label_table.load_labels, latencies)(target_file)
+            return 3
+
+        def single_search(latencies, errors):
+            search = timed(similarity_utils.search_rdf_index_rows, latencies)
+            for term in search_terms:
+                search(term, index_name, top_k=100, endpoint=endpoint, id_to_label=search_labels)
+            return len(search_terms)
+
+        def batch_search(latencies, errors):
+            search = timed(similarity_utils.search_rdf_index_batch_rows, latencies)
+            for start in range(0, len(search_terms), options.batch_size):
+                search(search_terms[start:start + options.batch_size], index_name, top_k=100,
+                       batch_size=options.batch_size, endpoint=endpoint, id_to_label=search_labels)
+            return len(search_terms)
+
+        def hits_at_n(latencies, errors):
+            kg_1_to_kg_2 = pd.read_csv("../data/mappings/" + selected_mapping, dtype=str) \
+                .set_index(SOURCE_ONTOLOGY)[TARGET_ONTOLOGY].to_dict()
+            source_table = label_table.load_labels(source_file)
+            queries = {(source_id, source_table[source_id]): target_id
+                       for source_id, target_id in kg_1_to_kg_2.items()}
+            backend = GraphDBBackend(endpoint=endpoint, id_to_label=search_labels)
+            similarity_utils.calculate_hits_at_n(
+                queries, timed(backend.search_rows, latencies), label_table.load_labels(target_file), index_name,
+                TARGET_ONTOLOGY.lower() + "_id",
+                similarity_utils.candidates_file_for(selected_pair, selected_mapping),
+                k_values=[1, 3, 5, 10, 20, 40], max_workers=options.max_workers,
+                search_rdf_index_batch=timed(backend.search_rows_batch, latencies),
+                batch_size=options.batch_size)
+            return len(queries)
+
+        def extended_info(latencies, errors):
+            entity_ids = list(source_labels)[:options.queries]
+            fetch = timed(llm_utils.get_extended_info_bulk, latencies, errors)
+            for start in range(0, len(entity_ids), 200):
+                fetch(SOURCE_ONTOLOGY, entity_ids[start:start + 200], use_store=False)
+            return len(entity_ids)
+
+        def classify(latencies, errors):
+            candidates_store = open_candidates_store(similarity_utils.candidates_file_for(selected_pair,
+                                                                                          selected_mapping))
+            data = candidates_store.page(0, options.classify_limit)
+            llm_utils.request_equivalent_entity = timed(llm_utils.request_equivalent_entity, latencies)
+            try:
+                llm_utils.classify(data, "gpt-4o-mini", SOURCE_ONTOLOGY, TARGET_ONTOLOGY, options.extended_prompt,
+                                   max_in_flight=options.max_in_flight, use_cache=False)
+            finally:
+                llm_utils.request_equivalent_entity = llm_utils.request_equivalent_entity.__wrapped__
+            return len(data)
+
+        def classify_batch(latencies, errors):
+            candidates_store = open_candidates_store(similarity_utils.candidates_file_for(selected_pair,
+                                                                                          selected_mapping))
+            data = candidates_store.page(0, options.classify_limit)
+            # one batch through the files and batches endpoints of the chat stand-in, timed as a single call
+            timed(llm_utils.classify, latencies, errors)(data, "gpt-4o-mini", SOURCE_ONTOLOGY, TARGET_ONTOLOGY,
+                                                         options.extended_prompt, use_cache=False,
+                                                         batch_requests_file="../data/batches/benchmark.jsonl")
+            return len(data)
+
+        stages = [("csv loading (DictReader)", csv_loading),
+                  ("label table build", label_table_build),
+                  ("label table load", label_table_load),
+                  ("search_rdf_index", single_search),
+                  ("search_rdf_index_batch", batch_search),
+                  ("calculate_hits_at_n", hits_at_n),
+                  ("get_extended_info", extended_info),
+                  ("classify", classify),
+                  ("classify (batch API)", classify_batch)]
+        for name, stage_fn in stages:
+            rows.append(measure(name, stage_fn, trace_memory))
+    finally:
+        os.chdir(previous_dir)
+        for process in stand_ins:
+            stop_stand_in(process)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    results_df = pd.DataFrame(rows)
+    print(f"\nScale {options.scale} ({SCALES[options.scale]} entities), latency {options.latency_ms} ms, "
+          f"error rate {options.error_rate}")
+    print(results_df.to_string(index=False))
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({"options": vars(options), "stages": rows}, f, indent=2)
+    if options.metrics_output:
+        export_metrics(options.metrics_output, "prometheus" if options.metrics_output.endswith(".prom") else "json")
+    return results_df
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against local stand-ins")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--latency-ms", type=float, default=5, help="Mean latency of the stand-in servers")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of stand-in requests answered with a 503 error")
+    parser.add_argument("--queries", type=int, default=500,
+                        help="Labels used by the search and extended info stages")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--classify-limit", type=int, default=200)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--extended-prompt", action="store_true")
+    parser.add_argument("--local-labels", action="store_true",
+                        help="Search stages attach the candidate labels from the label table instead of SPARQL")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip tracemalloc, which slows down allocation heavy stages")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--metrics-output", default=None,
+                        help="File for the instrumentation metrics of the run (Prometheus text format for .prom)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks(parse_args()) is None)
@@ -0,0 +1,358 @@
+"""
+Local stand-ins for GraphDB and the OpenAI chat completions and batch endpoints, with configurable latency and
+error injection.
+
+Both run in a child process (see start_stand_in), so their work does not count in the measured stages.
+"""
+import csv
+import email.parser
+import email.policy
+import gzip
+import io
+import json
+import math
+import multiprocessing
+import random
+import re
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from similarity.similarity_utils import read_class_id_to_pref_label
+
+_SEARCH_PATTERN = re.compile(r'(?:BIND\((\d+) AS \?termIndex\)\s*)?\?search a similarity-index:(\w+) ;\s*'
+                             r':searchTerm "((?:[^"\\]|\\.)*)".*?LIMIT (\d+)', re.DOTALL)
+_VALUES_PATTERN = re.compile(r"VALUES \?subject \{([^}]*)\}")
+_URI_PATTERN = re.compile(r"<([^>]+)>")
+_CANDIDATE_ID_PATTERN = re.compile(r"^- ID: ([^,]+),", re.MULTILINE)
+_SOURCE_ENTITY_PATTERN = re.compile(r"^Source entity (.+):$", re.MULTILINE)
+
+
+def _normalize(label):
+    return " ".join(sorted(label.lower().split()))
+
+
+def _unescape_sparql_literal(value):
+    return re.sub(r"\\(.)", lambda m: {"n": "\n", "r": "\r"}.get(m.group(1), m.group(1)), value)
+
+
+_XSD_FLOAT = "http://www.w3.org/2001/XMLSchema#float"
+_XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+
+
+def _tsv_term(term):
+    if term is None:
+        return ""
+    if term["type"] == "uri":
+        return "<" + term["value"] + ">"
+    if term.get("datatype") == _XSD_INTEGER:
+        return term["value"]
+    value = (term["value"].replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+             .replace("\r", "\\r").replace("\t", "\\t"))
+    return f'"{value}"' + (f"^^<{term['datatype']}>" if "datatype" in term else "")
+
+
+def _render_tsv(result):
+    variables = result["head"]["vars"]
+    lines = ["\t".join("?" + variable for variable in variables)]
+    lines.extend("\t".join(_tsv_term(binding.get(variable)) for variable in variables)
+                 for binding in result["results"]["bindings"])
+    return "\n".join(lines) + "\n"
+
+
+def _render_csv(result):
+    variables = result["head"]["vars"]
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\r\n")
+    writer.writerow(variables)
+    for binding in result["results"]["bindings"]:
+        writer.writerow([binding.get(variable, {}).get("value", "") for variable in variables])
+    return output.getvalue()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, with Nagle kept-alive connections would wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_bytes(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def _read_body(self):
+        return self._read_bytes().decode("utf-8")
+
+    def _inject(self):
+        """Sleeps the configured latency and returns True when this request should fail."""
+        server = self.server
+        time.sleep(server.latency * (0.5 + random.random()))
+        if random.random() < server.error_rate:
+            self._send(server.error_status, json.dumps({"error": {"message": "injected error", "type": "server_error"}}),
+                       headers={"Retry-After": "0"})
+            return True
+        return False
+
+
+class SparqlStandInHandler(_StandInHandler):
+    """
+    Answers the similarity search queries (single and batched), the extended info queries and the /size request
+    of the app from the labels of the synthetic ontologies.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith("/size"):
+            self._send(200, str(self.server.size), content_type="text/plain")
+            return
+        self._answer(parse_qs(url.query).get("query", [""])[0])
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.headers.get("Content-Type", "").startswith("application/sparql-query"):
+            self._answer(body)
+        else:
+            self._answer(parse_qs(body).get("query", [""])[0])
+
+    def _answer(self, query):
+        if self._inject():
+            return
+        values = _VALUES_PATTERN.search(query)
+        if values:
+            result = self._extended_info(_URI_PATTERN.findall(values.group(1)))
+        else:
+            result = self._similarity_search(query)
+
+        accept = self.headers.get("Accept", "")
+        if "text/tab-separated-values" in accept:
+            body, content_type = _render_tsv(result), "text/tab-separated-values"
+        elif "text/csv" in accept:
+            body, content_type = _render_csv(result), "text/csv"
+        else:
+            body, content_type = json.dumps(result), "application/sparql-results+json"
+        headers = None
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body, headers = gzip.compress(body.encode("utf-8"), compresslevel=1), {"Content-Encoding": "gzip"}
+        self._send(200, body, content_type=content_type, headers=headers)
+
+    def _similarity_search(self, query):
+        bindings = []
+        batched = "?termIndex" in query
+        with_labels = "?label" in query
+        for term_index, index_name, term, top_k in _SEARCH_PATTERN.findall(query):
+            for document_id, label, score in self.server.search(index_name, _unescape_sparql_literal(term),
+                                                                int(top_k)):
+                binding = {"documentID": {"type": "uri", "value": document_id},
+                           "score": {"type": "literal", "value": str(score), "datatype": _XSD_FLOAT}}
+                if with_labels:
+                    binding["label"] = {"type": "literal", "value": label}
+                if batched:
+                    binding["termIndex"] = {"type": "literal", "value": term_index, "datatype": _XSD_INTEGER}
+                bindings.append(binding)
+        variables = (["termIndex"] if batched else []) + ["documentID"] + (["label"] if with_labels else []) \
+            + ["score"]
+        return {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+    def _extended_info(self, subjects):
+        bindings = []
+        for subject in subjects:
+            label = self.server.labels.get(subject)
+            if label is None:
+                continue
+            bindings.append({"subject": {"type": "uri", "value": subject},
+                             "altLabels": {"type": "literal", "value": f"{label} (synonym); {label} NOS"},
+                             "parentClassLabels": {"type": "literal", "value": " ".join(label.split()[:-1])}})
+        return {"head": {"vars": ["subject", "altLabels", "parentClassLabels"]}, "results": {"bindings": bindings}}
+
+
+def _chat_completion(request):
+    """
+    Chat completion response with the first candidate of the prompt, and for packed prompts a JSON object
+    of the first candidate per source entity. Requests with logprobs get one token with a probability that is
+    fixed per prompt.
+    """
+    prompt = request["messages"][-1]["content"]
+    source_ids = _SOURCE_ENTITY_PATTERN.findall(prompt)
+    if source_ids:
+        blocks = re.split(r"^Source entity .+:$", prompt, flags=re.MULTILINE)[1:]
+        answer = json.dumps({source_id: (_CANDIDATE_ID_PATTERN.findall(block) or [""])[0]
+                             for source_id, block in zip(source_ids, blocks)})
+    else:
+        answer = (_CANDIDATE_ID_PATTERN.findall(prompt) or [""])[0]
+    choice = {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+    if request.get("logprobs"):
+        # answer probability between 0.5 and 1, fixed per prompt, so a share of the answers is uncertain
+        probability = 0.5 + 0.5 * (zlib.crc32(prompt.encode("utf-8")) % 1000) / 1000
+        choice["logprobs"] = {"content": [{"token": answer, "logprob": math.log(probability),
+                                           "bytes": list(answer.encode("utf-8")), "top_logprobs": []}]}
+    return {"id": f"chatcmpl-{random.getrandbits(48):x}", "object": "chat.completion",
+            "created": int(time.time()), "model": request["model"],
+            "choices": [choice],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4 + 1,
+                      "total_tokens": len(prompt) // 4 + len(answer) // 4 + 1}}
+
+
+def _parse_multipart(body, content_type):
+    """Returns the form fields of a multipart/form-data body as name to (file name, content bytes)."""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("utf-8") + b"\r\n\r\n" + body)
+    return {part.get_param("name", header="content-disposition"): (part.get_filename(),
+                                                                     part.get_payload(decode=True))
+            for part in message.iter_parts()}
+
+
+class ChatStandInHandler(_StandInHandler):
+    """
+    Answers chat completions (see _chat_completion), and the file upload, file content and batch create and
+    retrieve requests of the batch API. A batch is answered when it is created and reported completed at the
+    first poll; every request of it fails with the configured error rate, like a real batch with failed lines.
+    """
+
+    def do_GET(self):
+        if self._inject():
+            return
+        path = urlparse(self.path).path
+        content = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+        if content and content.group(1) in self.server.files:
+            self._send(200, self.server.files[content.group(1)][1], content_type="application/octet-stream")
+            return
+        batch = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+        if batch and batch.group(1) in self.server.batches:
+            self._send(200, json.dumps(self._poll_batch(batch.group(1))))
+            return
+        self._send(404, json.dumps({"error": {"message": f"{path} not found", "type": "invalid_request_error"}}))
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/v1/files":
+            fields = _parse_multipart(self._read_bytes(), self.headers.get("Content-Type", ""))
+            if self._inject():
+                return
+            self._send(200, json.dumps(self._create_file(*fields["file"], purpose=fields["purpose"][1].decode())))
+            return
+        request = json.loads(self._read_body())
+        if self._inject():
+            return
+        if path == "/v1/batches":
+            self._send(200, json.dumps(self._create_batch(request)))
+        else:
+            self._send(200, json.dumps(_chat_completion(request)))
+
+    def _create_file(self, filename, content, purpose):
+        file_id = f"file-{random.getrandbits(48):x}"
+        self.server.files[file_id] = (filename, content)
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def _create_batch(self, request):
+        results = []
+        for line in self.server.files[request["input_file_id"]][1].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            batch_request = json.loads(line)
+            if random.random() < self.server.error_rate:
+                response = {"status_code": self.server.error_status,
+                            "body": {"error": {"message": "injected error", "type": "server_error"}}}
+            else:
+                response = {"status_code": 200, "body": _chat_completion(batch_request["body"])}
+            results.append({"id": f"batch_req_{random.getrandbits(48):x}", "custom_id": batch_request["custom_id"],
+                            "response": response, "error": None})
+        output = "".join(json.dumps(result) + "\n" for result in results).encode("utf-8")
+        output_file = self._create_file("batch_output.jsonl", output, purpose="batch_output")
+
+        batch_id = f"batch_{random.getrandbits(48):x}"
+        failed = sum(result["response"]["status_code"] != 200 for result in results)
+        self.server.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+            "status": "in_progress", "created_at": int(time.time()), "output_file_id": None,
+            "request_counts": {"total": len(results), "completed": len(results) - failed, "failed": failed},
+            "pending_output_file_id": output_file["id"]}
+        return self._public_batch(batch_id)
+
+    def _poll_batch(self, batch_id):
+        batch = self.server.batches[batch_id]
+        if batch["status"] == "in_progress":
+            batch.update(status="completed", completed_at=int(time.time()),
+                         output_file_id=batch["pending_output_file_id"])
+        return self._public_batch(batch_id)
+
+    def _public_batch(self, batch_id):
+        return {key: value for key, value in self.server.batches[batch_id].items() if key != "pending_output_file_id"}
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency_ms=0, error_rate=0.0, error_status=503, ontology_files=None):
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # uploaded files (file name, content bytes) and batches of the batch API stand-in, by id
+        self.files = {}
+        self.batches = {}
+
+        # similarity index name to (normalized label to ids, all ids), and all labels for the extended info
+        self.labels = {}
+        self.indices = {}
+        for index_name, ontology_file in (ontology_files or {}).items():
+            id_to_label = read_class_id_to_pref_label(ontology_file)
+            by_label = {}
+            for class_id, label in id_to_label.items():
+                by_label.setdefault(_normalize(label), []).append(class_id)
+            self.indices[index_name] = (by_label, list(id_to_label))
+            self.labels.update(id_to_label)
+        self.size = len(self.labels)
+
+    def search(self, index_name, term, top_k):
+        """Entities with the same words as term first, then a fixed pseudo-random filler per term."""
+        by_label, all_ids = self.indices.get(index_name, ({}, []))
+        matches = by_label.get(_normalize(term), [])[:top_k]
+        rng = random.Random(zlib.crc32(term.encode("utf-8")))
+        fillers = rng.sample(all_ids, min(len(all_ids), top_k - len(matches))) if all_ids else []
+        rows = [(class_id, self.labels[class_id], 1.0) for class_id in matches]
+        rows += [(class_id, self.labels[class_id], round(0.9 - 0.005 * i, 4))
+                 for i, class_id in enumerate(class_id for class_id in fillers if class_id not in matches)]
+        return rows[:top_k]
+
+
+def _serve(handler_class, options, port_queue):
+    server = StandInServer(handler_class, **options)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_stand_in(handler_class, **options):
+    """
+    Starts a stand-in server in a child process.
+
+    :param options: Keyword arguments of StandInServer (latency_ms, error_rate, error_status, ontology_files)
+    :return: The child process and the base url of the server
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(handler_class, options, port_queue), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=600)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def stop_stand_in(process):
+    process.terminate()
+    process.join()
+
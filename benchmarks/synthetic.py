@@ -0,0 +1,77 @@
+import csv
+import json
+import os
+import random
+
+# Number of entities per ontology at each benchmark scale
+SCALES = {"small": 1_000, "medium": 10_000, "large": 100_000}
+
+SOURCE_ONTOLOGY = "DOID"
+TARGET_ONTOLOGY = "MESH"
+SOURCE_PREFIX = "http://purl.obolibrary.org/obo/DOID_"
+TARGET_PREFIX = "http://purl.bioontology.org/ontology/MESH/D"
+MAPPINGS_FILE = "mappings_doid_mesh.csv"
+
+_WORDS = ["acute", "chronic", "viral", "bacterial", "congenital", "hereditary", "primary", "secondary", "juvenile",
+          "familial", "heart", "lung", "kidney", "liver", "skin", "bone", "brain", "eye", "blood", "muscle",
+          "disease", "syndrome", "infection", "failure", "carcinoma", "deficiency", "disorder", "inflammation",
+          "lesion", "neoplasm", "type", "stage", "early", "late", "onset", "severe", "mild", "atypical"]
+
+
+def _label(rng, i):
+    return " ".join(rng.sample(_WORDS, rng.randint(2, 4))) + f" {i}"
+
+
+def _variant(rng, label):
+    """Target label of a mapped entity: mostly the same words, sometimes reordered or with one word replaced."""
+    words = label.split()
+    roll = rng.random()
+    if roll < 0.3:
+        rng.shuffle(words)
+    elif roll < 0.45:
+        words[rng.randrange(len(words))] = rng.choice(_WORDS)
+    return " ".join(words).capitalize()
+
+
+def _write_ontology(file_name, rows):
+    # the BioPortal csv layout, with the multi-line definitions real exports have
+    with open(file_name, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Class ID", "Preferred Label", "Synonyms", "Definitions", "Obsolete", "Parents"])
+        for class_id, label in rows:
+            writer.writerow([class_id, label, f"{label} (synonym)", f"Definition of {label}.\nSecond line.",
+                             "false", ""])
+
+
+def generate_dataset(data_dir, num_entities, seed=0):
+    """
+    Writes a synthetic source and target ontology csv with num_entities entities each, a mapping between them
+    and a similarity_config.json under data_dir, in the layout the app reads.
+
+    :return: The pair name and mappings file name to evaluate
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(data_dir, "datasets", "csv"), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, "mappings"), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, "candidates"), exist_ok=True)
+
+    source_rows = [(f"{SOURCE_PREFIX}{i}", _label(rng, i)) for i in range(num_entities)]
+    target_ids = [f"{TARGET_PREFIX}{i:06d}" for i in range(num_entities)]
+    rng.shuffle(target_ids)
+    target_rows = [(target_id, _variant(rng, label)) for target_id, (_, label) in zip(target_ids, source_rows)]
+
+    _write_ontology(os.path.join(data_dir, "datasets", "csv", SOURCE_ONTOLOGY + ".csv"), source_rows)
+    _write_ontology(os.path.join(data_dir, "datasets", "csv", TARGET_ONTOLOGY + ".csv"), target_rows)
+
+    # 80% of the entities are mapped
+    with open(os.path.join(data_dir, "mappings", MAPPINGS_FILE), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow([SOURCE_ONTOLOGY, TARGET_ONTOLOGY])
+        for (source_id, _), (target_id, _) in zip(source_rows, target_rows):
+            if rng.random() < 0.8:
+                writer.writerow([source_id, target_id])
+
+    selected_pair = f"{SOURCE_ONTOLOGY}-{TARGET_ONTOLOGY}"
+    with open(os.path.join(data_dir, "similarity_config.json"), "w") as f:
+        json.dump({selected_pair: [MAPPINGS_FILE]}, f, indent=2)
+    return selected_pair, MAPPINGS_FILE
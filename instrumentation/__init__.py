@@ -0,0 +1,3 @@
+from .metrics import registry
+from .metrics import MetricsRegistry
+from .metrics import export_metrics
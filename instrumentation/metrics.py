@@ -0,0 +1,179 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, its sum and count."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+
+    def quantile(self, q):
+        """Estimates the q-quantile by linear interpolation within its bucket (like Prometheus histogram_quantile)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and cumulative + count >= rank:
+                if math.isinf(bound):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound if not math.isinf(bound) else lower
+        return lower
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and latency histograms, identified by a metric name and labels.
+
+    Counters count events or amounts (requests, tokens, cache hits), histograms record durations in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Records the duration of the with block in the histogram name, also when it raises."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator recording the duration of every call in the histogram name."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """
+        Returns a copy of all metrics: {"counters": [{"name", "labels", "value"}],
+        "histograms": [{"name", "labels", "count", "sum", "p50", "p99", "buckets"}]}
+        """
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": histogram.count, "sum": histogram.sum,
+                           "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99),
+                           "buckets": [[bound, count] for bound, count in zip(histogram.buckets, histogram.counts)]}
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+        return {"started_at": self.started_at, "counters": counters, "histograms": histograms}
+
+
+# Registry shared by the whole process
+registry = MetricsRegistry()
+
+
+def _prometheus_labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ""
+    escaped = []
+    for key, value in items:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class JsonExporter:
+    """Writes the snapshot of a registry as JSON."""
+
+    def render(self, snapshot):
+        # JSON has no infinity, the unbounded bucket is written like in the Prometheus format
+        histograms = [{**histogram, "buckets": [["+Inf" if math.isinf(bound) else bound, count]
+                                                for bound, count in histogram["buckets"]]}
+                      for histogram in snapshot["histograms"]]
+        return json.dumps({**snapshot, "histograms": histograms}, indent=2)
+
+    def export(self, path, metrics_registry=registry):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.render(metrics_registry.snapshot()))
+
+
+class PrometheusExporter(JsonExporter):
+    """Writes the snapshot of a registry in the Prometheus text exposition format."""
+
+    def render(self, snapshot):
+        lines = []
+        typed = set()
+        for counter in snapshot["counters"]:
+            if counter["name"] not in typed:
+                lines.append(f"# TYPE {counter['name']} counter")
+                typed.add(counter["name"])
+            lines.append(f"{counter['name']}{_prometheus_labels(counter['labels'])} {counter['value']}")
+        for histogram in snapshot["histograms"]:
+            name, labels = histogram["name"], histogram["labels"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in histogram["buckets"]:
+                cumulative += count
+                le = "+Inf" if math.isinf(bound) else repr(bound)
+                lines.append(f"{name}_bucket{_prometheus_labels(labels, {'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+exporters = {"json": JsonExporter, "prometheus": PrometheusExporter}
+
+
+def export_metrics(path, format="json", metrics_registry=registry):
+    """Exports the metrics to path, format is one of the keys of exporters."""
+    exporters[format]().export(path, metrics_registry)
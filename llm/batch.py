@@ -0,0 +1,94 @@
+import json
+import os
+import time
+
+from instrumentation import registry as metrics
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def write_batch_requests(prompts: list, model: str, temperature: float, requests_file: str) -> list:
+    """
+    Writes one chat completion request per prompt to a JSONL batch request file.
+
+    :return: The custom ids of the requests, in prompt order
+    """
+    os.makedirs(os.path.dirname(requests_file) or ".", exist_ok=True)
+    custom_ids = [f"request-{i}" for i in range(len(prompts))]
+    with open(requests_file, "w", encoding="utf-8") as f:
+        for custom_id, prompt in zip(custom_ids, prompts):
+            request = {"custom_id": custom_id,
+                       "method": "POST",
+                       "url": BATCH_ENDPOINT,
+                       "body": {"model": model,
+                                "messages": [{"role": "user", "content": prompt}],
+                                "temperature": temperature}}
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+    return custom_ids
+
+
+def submit_batch(client, requests_file: str, completion_window: str = "24h"):
+    """Uploads the request file and creates a batch for it."""
+    with open(requests_file, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                  completion_window=completion_window)
+    print(f"Submitted batch {batch.id} with requests from {requests_file}")
+    return batch
+
+
+def wait_for_batch(client, batch_id: str, poll_interval: float = 30, timeout: float = None):
+    """Polls the batch until it reaches a final status and returns it."""
+    start_time = time.time()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in FINAL_BATCH_STATUSES:
+            print(f"Batch {batch_id} finished with status {batch.status}")
+            return batch
+        if timeout is not None and time.time() - start_time > timeout:
+            raise TimeoutError(f"Batch {batch_id} did not finish within {timeout} seconds (status {batch.status})")
+        time.sleep(poll_interval)
+
+
+def read_batch_answers(client, batch) -> dict:
+    """
+    Downloads the output of a finished batch.
+
+    :return: Dictionary of custom id to answer, requests that failed are missing
+    """
+    answers = {}
+    if not batch.output_file_id:
+        return answers
+
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            print(f"Batch request {result.get('custom_id')} failed: {result.get('error') or response}")
+            metrics.inc("llm_batch_requests_total", status="failed")
+            continue
+        body = response["body"]
+        answers[result["custom_id"]] = body["choices"][0]["message"]["content"].strip()
+        metrics.inc("llm_batch_requests_total", status="ok")
+        usage = body.get("usage") or {}
+        metrics.inc("llm_prompt_tokens_total", usage.get("prompt_tokens", 0), model=body.get("model"), mode="batch")
+        metrics.inc("llm_completion_tokens_total", usage.get("completion_tokens", 0), model=body.get("model"),
+                    mode="batch")
+    return answers
+
+
+def run_batch(client, prompts: list, model: str, temperature: float, requests_file: str,
+              poll_interval: float = 30, timeout: float = None) -> list:
+    """
+    Writes, submits and waits for a batch of prompts.
+
+    :return: The answers in prompt order, None for failed requests
+    """
+    custom_ids = write_batch_requests(prompts, model, temperature, requests_file)
+    batch = submit_batch(client, requests_file)
+    batch = wait_for_batch(client, batch.id, poll_interval=poll_interval, timeout=timeout)
+    answers = read_batch_answers(client, batch)
+    return [answers.get(custom_id) for custom_id in custom_ids]
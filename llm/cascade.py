@@ -0,0 +1,121 @@
+import re
+
+# USD per 1M prompt and completion tokens of the OpenAI models offered in the app, used to compare the cost of
+# a cascade with the single-model baseline (list prices, update when they change)
+MODEL_PRICES = {"gpt-4o-mini": (0.15, 0.60),
+                "gpt-4o": (2.50, 10.00),
+                "gpt-3.5-turbo": (0.50, 1.50)}
+
+# Answers are a single candidate ID (optionally with its IRI prefix), anything else is malformed
+_ANSWER_PATTERN = re.compile(r"[\w.:/#-]+")
+
+
+def model_price(model: str):
+    """Returns the (prompt, completion) USD price per 1M tokens of a model or its dated snapshot, or None."""
+    matches = [name for name in MODEL_PRICES if model == name or model.startswith(name + "-")]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int):
+    """USD cost of one request, None for models without a known price."""
+    price = model_price(model)
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+
+
+def score_margin(info: dict) -> float:
+    """Similarity score difference between the two best candidates of an entity (None with fewer candidates)."""
+    scores = sorted((c["score"] for c in info["candidates"]), reverse=True)
+    return scores[0] - scores[1] if len(scores) > 1 else None
+
+
+def escalation_reason(answer: str, probability: float, info: dict, target_id_name: str,
+                      min_probability: float = None, min_score_margin: float = None) -> str:
+    """
+    Decides whether the answer of the cheap model is escalated to the stronger model.
+
+    :param probability: Probability of the answer from its token logprobs, None when the model returned none
+    :param min_probability: Answers less probable than this are escalated
+    :param min_score_margin: Entities whose two best candidates are closer in similarity score are escalated
+    :return: None to keep the answer, otherwise why it is escalated: "failed" (no answer), "malformed"
+             (not a single ID), "not_candidate", "low_probability" or "low_margin"
+    """
+    if answer is None:
+        return "failed"
+    if not _ANSWER_PATTERN.fullmatch(answer):
+        return "malformed"
+    if answer.rsplit('/', 1)[-1] not in {c[target_id_name].rsplit('/', 1)[-1] for c in info["candidates"]}:
+        return "not_candidate"
+    if min_probability is not None and probability is not None and probability < min_probability:
+        return "low_probability"
+    if min_score_margin is not None:
+        margin = score_margin(info)
+        if margin is not None and margin < min_score_margin:
+            return "low_margin"
+    return None
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def cascade_report(model: str, escalation_model: str, reasons: list, prompt_tokens: list, completion_tokens: list,
+                   latencies: list, escalation_completion_tokens: list, escalation_latencies: list) -> dict:
+    """
+    Summarizes a cascade run against the baseline of sending every entity to escalation_model.
+
+    Costs are computed from the token counts of every prompt and answer whether it came from the response cache
+    or not, latencies from the requests actually sent (None when every answer of a model was cached).
+    The baseline latency per entity is the mean latency of escalation_model, the cascade latency per entity
+    the mean latency of model plus the escalated share of the escalation_model latency.
+
+    :param reasons: Escalation reason per entity (None when the answer of model was kept)
+    :param prompt_tokens: Prompt tokens per entity, the same prompt is sent to both models
+    :param completion_tokens: Completion tokens of the model answer per entity
+    :param latencies: Seconds of the model request per entity, None for cached answers
+    :param escalation_completion_tokens: Completion tokens of the escalation_model answer per escalated entity
+    :param escalation_latencies: Seconds of the escalation_model request per escalated entity, None for cached
+    """
+    entities = len(reasons)
+    escalated = [i for i, reason in enumerate(reasons) if reason is not None]
+    escalated_share = len(escalated) / entities if entities else 0.0
+
+    reason_counts = {}
+    for reason in reasons:
+        if reason is not None:
+            reason_counts[reason] = reason_counts.get(reason, 0) + 1
+
+    cascade_cost = baseline_cost = None
+    if model_price(model) and model_price(escalation_model):
+        cascade_cost = sum(request_cost(model, tokens, answer_tokens)
+                           for tokens, answer_tokens in zip(prompt_tokens, completion_tokens))
+        cascade_cost += sum(request_cost(escalation_model, prompt_tokens[i], answer_tokens)
+                            for i, answer_tokens in zip(escalated, escalation_completion_tokens))
+        # baseline answers are assumed as long as the escalation_model answers in the cascade
+        baseline_completion = _mean(escalation_completion_tokens) or _mean(completion_tokens) or 0
+        baseline_cost = sum(request_cost(escalation_model, tokens, baseline_completion) for tokens in prompt_tokens)
+
+    first_latency = _mean(latencies)
+    escalation_latency = _mean(escalation_latencies)
+    cascade_latency = baseline_latency = None
+    if first_latency is not None and escalation_latency is not None:
+        cascade_latency = first_latency + escalated_share * escalation_latency
+        baseline_latency = escalation_latency
+
+    return {"model": model,
+            "escalation_model": escalation_model,
+            "entities": entities,
+            "escalated": len(escalated),
+            "escalated_share": round(escalated_share, 4),
+            "escalation_reasons": reason_counts,
+            "cascade_cost_usd": cascade_cost,
+            "baseline_cost_usd": baseline_cost,
+            "cost_saved_usd": baseline_cost - cascade_cost if baseline_cost else None,
+            "cost_saved_share": round(1 - cascade_cost / baseline_cost, 4) if baseline_cost else None,
+            "latency_s": first_latency,
+            "escalation_latency_s": escalation_latency,
+            "cascade_latency_per_entity_s": cascade_latency,
+            "baseline_latency_per_entity_s": baseline_latency,
+            "latency_saved_per_entity_s": baseline_latency - cascade_latency if cascade_latency is not None else None}
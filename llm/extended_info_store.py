@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+from similarity.label_table import load_labels
+from similarity.sparql_client import get_sparql_client
+
+from . import llm_utils
+
+EXTENDED_INFO_STORE_DIR = "../data/extended_info/"
+
+
+def store_file_for(ontology: str) -> str:
+    return os.path.join(EXTENDED_INFO_STORE_DIR, ontology.lower() + ".sqlite")
+
+
+class ExtendedInfoStore:
+    """
+    Local SQLite store of the altLabels and parentClassLabels of every entity of one ontology.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS extended_info (
+                entity_id TEXT PRIMARY KEY,
+                alt_labels TEXT NOT NULL,
+                parent_class_labels TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get_many(self, entity_ids: list) -> dict:
+        """Returns the extended info of the stored entities among entity_ids, keyed by entity id."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(entity_ids), 500):
+                chunk = entity_ids[start:start + 500]
+                rows = self._conn.execute(
+                    "SELECT entity_id, alt_labels, parent_class_labels FROM extended_info "
+                    f"WHERE entity_id IN ({', '.join('?' * len(chunk))})", chunk)
+                for entity_id, alt_labels, parent_class_labels in rows:
+                    found[entity_id] = {"altLabels": json.loads(alt_labels),
+                                        "parentClassLabels": json.loads(parent_class_labels)}
+        return found
+
+    def put_many(self, extended_info: dict):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO extended_info VALUES (?, ?, ?)",
+                [(entity_id, json.dumps(info["altLabels"], ensure_ascii=False),
+                  json.dumps(info["parentClassLabels"], ensure_ascii=False))
+                 for entity_id, info in extended_info.items()])
+            self._conn.commit()
+
+    def clear(self):
+        """Removes all entities and the fingerprint."""
+        with self._lock:
+            self._conn.execute("DELETE FROM meta")
+            self._conn.execute("DELETE FROM extended_info")
+            self._conn.commit()
+
+    def get_fingerprint(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        return row[0] if row else None
+
+    def set_fingerprint(self, fingerprint: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_open_stores = {}
+
+
+def open_store(ontology: str):
+    """Returns the store of an ontology, opened once per process, or None when it has not been built."""
+    path = store_file_for(ontology)
+    if path not in _open_stores:
+        if not os.path.exists(path):
+            return None
+        store = ExtendedInfoStore(path)
+        # a store without fingerprint is a build that did not finish
+        if not store.get_fingerprint():
+            store.close()
+            return None
+        _open_stores[path] = store
+    return _open_stores[path]
+
+
+def data_fingerprint(ontology: str, endpoint: str = None) -> str:
+    """
+    Fingerprint of the data the store is built from: the number of statements in the GraphDB repository
+    and the modification time of the ontology csv the entity ids are read from.
+
+    This is only a heuristic, an update of the repository replacing labels or parents without changing its number
+    of statements is not detected. Such stores have to be rebuilt with force (--rebuild).
+    """
+    repository_size = get_sparql_client(endpoint or llm_utils.SPARQL_ENDPOINT).size()
+    csv_mtime = os.path.getmtime("../data/datasets/csv/" + ontology.upper() + ".csv")
+    return f"{repository_size}:{csv_mtime}"
+
+
+def build_extended_info_store(ontology: str, force: bool = False, batch_size: int = 1000):
+    """
+    Runs the extended info query in bulk for every entity of the ontology csv and stores the results.
+    The store is only rebuilt when force is set or the data fingerprint changed since the last build.
+    """
+    fingerprint = data_fingerprint(ontology)
+    path = store_file_for(ontology)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    store = ExtendedInfoStore(path)
+    if not force and store.get_fingerprint() == fingerprint:
+        print(f"Extended info store for {ontology} is up to date")
+        store.close()
+        return
+
+    # drop the fingerprint first, so an interrupted build is not picked up by open_store
+    store.clear()
+
+    entity_ids = list(load_labels("../data/datasets/csv/" + ontology.upper() + ".csv"))
+    for start in range(0, len(entity_ids), batch_size):
+        chunk = entity_ids[start:start + batch_size]
+        store.put_many(llm_utils.get_extended_info_bulk(ontology, chunk, batch_size=batch_size, use_store=False))
+        print(f"Stored extended info for {min(start + batch_size, len(entity_ids))} of {len(entity_ids)} {ontology} ids")
+
+    store.set_fingerprint(fingerprint)
+    store.close()
+    # stores opened before the rebuild keep working, the next open_store call gets the rebuilt data
+    _open_stores.pop(path, None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the local extended info stores of ontologies")
+    parser.add_argument("ontologies", nargs="+", help="Ontologies, e.g. DOID ICD10CM MESH")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild even when the repository size and the csv did not change")
+    return parser.parse_args(argv)
+
+
+# Example usage (from the app folder): PYTHONPATH=.. python -m llm.extended_info_store DOID ICD10CM MESH
+if __name__ == "__main__":
+    args = parse_args()
+    for ontology_name in args.ontologies:
+        build_extended_info_store(ontology_name, force=args.rebuild)
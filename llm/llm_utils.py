@@ -1,148 +1,480 @@
 import openai
 import os
 import json
+import math
+import re
+import time
 import pandas as pd
-from SPARQLWrapper import SPARQLWrapper, JSON
+from functools import lru_cache
 from dotenv import load_dotenv, find_dotenv
+
+from . import batch
+from . import extended_info_store
+from .scheduler import RateLimitedScheduler
+from .response_cache import get_response_cache
+from .tokens import count_tokens
+from .cascade import cascade_report, escalation_reason
+from similarity.candidates_store import open_candidates_store
+from similarity.exact_match import load_exact_match_index
+from similarity.sparql_client import DEFAULT_ENDPOINT, get_sparql_client
+from instrumentation import registry as metrics
 load_dotenv(find_dotenv(filename='.env'))
 
 # Create the OpenAI client (reads API key from environment variable)
 client = openai.OpenAI()
 
+SPARQL_ENDPOINT = DEFAULT_ENDPOINT
+
 # Prefixes for the available target ontologies, they are removed from the prompts, to save on cost per tokens
 target_prefixes = {"DOID": "http://purl.obolibrary.org/obo/",
                    "MESH": "http://purl.bioontology.org/ontology/MESH/"}
 
-def find_equivalent_entity(model: str, prompt: str) -> str:
+# Completion tokens reserved per request by the tokens-per-minute limiter, answers are a single id
+ANSWER_TOKENS = 16
+
+# Deterministic output, which also makes answers reusable from the response cache
+TEMPERATURE = 0
+
+
+def _chat_completion(model: str, prompt: str, **options):
+    """Sends the prompt to OpenAI without retries and returns the response, raising on errors."""
+    try:
+        with metrics.timer("llm_request_seconds", model=model):
+            response = client.with_options(max_retries=0).chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=TEMPERATURE,
+                **options
+            )
+    except Exception as e:
+        metrics.inc("llm_requests_total", model=model, status=type(e).__name__)
+        raise
+
+    metrics.inc("llm_requests_total", model=model, status="ok")
+    record_token_usage(model, response.usage)
+    return response
+
+
+def request_equivalent_entity(model: str, prompt: str) -> str:
+    """
+    Sends the prompt to OpenAI and returns the answer, raising on errors.
+    Retries are left to the caller (see RateLimitedScheduler).
+    """
+    return _chat_completion(model, prompt).choices[0].message.content.strip()
+
+
+def request_scored_answer(model: str, prompt: str, logprobs: bool = False) -> tuple:
+    """
+    Sends the prompt to OpenAI like request_equivalent_entity, optionally asking for the token logprobs.
+
+    :return: The answer, its probability (product of the probabilities of its tokens, None without logprobs)
+             and the seconds the request took
+    """
+    start_time = time.perf_counter()
+    response = _chat_completion(model, prompt, logprobs=True) if logprobs else _chat_completion(model, prompt)
+    seconds = time.perf_counter() - start_time
+
+    choice = response.choices[0]
+    token_logprobs = getattr(choice.logprobs, "content", None) if logprobs and choice.logprobs else None
+    probability = math.exp(sum(token.logprob for token in token_logprobs)) if token_logprobs else None
+    return choice.message.content.strip(), probability, seconds
+
+
+def record_token_usage(model: str, usage):
+    """Counts the prompt and completion tokens of a chat completion response."""
+    if usage is None:
+        return
+    metrics.inc("llm_prompt_tokens_total", usage.prompt_tokens or 0, model=model, mode="online")
+    metrics.inc("llm_completion_tokens_total", usage.completion_tokens or 0, model=model, mode="online")
+
+
+def find_equivalent_entity(model: str, prompt: str, use_cache: bool = True) -> str:
     """
     Given an entity ID from the source ontology, asks OpenAI to find the equivalent in the target ontology.
 
     :param prompt: The prompt send to OpenAI
+    :param use_cache: Answer from (and store into) the persistent response cache, False bypasses it
 
     """
+    cache = get_response_cache() if use_cache else None
+    if cache is not None:
+        answer = cache.get(model, prompt, TEMPERATURE)
+        if answer is not None:
+            return answer
 
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0  # deterministic output
-        )
-
-        answer = response.choices[0].message.content.strip()
-        return answer
+        answer = request_equivalent_entity(model, prompt)
 
     except Exception as e:
         print(f"Error querying OpenAI: {e}")
         return None
 
-def create_prompt_with_candidates(source_ontology: str, target_ontology: str, source_id: str, info: dict ) -> str:
-    target_id_name = target_ontology.lower() + "_id"
+    if cache is not None:
+        cache.put(model, prompt, TEMPERATURE, answer)
+    return answer
 
-    prompt = f"""You are comparing the ontologies {source_ontology} and {target_ontology}.
+
+def answer_prompts(model: str, prompts: list, scheduler: RateLimitedScheduler, use_cache: bool = True,
+                   token_counts: list = None):
+    """
+    Yields the answers to prompts in input order. Cached answers are returned directly,
+    only the other prompts are sent through the scheduler and their answers are cached.
+    token_counts, the prompt token counts, are estimated when not given.
+    """
+    cache = get_response_cache() if use_cache else None
+    cached_answers = [cache.get(model, prompt, TEMPERATURE) for prompt in prompts] if cache else [None] * len(prompts)
+    token_counts = token_counts or [estimate_tokens(prompt) - ANSWER_TOKENS for prompt in prompts]
+
+    missing = [i for i, answer in enumerate(cached_answers) if answer is None]
+    fresh_answers = scheduler.map([prompts[i] for i in missing], [token_counts[i] + ANSWER_TOKENS for i in missing])
+
+    for prompt, answer in zip(prompts, cached_answers):
+        if answer is None:
+            answer = next(fresh_answers)
+            if answer is not None and cache is not None:
+                cache.put(model, prompt, TEMPERATURE, answer)
+        yield answer
+
+
+def estimate_tokens(prompt: str) -> int:
+    """Rough token estimate of a request (about 4 characters per token plus the answer)."""
+    return len(prompt) // 4 + ANSWER_TOKENS
+
+PROMPT_QUESTION = ("\nWhich one is the best match?"
+                   "\nIMPORTANT: Return only the ID, and nothing else. Do not explain.")
+
+
+def _prompt_header(source_ontology: str, target_ontology: str, source_id: str, label: str,
+                   optional_sections: str = None) -> str:
+    """Prompt text up to the candidates, optional_sections (possibly empty) selects the extended layout."""
+    if optional_sections is None:
+        return f"""You are comparing the ontologies {source_ontology} and {target_ontology}.
+
+    Given the source entity:
+    - ID: {source_id}
+    - Label: {label}
+
+    Here are candidate equivalent entities in {target_ontology}:
+    """
+
+    return f"""You are comparing the ontologies {source_ontology} and {target_ontology}.
 
     Given the source entity:
     - ID: {source_id}
-    - Label: {info["label"]}
+    - Label: {label}
+    {optional_sections}
 
     Here are candidate equivalent entities in {target_ontology}:
     """
+
+
+def _source_sections(source_extended_info: dict) -> list:
+    """The non-empty alternative and parent labels sections of the source entity, in prompt order."""
+    alt_labels_section = (
+        f"- Alternative Labels: {'; '.join(source_extended_info['altLabels'])}"
+        if source_extended_info["altLabels"] else ""
+    )
+
+    parent_labels_section = (
+        f"- Parent Classes Labels: {'; '.join(source_extended_info['parentClassLabels'])}"
+        if source_extended_info["parentClassLabels"] else ""
+    )
+    return list(filter(None, [alt_labels_section, parent_labels_section]))
+
+
+def _candidate_line(c: dict, target_id_name: str, candidate_extended_info: dict = None) -> str:
+    short_id = c[target_id_name].rsplit('/', 1)[-1]
+    line = f"- ID: {short_id}, Label: {c['label']}, String-similarity-score: {c['score']}"
+    if candidate_extended_info:
+        if candidate_extended_info["altLabels"]:
+            line += f", Alternative Labels: {'; '.join(candidate_extended_info['altLabels'])}"
+        if candidate_extended_info["parentClassLabels"]:
+            line += f", Parent Classes Labels: {'; '.join(candidate_extended_info['parentClassLabels'])}"
+    return line + "\n"
+
+
+def create_prompt_with_candidates(source_ontology: str, target_ontology: str, source_id: str, info: dict ) -> str:
+    target_id_name = target_ontology.lower() + "_id"
+
+    prompt = _prompt_header(source_ontology, target_ontology, source_id, info["label"])
     for c in info["candidates"]:
-        short_id = c[target_id_name].rsplit('/', 1)[-1]
-        prompt += f"- ID: {short_id}, Label: {c['label']}, String-similarity-score: {c['score']}\n"
+        prompt += _candidate_line(c, target_id_name)
 
-    prompt += "\nWhich one is the best match?"
-    prompt += "\nIMPORTANT: Return only the ID, and nothing else. Do not explain."
+    prompt += PROMPT_QUESTION
     return prompt
 
-def get_extended_info(ontology: str, entity_id: str) -> dict:
-    """
-    Retrieve alternative and parent class labels from GraphDB using SPARQL queries loaded from file.
-    """
-    endpoint = "http://localhost:7200/repositories/WeVerify"
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setReturnFormat(JSON)
+# Map ontology to extended info query file
+extended_info_query_files = {
+    "icd10cm": "../queries/extended_info_icd10cm_mesh.rq",
+    "doid": "../queries/extended_info_doid.rq",
+    "mesh": "../queries/extended_info_icd10cm_mesh.rq"
+}
 
-    # Map ontology to query file
-    query_file_map = {
-        "icd10cm": "../queries/extended_info_icd10cm_mesh.rq",
-        "doid": "../queries/extended_info_doid.rq",
-        "mesh": "../queries/extended_info_icd10cm_mesh.rq"
-    }
+EMPTY_EXTENDED_INFO = {"altLabels": [], "parentClassLabels": []}
 
+
+@lru_cache(maxsize=None)
+def load_extended_info_query(ontology: str) -> tuple:
+    """
+    Loads the extended info query of an ontology once per process.
+    The template is returned split around the {{ENTITY_URIS}} placeholder, so filling it is a join.
+    """
     ontology_key = ontology.lower()
-    if ontology_key not in query_file_map:
+    if ontology_key not in extended_info_query_files:
         raise ValueError(f"Unsupported ontology: {ontology}")
 
-    # Load and inject entity ID into query
-    query_file = query_file_map[ontology_key]
-    with open(query_file, "r", encoding="utf-8") as f:
+    with open(extended_info_query_files[ontology_key], "r", encoding="utf-8") as f:
         query_template = f.read()
-    query = query_template.replace("{{ENTITY_URI}}", entity_id)
+    return tuple(query_template.split("{{ENTITY_URIS}}"))
 
-    # Execute the SPARQL query
-    sparql.setQuery(query)
-    results = sparql.query().convert()
 
-    # Parse result
-    bindings = results["results"]["bindings"]
-    if not bindings:
-        return {"altLabels": [], "parentClassLabels": []}
+def _split_labels(value: str) -> list:
+    return [label.strip() for label in value.split(";") if label.strip()]
+
+
+def get_extended_info_bulk(ontology: str, entity_ids: list, batch_size: int = 200, use_store: bool = True) -> dict:
+    """
+    Retrieve alternative and parent class labels for many entities, one SPARQL query (VALUES over the
+    subjects) per batch_size entities.
+    Entities found in the local extended info store of the ontology (see extended_info_store.py) are read
+    from there, only the others are queried.
+
+    :return: Dictionary of entity id to {"altLabels": [...], "parentClassLabels": [...]}
+    """
+    endpoint = SPARQL_ENDPOINT
+
+    unique_ids = list(dict.fromkeys(entity_ids))
+    extended_info = {entity_id: EMPTY_EXTENDED_INFO for entity_id in unique_ids}
 
-    result = bindings[0]
-    alt_labels = result.get("altLabels", {}).get("value", "")
-    parent_labels = result.get("parentClassLabels", {}).get("value", "")
+    store = extended_info_store.open_store(ontology) if use_store else None
+    if store is not None:
+        stored_info = store.get_many(unique_ids)
+        metrics.inc("extended_info_store_lookups_total", len(stored_info), ontology=ontology, result="hit")
+        metrics.inc("extended_info_store_lookups_total", len(unique_ids) - len(stored_info), ontology=ontology,
+                    result="miss")
+        extended_info.update(stored_info)
+        unique_ids = [entity_id for entity_id in unique_ids if entity_id not in stored_info]
 
-    return {
-        "altLabels": [label.strip() for label in alt_labels.split(";") if label.strip()],
-        "parentClassLabels": [label.strip() for label in parent_labels.split(";") if label.strip()]
-    }
+    query_parts = load_extended_info_query(ontology) if unique_ids else None
+    for start in range(0, len(unique_ids), batch_size):
+        chunk = unique_ids[start:start + batch_size]
+        query = " ".join(f"<{entity_id}>" for entity_id in chunk).join(query_parts)
 
+        # Execute the SPARQL query
+        with metrics.timer("sparql_extended_info_query_seconds", ontology=ontology):
+            results = get_sparql_client(endpoint).select(query)
 
-def create_extended_prompt(source_ontology: str, target_ontology: str, source_id: str, info: dict ) -> str:
+        # Parse result, grouped per subject by the query
+        for result in results:
+            extended_info[result["subject"]] = {
+                "altLabels": _split_labels(result.get("altLabels") or ""),
+                "parentClassLabels": _split_labels(result.get("parentClassLabels") or "")
+            }
+
+    return extended_info
+
+
+def get_extended_info(ontology: str, entity_id: str) -> dict:
+    """
+    Retrieve alternative and parent class labels from GraphDB using SPARQL queries loaded from file.
+    """
+    return get_extended_info_bulk(ontology, [entity_id])[entity_id]
+
+
+def prefetch_extended_info(source_ontology: str, target_ontology: str, data: dict) -> dict:
+    """
+    Fetches the extended info of all source entities and all their candidates in data,
+    with one bulk query per ontology, for use by create_extended_prompt.
+    """
     target_id_name = target_ontology.lower() + "_id"
-    source_extended_info = get_extended_info(source_ontology, source_id)
+    candidate_ids = [c[target_id_name] for info in data.values() for c in info["candidates"]]
+    return {**get_extended_info_bulk(source_ontology, list(data.keys())),
+            **get_extended_info_bulk(target_ontology, candidate_ids)}
 
-    # Build optional label sections
-    alt_labels_section = (
-        f"- Alternative Labels: {'; '.join(source_extended_info['altLabels'])}"
-        if source_extended_info["altLabels"] else ""
-    )
 
-    parent_labels_section = (
-        f"- Parent Classes Labels: {'; '.join(source_extended_info['parentClassLabels'])}"
-        if source_extended_info["parentClassLabels"] else ""
-    )
+def create_extended_prompt(source_ontology: str, target_ontology: str, source_id: str, info: dict,
+                           extended_info: dict = None) -> str:
+    """
+    :param extended_info: Prefetched extended info per entity id (see prefetch_extended_info),
+                          fetched for this entity and its candidates when not given
+    """
+    target_id_name = target_ontology.lower() + "_id"
+    if extended_info is None:
+        extended_info = prefetch_extended_info(source_ontology, target_ontology, {source_id: info})
+    source_extended_info = extended_info.get(source_id, EMPTY_EXTENDED_INFO)
 
     # Join only non-empty sections
-    optional_sections = "\n".join(filter(None, [alt_labels_section, parent_labels_section]))
+    optional_sections = "\n".join(_source_sections(source_extended_info))
 
     # Construct the final prompt
-    prompt = f"""You are comparing the ontologies {source_ontology} and {target_ontology}.
+    prompt = _prompt_header(source_ontology, target_ontology, source_id, info["label"], optional_sections)
 
-    Given the source entity:
-    - ID: {source_id}
-    - Label: {info["label"]}
-    {optional_sections}
+    for c in info["candidates"]:
+        candiadate_extended_info = extended_info.get(c[target_id_name], EMPTY_EXTENDED_INFO)
+        prompt += _candidate_line(c, target_id_name, candiadate_extended_info)
 
-    Here are candidate equivalent entities in {target_ontology}:
+    prompt += PROMPT_QUESTION
+    return prompt
+
+
+def create_budgeted_prompt(source_ontology: str, target_ontology: str, source_id: str, info: dict, model: str,
+                           max_prompt_tokens: int = None, extended_info: dict = None) -> tuple:
     """
+    Builds the prompt of create_prompt_with_candidates, or of create_extended_prompt when extended_info is given,
+    within max_prompt_tokens tokens of the model's tokenizer.
 
+    When the full prompt is over budget, it is reduced in this order until it fits:
+    the extended labels of the candidates (lowest similarity score first), the extended labels of the source
+    entity (parent classes first), and finally the lowest scoring candidates (at least one is kept).
 
-    for c in info["candidates"]:
-        short_id = c[target_id_name].rsplit('/', 1)[-1]
-        candiadate_extended_info = get_extended_info(target_ontology, c[target_id_name])
-        prompt += f"- ID: {short_id}, Label: {c['label']}, String-similarity-score: {c['score']}"
-        if candiadate_extended_info["altLabels"]:
-            prompt+=f", Alternative Labels: {'; '.join(candiadate_extended_info['altLabels'])}"
-        if candiadate_extended_info["parentClassLabels"]:
-            prompt+=f", Parent Classes Labels: {'; '.join(candiadate_extended_info['parentClassLabels'])}"
-        prompt+="\n"
-
-    prompt += "\nWhich one is the best match?"
-    prompt += "\nIMPORTANT: Return only the ID, and nothing else. Do not explain."
+    :return: The prompt and its token count
+    """
+    target_id_name = target_ontology.lower() + "_id"
+    candidates = sorted(info["candidates"], key=lambda c: c["score"], reverse=True)
+
+    plain_lines = [_candidate_line(c, target_id_name) for c in candidates]
+    if extended_info is not None:
+        source_sections = _source_sections(extended_info.get(source_id, EMPTY_EXTENDED_INFO))
+        lines = [_candidate_line(c, target_id_name, extended_info.get(c[target_id_name], EMPTY_EXTENDED_INFO))
+                 for c in candidates]
+    else:
+        source_sections = None
+        lines = list(plain_lines)
+
+    def assemble():
+        optional_sections = "\n".join(source_sections) if source_sections is not None else None
+        header = _prompt_header(source_ontology, target_ontology, source_id, info["label"], optional_sections)
+        return header + "".join(lines) + PROMPT_QUESTION
+
+    prompt = assemble()
+    prompt_tokens = count_tokens(prompt, model)
+    if max_prompt_tokens is None or prompt_tokens <= max_prompt_tokens:
+        return prompt, prompt_tokens
+
+    excess = prompt_tokens - max_prompt_tokens
+    line_tokens = [count_tokens(line, model) for line in lines]
+
+    for i in reversed(range(len(lines))):
+        if excess <= 0:
+            break
+        if lines[i] != plain_lines[i]:
+            saved = line_tokens[i] - count_tokens(plain_lines[i], model)
+            lines[i] = plain_lines[i]
+            line_tokens[i] -= saved
+            excess -= saved
+
+    while excess > 0 and source_sections:
+        excess -= count_tokens(source_sections.pop(), model)
+
+    while excess > 0 and len(lines) > 1:
+        excess -= line_tokens.pop()
+        lines.pop()
+
+    # tokens at the part boundaries can differ slightly from the sum of the parts
+    prompt = assemble()
+    prompt_tokens = count_tokens(prompt, model)
+    while prompt_tokens > max_prompt_tokens and len(lines) > 1:
+        lines.pop()
+        prompt = assemble()
+        prompt_tokens = count_tokens(prompt, model)
+    return prompt, prompt_tokens
+
+
+def create_packed_prompt(source_ontology: str, target_ontology: str, entries: list, extended_info: dict = None) -> str:
+    """
+    Builds one prompt classifying several source entities at once, answered with a JSON object
+    mapping every source id to the ID of its best candidate.
+
+    :param entries: List of (source id, info) pairs
+    :param extended_info: Prefetched extended info per entity id, adds the extended labels like create_extended_prompt
+    """
+    target_id_name = target_ontology.lower() + "_id"
+
+    prompt = (f"You are comparing the ontologies {source_ontology} and {target_ontology}.\n\n"
+              f"For each source entity below, choose the best match among its candidate equivalent entities "
+              f"in {target_ontology}.\n")
+
+    for source_id, info in entries:
+        prompt += f"\nSource entity {source_id}:\n- Label: {info['label']}\n"
+        if extended_info is not None:
+            for section in _source_sections(extended_info.get(source_id, EMPTY_EXTENDED_INFO)):
+                prompt += section + "\n"
+        prompt += "Candidates:\n"
+        for c in info["candidates"]:
+            candidate_extended_info = extended_info.get(c[target_id_name]) if extended_info is not None else None
+            prompt += _candidate_line(c, target_id_name, candidate_extended_info)
+
+    example = json.dumps({entries[0][0]: "<candidate ID>"})
+    prompt += (f"\nIMPORTANT: Return only a JSON object mapping every source entity to the ID of its best match, "
+               f"e.g. {example}, and nothing else. Do not explain.")
     return prompt
 
-def classify(data, model, source, target, extended_prompt):
+
+def parse_packed_answer(answer: str, entries: list, target_ontology: str) -> dict:
+    """
+    Parses the answer to a packed prompt (see create_packed_prompt).
+
+    :return: Dictionary of source id to chosen candidate ID, only for the entries whose answer
+             is one of their candidates
+    """
+    if answer is None:
+        return {}
+    # tolerate code fences or text around the object
+    match = re.search(r"\{.*\}", answer, re.DOTALL)
+    try:
+        parsed = json.loads(match.group(0)) if match else None
+    except json.JSONDecodeError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        print(f"Could not parse packed answer: {answer}")
+        return {}
+
+    target_id_name = target_ontology.lower() + "_id"
+    valid = {}
+    for source_id, info in entries:
+        chosen = parsed.get(source_id)
+        if not isinstance(chosen, str):
+            continue
+        chosen = chosen.strip().rsplit('/', 1)[-1]
+        if chosen in {c[target_id_name].rsplit('/', 1)[-1] for c in info["candidates"]}:
+            valid[source_id] = chosen
+    return valid
+
+
+def create_scheduler(model: str, max_in_flight: int = 8, requests_per_minute: int = 500,
+                     tokens_per_minute: int = 200_000) -> RateLimitedScheduler:
+    """Creates a scheduler sending classification prompts to the model."""
+    return RateLimitedScheduler(lambda prompt: request_equivalent_entity(model, prompt),
+                                max_in_flight=max_in_flight,
+                                requests_per_minute=requests_per_minute,
+                                tokens_per_minute=tokens_per_minute)
+
+
+def create_prompts(data, source, target, extended_prompt, model, max_prompt_tokens=None):
+    """
+    Creates the classification prompt of every source entity in data, in data order,
+    each within max_prompt_tokens when given (see create_budgeted_prompt).
+
+    :return: The prompts and their token counts
+    """
+    # one bulk query per ontology for the whole page instead of one query per entity and candidate
+    extended_info = prefetch_extended_info(source, target, data) if extended_prompt else None
+
+    with metrics.timer("prompt_construction_seconds", mode="single"):
+        prompts_with_tokens = [
+            create_budgeted_prompt(source, target, source_id, info, model, max_prompt_tokens, extended_info)
+            for source_id, info in data.items()
+        ]
+    return [prompt for prompt, _ in prompts_with_tokens], [tokens for _, tokens in prompts_with_tokens]
+
+
+def evaluate_answers(data, answers, target, prompt_tokens=None):
+    """
+    Compares the LLM answers (in data order, None for failed requests) with the equivalent ids.
+    prompt_tokens, the token count of each prompt, is reported as a column when given.
+
+    :return: DataFrame with one row per source entity and the share of correct answers
+    """
     num_queries = len(data)
 
     target_prefix = target_prefixes[target]
@@ -150,18 +482,13 @@ def classify(data, model, source, target, extended_prompt):
     correct_cnt = 0
     results = []
 
-    for i, (source_id, info) in enumerate(data.items()):
+    for i, ((source_id, info), answer) in enumerate(zip(data.items(), answers)):
 
         label = info.get("label")
         equivalent_id = info.get("equivalent_id")
         equivalent_id_label = info.get("equivalent_id_label")
 
-        prompt = (
-            create_extended_prompt(source, target, source_id, info)
-            if extended_prompt
-            else create_prompt_with_candidates(source, target, source_id, info)
-        )
-        llm_answer = target_prefix +  find_equivalent_entity(model, prompt)
+        llm_answer = target_prefix + answer if answer is not None else None
 
         if llm_answer == equivalent_id:
             print(f"Correct answer for {source_id}: {label}!")
@@ -175,6 +502,8 @@ def classify(data, model, source, target, extended_prompt):
             "Correct Target Label": equivalent_id_label,
             "Correct Target ID": equivalent_id,
         })
+        if prompt_tokens is not None:
+            results[-1]["Prompt Tokens"] = prompt_tokens[i]
 
 
     df = pd.DataFrame(results)
@@ -182,62 +511,292 @@ def classify(data, model, source, target, extended_prompt):
     return df, score
 
 
-#Example usage
-if __name__ == "__main__":
-    # extended_info_icd = get_extended_info("icd10cm", "http://purl.bioontology.org/ontology/ICD10CM/J09.X")
-    # extended_info_doid = get_extended_info("doid", "http://purl.obolibrary.org/obo/DOID_8469")
-    # extended_info_mesh = get_extended_info("mesh", "http://purl.bioontology.org/ontology/MESH/D017889")
+def answer_packed(data, model, source, target, extended_prompt, pack_size, scheduler, use_cache=True,
+                  max_prompt_tokens=None):
+    """
+    Answers the source entities of data pack_size at a time with packed prompts (see create_packed_prompt).
+    Packs over max_prompt_tokens are split in halves until they fit, entities that do not fit alone are sent
+    individually with a pruned prompt (see create_budgeted_prompt).
+    Entities whose answer is missing or not one of their candidates are re-issued individually.
 
-    file_path = "../data/candidates/ICD10CM-DOID_extended_mappings_doid_icd10cm.json"
+    :return: The answers in data order (None for failed requests) and the prompt tokens per entity: its share
+             of the packed prompt plus its individual prompt when it was sent individually
+    """
+    entries = list(data.items())
+    packs = [entries[start:start + pack_size] for start in range(0, len(entries), pack_size)]
+
+    extended_info = prefetch_extended_info(source, target, data) if extended_prompt else None
+    sent_packs, prompts, prompt_tokens = [], [], []
+    with metrics.timer("prompt_construction_seconds", mode="packed"):
+        while packs:
+            pack = packs.pop(0)
+            prompt = create_packed_prompt(source, target, pack, extended_info)
+            tokens = count_tokens(prompt, model)
+            if max_prompt_tokens and tokens > max_prompt_tokens:
+                if len(pack) > 1:
+                    half = (len(pack) + 1) // 2
+                    packs[:0] = [pack[:half], pack[half:]]
+                continue
+            sent_packs.append(pack)
+            prompts.append(prompt)
+            prompt_tokens.append(tokens)
+
+    entity_tokens = {}
+    for pack, tokens in zip(sent_packs, prompt_tokens):
+        entity_tokens.update((source_id, round(tokens / len(pack))) for source_id, _ in pack)
+
+    answers = {}
+    # answer_prompts reserves the answer tokens of one entity per request
+    token_counts = [tokens + ANSWER_TOKENS * (len(pack) - 1) for pack, tokens in zip(sent_packs, prompt_tokens)]
+    for pack, answer in zip(sent_packs, answer_prompts(model, prompts, scheduler, use_cache=use_cache,
+                                                       token_counts=token_counts)):
+        answers.update(parse_packed_answer(answer, pack, target))
+
+    retry_data = {source_id: info for source_id, info in entries if source_id not in answers}
+    if retry_data:
+        print(f"Re-issuing {len(retry_data)} of {len(entries)} entities individually")
+        retry_prompts, retry_tokens = create_prompts(retry_data, source, target, extended_prompt, model,
+                                                     max_prompt_tokens)
+        retry_answers = answer_prompts(model, retry_prompts, scheduler, use_cache=use_cache, token_counts=retry_tokens)
+        answers.update(zip(retry_data, retry_answers))
+        for source_id, tokens in zip(retry_data, retry_tokens):
+            entity_tokens[source_id] = entity_tokens.get(source_id, 0) + tokens
+
+    return [answers.get(source_id) for source_id, _ in entries], [entity_tokens[source_id] for source_id, _ in entries]
+
+
+def resolve_exact_matches(data, target):
+    """
+    Answers the source entities whose label resolves to a single target id in the exact match index of the
+    target ontology (see similarity/exact_match.py), without asking the LLM.
 
-    with open(file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    :return: Dictionary of source id to answer (ID without prefix, like the LLM answers) of the resolved entities
+    """
+    index = load_exact_match_index("../data/datasets/csv/" + target + ".csv")
+    matched_ids = index.resolve([info["label"] for info in data.values()], stage="classify")
+    exact_answers = {source_id: target_id.rsplit('/', 1)[-1]
+                     for source_id, target_id in zip(data, matched_ids) if target_id is not None}
+    print(f"Exact match fast path answered {len(exact_answers)} of {len(data)} entities without the LLM")
+    return exact_answers
 
-    candidates_data = data.get("candidates", {})
 
-    max_queries = 100
-    total_queries = min(len(candidates_data), max_queries)
-    source_ontology = "ICD10CM"
-    target_ontology = "DOID"
+def merge_exact_answers(data, exact_answers, target, df, model):
+    """
+    Adds the rows of the entities answered by exact match to the results df of the other entities (as returned
+    by evaluate_answers), in data order, with the "Answered By" column telling them apart.
 
-    target_prefix = "http://purl.obolibrary.org/obo/"
+    :return: The merged DataFrame and the share of correct answers over all entities
+    """
+    if not data:
+        return df, 0.0
+    exact_df, _ = evaluate_answers({source_id: data[source_id] for source_id in exact_answers},
+                                   list(exact_answers.values()), target)
+    exact_df["Answered By"] = "exact match"
+    if len(df):
+        if "Answered By" not in df:
+            df["Answered By"] = model
+        if "Prompt Tokens" in df:
+            exact_df["Prompt Tokens"] = 0
+    merged_df = pd.concat([df, exact_df], ignore_index=True) \
+        .set_index("Source ID").loc[list(data)].reset_index()
+    score = float((merged_df["Predicted Target ID"] == merged_df["Correct Target ID"]).mean())
+    return merged_df, score
+
+
+def classify(data, model, source, target, extended_prompt, max_in_flight=8, scheduler=None, use_cache=True,
+             batch_requests_file=None, max_prompt_tokens=None, pack_size=1, exact_match=False):
+    """
+    Classifies every source entity in data with the LLM, sending up to max_in_flight prompts concurrently.
+    A scheduler created with create_scheduler can be passed to share its rate limits between calls.
+    With use_cache, answers are reused from the persistent response cache.
+    With batch_requests_file, the prompts are sent offline through the batch endpoint instead (see classify_batch).
+    With max_prompt_tokens, every prompt is pruned to that many tokens (see create_budgeted_prompt).
+    With pack_size > 1, pack_size entities share one prompt (see answer_packed), packs over max_prompt_tokens
+    are split.
+    With exact_match, entities resolved by the exact match index are answered without the LLM
+    (see resolve_exact_matches).
+    """
+    if exact_match:
+        exact_answers = resolve_exact_matches(data, target)
+        remaining_data = {source_id: info for source_id, info in data.items() if source_id not in exact_answers}
+        df, _ = classify(remaining_data, model, source, target, extended_prompt, max_in_flight=max_in_flight,
+                         scheduler=scheduler, use_cache=use_cache, batch_requests_file=batch_requests_file,
+                         max_prompt_tokens=max_prompt_tokens, pack_size=pack_size) if remaining_data \
+            else (pd.DataFrame(), 0.0)
+        return merge_exact_answers(data, exact_answers, target, df, model)
 
-    correct_cnt = 0
-    missing_candidate_cnt = 0
+    if batch_requests_file:
+        return classify_batch(data, model, source, target, extended_prompt, batch_requests_file, use_cache=use_cache,
+                              max_prompt_tokens=max_prompt_tokens)
 
-    # model = "gpt-4o-mini"
-    # model = "gpt-3.5-turbo"
-    model = "gpt-4o-2024-11-20"
+    scheduler = scheduler or create_scheduler(model, max_in_flight=max_in_flight)
 
-    for i, (source_id, info) in enumerate(candidates_data.items()):
-        if i >= max_queries:
-            break
+    if pack_size > 1:
+        answers, prompt_tokens = answer_packed(data, model, source, target, extended_prompt, pack_size, scheduler,
+                                               use_cache=use_cache, max_prompt_tokens=max_prompt_tokens)
+        return evaluate_answers(data, answers, target, prompt_tokens)
 
-        label = info.get("label")
-        equivalent_id = info.get("equivalent_id")
-        candidate_list = info.get("candidates", [])
-        candidate_ids = [c["doid_id"] for c in info.get("candidates", [])]
+    prompts, prompt_tokens = create_prompts(data, source, target, extended_prompt, model, max_prompt_tokens)
+
+    # answers arrive in input order
+    answers = answer_prompts(model, prompts, scheduler, use_cache=use_cache, token_counts=prompt_tokens)
+
+    return evaluate_answers(data, answers, target, prompt_tokens)
 
-        if (equivalent_id not in candidate_ids):
-            print(f"The correct equivalent entity ID for {source_id}: {label} is not among the candidates.")
-            missing_candidate_cnt += 1
+
+# The response cache holds the answers of requests with logprobs as JSON [answer, probability] under this model suffix
+PROBABILITY_CACHE_SUFFIX = "+logprobs"
+
+
+def answer_prompts_scored(model: str, prompts: list, token_counts: list, max_in_flight: int = 8,
+                          use_cache: bool = True, logprobs: bool = False):
+    """
+    Yields (answer, probability, seconds) per prompt in input order (see request_scored_answer).
+    Cached answers have no seconds, failed requests give (None, None, None).
+    """
+    cache = get_response_cache() if use_cache else None
+    cache_model = model + PROBABILITY_CACHE_SUFFIX if logprobs else model
+    cached_answers = [cache.get(cache_model, prompt, TEMPERATURE) for prompt in prompts] if cache \
+        else [None] * len(prompts)
+
+    scheduler = RateLimitedScheduler(lambda prompt: request_scored_answer(model, prompt, logprobs),
+                                     max_in_flight=max_in_flight)
+    missing = [i for i, answer in enumerate(cached_answers) if answer is None]
+    fresh_results = scheduler.map([prompts[i] for i in missing], [token_counts[i] + ANSWER_TOKENS for i in missing])
+
+    for prompt, cached_answer in zip(prompts, cached_answers):
+        if cached_answer is not None:
+            answer, probability = json.loads(cached_answer) if logprobs else (cached_answer, None)
+            yield answer, probability, None
+            continue
+        result = next(fresh_results)
+        if result is None:
+            yield None, None, None
             continue
+        if cache is not None:
+            answer, probability, _ = result
+            cache.put(cache_model, prompt, TEMPERATURE, json.dumps([answer, probability]) if logprobs else answer)
+        yield result
 
-        prompt = create_extended_prompt(source_ontology, target_ontology, source_id, info)
-        print(prompt)
-        llm_answer = target_prefix +  find_equivalent_entity(model, prompt)
 
-        if llm_answer == equivalent_id:
-            print(f"Correct answer for {source_id}: {label}!")
-            correct_cnt += 1
-        else:
-            print(f"For {source_id}: LLM answer is {llm_answer}, but equivalent ID is {equivalent_id}")
+def classify_cascade(data, model, escalation_model, source, target, extended_prompt, max_in_flight=8,
+                     use_cache=True, max_prompt_tokens=None, min_probability=0.9, min_score_margin=None,
+                     exact_match=False):
+    """
+    Classifies every source entity in data with a model cascade: the cheap model answers first (with logprobs),
+    entities whose answer fails, is malformed, is not one of their candidates, is less probable than
+    min_probability or whose two best candidates are closer than min_score_margin in similarity score
+    (see cascade.escalation_reason) are sent again to escalation_model, whose answer replaces the first one.
 
+    With exact_match, entities resolved by the exact match index skip both models (see resolve_exact_matches),
+    the report covers the other entities.
+
+    :return: DataFrame as classify (with the model of the final answer, the escalation reason and the probability
+             of the first answer per entity), the share of correct answers and the cascade report comparing cost and
+             latency with sending everything to escalation_model (see cascade.cascade_report)
+    """
+    if exact_match:
+        exact_answers = resolve_exact_matches(data, target)
+        remaining_data = {source_id: info for source_id, info in data.items() if source_id not in exact_answers}
+        df, _, report = classify_cascade(remaining_data, model, escalation_model, source, target, extended_prompt,
+                                         max_in_flight=max_in_flight, use_cache=use_cache,
+                                         max_prompt_tokens=max_prompt_tokens, min_probability=min_probability,
+                                         min_score_margin=min_score_margin) if remaining_data \
+            else (pd.DataFrame(), 0.0, cascade_report(model, escalation_model, [], [], [], [], [], []))
+        df, score = merge_exact_answers(data, exact_answers, target, df, model)
+        report["exact_matches"] = len(exact_answers)
+        report["accuracy"] = score
+        return df, score, report
+
+    target_id_name = target.lower() + "_id"
+    prompts, prompt_tokens = create_prompts(data, source, target, extended_prompt, model, max_prompt_tokens)
+
+    first_results = list(answer_prompts_scored(model, prompts, prompt_tokens, max_in_flight=max_in_flight,
+                                               use_cache=use_cache, logprobs=True))
+    reasons = [escalation_reason(answer, probability, info, target_id_name, min_probability, min_score_margin)
+               for (answer, probability, _), info in zip(first_results, data.values())]
+    for reason in reasons:
+        metrics.inc("llm_cascade_entities_total", model=model, escalation=reason or "none")
+
+    escalated = [i for i, reason in enumerate(reasons) if reason is not None]
+    print(f"Escalating {len(escalated)} of {len(data)} entities to {escalation_model}")
+    escalation_results = list(answer_prompts_scored(escalation_model, [prompts[i] for i in escalated],
+                                                    [prompt_tokens[i] for i in escalated],
+                                                    max_in_flight=max_in_flight, use_cache=use_cache))
+
+    answers = [answer for answer, _, _ in first_results]
+    answered_by = [model] * len(data)
+    for i, (answer, _, _) in zip(escalated, escalation_results):
+        # a failed escalation keeps the first answer
+        if answer is not None:
+            answers[i] = answer
+            answered_by[i] = escalation_model
+
+    df, score = evaluate_answers(data, answers, target, prompt_tokens)
+    if len(df):
+        df["Answered By"] = answered_by
+        df["Escalation Reason"] = reasons
+        df["First Answer Probability"] = [probability for _, probability, _ in first_results]
+
+    report = cascade_report(model, escalation_model, reasons, prompt_tokens,
+                            [count_tokens(answer or "", model) for answer, _, _ in first_results],
+                            [seconds for _, _, seconds in first_results],
+                            [count_tokens(answer or "", escalation_model) for answer, _, _ in escalation_results],
+                            [seconds for _, _, seconds in escalation_results])
+    report["accuracy"] = score
+    print(f"Cascade report: {report}")
+    return df, score, report
+
+
+def classify_batch(data, model, source, target, extended_prompt, requests_file, use_cache=True,
+                   poll_interval=30, timeout=None, batch_client=None, max_prompt_tokens=None):
+    """
+    Offline variant of classify using the provider's batch endpoint: all prompts (except cached ones) are
+    written to the JSONL requests_file, submitted as one batch and the results are joined back by custom id.
+    Blocks until the batch finished, polling every poll_interval seconds.
+
+    :param batch_client: OpenAI client used for the batch endpoints (default: the module client),
+                         e.g. one with base_url pointing to a local stand-in server
+    """
+    batch_client = batch_client or client
+    cache = get_response_cache() if use_cache else None
+
+    prompts, prompt_tokens = create_prompts(data, source, target, extended_prompt, model, max_prompt_tokens)
+    answers = [cache.get(model, prompt, TEMPERATURE) for prompt in prompts] if cache else [None] * len(prompts)
+
+    missing = [i for i, answer in enumerate(answers) if answer is None]
+    if missing:
+        batch_answers = batch.run_batch(batch_client, [prompts[i] for i in missing], model, TEMPERATURE,
+                                        requests_file, poll_interval=poll_interval, timeout=timeout)
+        for i, answer in zip(missing, batch_answers):
+            answers[i] = answer
+            if answer is not None and cache is not None:
+                cache.put(model, prompts[i], TEMPERATURE, answer)
+
+    return evaluate_answers(data, answers, target, prompt_tokens)
+
+
+#Example usage
+if __name__ == "__main__":
+    # extended_info_icd = get_extended_info("icd10cm", "http://purl.bioontology.org/ontology/ICD10CM/J09.X")
+    # extended_info_doid = get_extended_info("doid", "http://purl.obolibrary.org/obo/DOID_8469")
+    # extended_info_mesh = get_extended_info("mesh", "http://purl.bioontology.org/ontology/MESH/D017889")
+
+    candidates_store = open_candidates_store("../data/candidates/ICD10CM-DOID_extended_mappings_doid_icd10cm.jsonl")
+
+    max_queries = 100
+    source_ontology = "ICD10CM"
+    target_ontology = "DOID"
+
+    # model = "gpt-4o-mini"
+    # model = "gpt-3.5-turbo"
+    model = "gpt-4o-2024-11-20"
 
+    # only the entities whose equivalent ID is among their candidates can be answered correctly
+    data = candidates_store.page(0, max_queries)
+    print(f"{candidates_store.num_classifiable} of {len(candidates_store)} entities have the equivalent ID "
+          f"among their candidates")
 
-    print(f"Correct answers: {correct_cnt} out of {total_queries} - {round(100 * (correct_cnt / total_queries), 2)}%")
-    print(
-        f"Correct answers when answer is in the candidates: {correct_cnt} out of {total_queries - missing_candidate_cnt} - {round(100 * (correct_cnt / (total_queries - missing_candidate_cnt)), 2)}%")
-    wrong_cnt = total_queries - correct_cnt
-    print(
-        f"Out of {wrong_cnt} wrong answers {missing_candidate_cnt} are because of answer not in provided candidates - {round(100 * (missing_candidate_cnt / wrong_cnt), 2)}%")
+    df, score = classify(data, model, source_ontology, target_ontology, extended_prompt=True)
+    failed_cnt = int(df["Predicted Target ID"].isna().sum()) if len(df) else 0
+    print(f"Correct answers: {round(100 * score, 2)}% of {len(data)} entities ({failed_cnt} failed requests)")
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from instrumentation import registry as metrics
+
+DEFAULT_CACHE_FILE = "../data/cache/llm_responses.sqlite"
+
+
+def response_key(model: str, prompt: str, temperature: float) -> str:
+    """Content address of a request: the sha256 of its model, prompt text and temperature."""
+    return hashlib.sha256(json.dumps([model, prompt, temperature], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of LLM answers keyed by response_key.
+
+    Only deterministic (temperature=0) answers are worth caching. When the cache holds more than max_entries,
+    the least recently used entries are evicted. hits and misses count the lookups of this instance.
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_FILE, max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._puts_since_eviction = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, model: str, prompt: str, temperature: float):
+        """Returns the cached answer, or None on a miss."""
+        key = response_key(model, prompt, temperature)
+        with self._lock:
+            row = self._conn.execute("SELECT answer FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("llm_response_cache_lookups_total", result="miss")
+                return None
+            self.hits += 1
+            metrics.inc("llm_response_cache_lookups_total", result="hit")
+            self._conn.execute("UPDATE responses SET last_access=? WHERE key=?", (time.time(), key))
+            self._conn.commit()
+        return row[0]
+
+    def put(self, model: str, prompt: str, temperature: float, answer: str):
+        key = response_key(model, prompt, temperature)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                               (key, model, answer, time.time()))
+            self._conn.commit()
+            self._puts_since_eviction += 1
+            evict = self._puts_since_eviction >= 1000
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries above max_entries."""
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                self._conn.execute("""
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY last_access LIMIT ?
+                    )
+                """, (count - self.max_entries,))
+                self._conn.commit()
+            self._puts_since_eviction = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the response cache shared by the whole process, opened on first use."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache()
+        return _shared_cache
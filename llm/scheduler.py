@@ -0,0 +1,100 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from instrumentation import registry as metrics
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at rate_per_minute, holding at most capacity tokens.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        """Blocks until amount tokens are available and takes them."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Rate limits (429), server errors (5xx), timeouts and connection errors are retried."""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimitedScheduler:
+    """
+    Runs requests concurrently while respecting requests-per-minute and tokens-per-minute limits.
+
+    At most max_in_flight requests run at the same time. Every request first takes one request and its
+    estimated tokens from the token buckets. Retryable errors are retried with exponential backoff and jitter
+    (or the server's Retry-After), other errors and exhausted retries give None for that request.
+    Results are yielded in input order as soon as they (and all earlier ones) are available.
+    """
+
+    def __init__(self, request_fn, max_in_flight: int = 8, requests_per_minute: int = 500,
+                 tokens_per_minute: int = 200_000, max_retries: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        """
+        :param request_fn: Function executing one request, raising on errors
+        """
+        self.request_fn = request_fn
+        self.max_in_flight = max_in_flight
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _run(self, item, token_count):
+        for attempt in range(self.max_retries + 1):
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(token_count)
+            try:
+                return self.request_fn(item)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    print(f"Error querying OpenAI: {e}")
+                    return None
+                delay = _retry_after(e) or min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay *= 1 + random.random() * 0.1
+                print(f"Retrying after {delay:.1f}s ({type(e).__name__}, attempt {attempt + 1})")
+                metrics.inc("llm_retries_total", error=type(e).__name__)
+                time.sleep(delay)
+
+    def map(self, items, token_counts):
+        """
+        Executes request_fn for every item, token_counts holds the estimated tokens of each request.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            yield from executor.map(self._run, items, token_counts)
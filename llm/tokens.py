@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def encoding_for(model: str):
+    """
+    Returns the tiktoken encoding of a model, o200k_base for models tiktoken does not know,
+    or None when the encoding cannot be loaded (tiktoken downloads it on first use).
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"Could not load the tokenizer of {model}, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Counts the tokens of text with the local tokenizer of the model (about 4 characters per token without it)."""
+    encoding = encoding_for(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
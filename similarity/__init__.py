@@ -1,2 +1,3 @@
 from .similarity_utils import search_rdf_index
+from .similarity_utils import search_rdf_index_batch
 from .similarity_utils import compute_hits_at_n
\ No newline at end of file
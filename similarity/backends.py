@@ -0,0 +1,218 @@
+import json
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from . import similarity_utils
+from .label_table import load_labels
+from .sparql_client import DEFAULT_ENDPOINT
+from instrumentation import registry as metrics
+
+# Index names with this prefix are served in-process by LocalTfidfBackend instead of GraphDB,
+# e.g. similarity_indices = {"DOID": "local:doid_labels"} loads the index from ../data/indices/doid_labels/
+LOCAL_INDEX_PREFIX = "local:"
+LOCAL_INDEX_DIR = "../data/indices/"
+
+
+class SearchBackend:
+    """
+    Interface of a similarity search backend used by calculate_hits_at_n.
+
+    Backends implement search_rows and search_rows_batch, which return (id, label, score) tuples ordered by
+    descending score and are what calculate_hits_at_n consumes. search and search_batch wrap the rows in
+    DataFrames with the signatures of search_rdf_index and search_rdf_index_batch, for the UI.
+    """
+
+    # Batch size used by compute_hits_at_n when none is requested explicitly (None means one request per label)
+    default_batch_size = None
+
+    def search_rows(self, search_term, index_name, top_k=10):
+        raise NotImplementedError
+
+    def search_rows_batch(self, search_terms, index_name, top_k=10, batch_size=50):
+        raise NotImplementedError
+
+    def search(self, search_term, index_name, result_column_name, top_k=10):
+        return pd.DataFrame(self.search_rows(search_term, index_name, top_k=top_k),
+                            columns=[result_column_name, "label", "score"])
+
+    def search_batch(self, search_terms, index_name, result_column_name, top_k=10, batch_size=50):
+        rows_by_term = self.search_rows_batch(search_terms, index_name, top_k=top_k, batch_size=batch_size)
+        return {term: pd.DataFrame(rows, columns=[result_column_name, "label", "score"])
+                for term, rows in rows_by_term.items()}
+
+
+class GraphDBBackend(SearchBackend):
+    """
+    Backend using the GraphDB similarity plugin over SPARQL.
+    With id_to_label, the queries only return ids and scores and the labels come from that label table.
+    """
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, cache=None, id_to_label=None):
+        self.endpoint = endpoint
+        self.cache = cache
+        self.id_to_label = id_to_label
+
+    def search_rows(self, search_term, index_name, top_k=10):
+        return similarity_utils.search_rdf_index_rows(search_term, index_name, top_k=top_k,
+                                                      endpoint=self.endpoint, cache=self.cache,
+                                                      id_to_label=self.id_to_label)
+
+    def search_rows_batch(self, search_terms, index_name, top_k=10, batch_size=50):
+        return similarity_utils.search_rdf_index_batch_rows(search_terms, index_name, top_k=top_k,
+                                                            batch_size=batch_size, endpoint=self.endpoint,
+                                                            cache=self.cache, id_to_label=self.id_to_label)
+
+
+def _char_ngrams(text, ngram_range):
+    text = " " + " ".join(text.lower().split()) + " "
+    min_n, max_n = ngram_range
+    for n in range(min_n, max_n + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i + n]
+
+
+class LocalTfidfBackend(SearchBackend):
+    """
+    In-process backend scoring labels by cosine similarity of character n-gram TF-IDF vectors.
+
+    Queries are vectorized with the vocabulary of the index, scored against all labels with a single sparse
+    matrix multiplication per batch, and the top-k of each row is selected with argpartition.
+    """
+
+    default_batch_size = 256
+
+    def __init__(self, ids, labels, vocabulary, idf, matrix, ngram_range=(2, 4)):
+        self.ids = np.asarray(ids, dtype=object)
+        self.labels = np.asarray(labels, dtype=object)
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = matrix
+        self.ngram_range = tuple(ngram_range)
+        # labels x ngrams is stored, ngrams x labels is what the query multiplication needs
+        self._matrix_t = matrix.T.tocsr()
+
+    @classmethod
+    def build(cls, id_to_label, ngram_range=(2, 4)):
+        """
+        Builds the index from a class id to label dictionary, as returned by read_class_id_to_pref_label.
+        """
+        ids = list(id_to_label.keys())
+        labels = [id_to_label[class_id] for class_id in ids]
+
+        vocabulary = {}
+        indptr, indices, data = [0], [], []
+        for label in labels:
+            counts = Counter(vocabulary.setdefault(g, len(vocabulary)) for g in _char_ngrams(label, ngram_range))
+            indices.extend(counts.keys())
+            data.extend(counts.values())
+            indptr.append(len(indices))
+
+        counts_matrix = sparse.csr_matrix((np.asarray(data, dtype=np.float32), indices, indptr),
+                                          shape=(len(labels), len(vocabulary)))
+        document_frequency = np.bincount(counts_matrix.indices, minlength=len(vocabulary))
+        idf = (np.log((1 + len(labels)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        return cls(ids, labels, vocabulary, idf, cls._normalize(counts_matrix @ sparse.diags(idf)), ngram_range)
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix, dtype=np.float32)
+
+    def _vectorize(self, terms):
+        indptr, indices, data = [0], [], []
+        for term in terms:
+            counts = Counter(self.vocabulary[g] for g in _char_ngrams(term, self.ngram_range) if g in self.vocabulary)
+            indices.extend(counts.keys())
+            data.extend(counts.values())
+            indptr.append(len(indices))
+        counts_matrix = sparse.csr_matrix((np.asarray(data, dtype=np.float32), indices, indptr),
+                                          shape=(len(terms), len(self.vocabulary)))
+        return self._normalize(counts_matrix @ sparse.diags(self.idf))
+
+    def _top_k(self, scores, row, top_k):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        row_scores, row_indices = scores.data[start:end], scores.indices[start:end]
+        if len(row_scores) > top_k:
+            selected = np.argpartition(-row_scores, top_k - 1)[:top_k]
+            row_scores, row_indices = row_scores[selected], row_indices[selected]
+        order = np.argsort(-row_scores, kind="stable")
+        row_indices = row_indices[order]
+        return list(zip(self.ids[row_indices].tolist(), self.labels[row_indices].tolist(),
+                        row_scores[order].astype(float).tolist()))
+
+    def search_rows(self, search_term, index_name, top_k=10):
+        return self.search_rows_batch([search_term], index_name, top_k=top_k)[search_term]
+
+    def search_rows_batch(self, search_terms, index_name, top_k=10, batch_size=256):
+        unique_terms = list(dict.fromkeys(search_terms))
+        results_by_term = {}
+        for start in range(0, len(unique_terms), batch_size):
+            chunk = unique_terms[start:start + batch_size]
+            with metrics.timer("local_similarity_search_seconds", index=index_name):
+                scores = (self._vectorize(chunk) @ self._matrix_t).tocsr()
+                for i, term in enumerate(chunk):
+                    results_by_term[term] = self._top_k(scores, i, top_k)
+        return results_by_term
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        sparse.save_npz(os.path.join(directory, "matrix.npz"), self.matrix)
+        np.save(os.path.join(directory, "idf.npy"), self.idf)
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"ngram_range": list(self.ngram_range),
+                       "ids": self.ids.tolist(),
+                       "labels": self.labels.tolist(),
+                       "vocabulary": self.vocabulary}, f, ensure_ascii=False)
+        print(f"Local similarity index with {len(self.ids)} labels written to {directory}")
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return cls(index["ids"], index["labels"], index["vocabulary"],
+                   np.load(os.path.join(directory, "idf.npy")),
+                   sparse.load_npz(os.path.join(directory, "matrix.npz")).tocsr(),
+                   index["ngram_range"])
+
+
+def build_local_index(ontology, index_name, ngram_range=(2, 4)):
+    """
+    Builds a local index from ../data/datasets/csv/<ontology>.csv and saves it under ../data/indices/<index_name>/.
+    """
+    id_to_label = load_labels("../data/datasets/csv/" + ontology + ".csv")
+    backend = LocalTfidfBackend.build(id_to_label, ngram_range)
+    backend.save(os.path.join(LOCAL_INDEX_DIR, index_name))
+    return backend
+
+
+_local_backends = {}
+
+
+def get_search_backend(index_name, cache=None, id_to_label=None):
+    """
+    Returns the backend serving index_name and the index name without backend prefix.
+    Local indices are loaded once per process, they carry their own labels.
+    With id_to_label, GraphDB searches take the labels from that label table instead of the query.
+    """
+    # imported here, lsh.py builds on this module
+    from .lsh import LSH_INDEX_PREFIX, MinHashLshBackend
+
+    for prefix, backend_class in ((LOCAL_INDEX_PREFIX, LocalTfidfBackend), (LSH_INDEX_PREFIX, MinHashLshBackend)):
+        if index_name.startswith(prefix):
+            local_name = index_name[len(prefix):]
+            if (prefix, local_name) not in _local_backends:
+                _local_backends[prefix, local_name] = backend_class.load(os.path.join(LOCAL_INDEX_DIR, local_name))
+            return _local_backends[prefix, local_name], local_name
+    return GraphDBBackend(cache=cache, id_to_label=id_to_label), index_name
+
+
+# Example usage: python -m similarity.backends DOID doid_labels
+if __name__ == "__main__":
+    build_local_index(sys.argv[1], sys.argv[2])
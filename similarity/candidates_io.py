@@ -0,0 +1,147 @@
+import json
+import os
+
+
+def summary_file_for(candidates_file):
+    """Returns the sidecar file holding the Hits@K summary of a JSON Lines candidates file."""
+    return os.path.splitext(candidates_file)[0] + ".summary.json"
+
+
+def read_summary(candidates_file):
+    """
+    Returns the Hits@K summary of a JSON Lines candidates file, only the run settings (see CandidatesWriter)
+    when its run did not finish and empty for files written without them.
+    """
+    if not os.path.exists(summary_file_for(candidates_file)):
+        return {}
+    with open(summary_file_for(candidates_file), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _read_complete_records(candidates_file):
+    """Returns the records of a JSON Lines candidates file up to a partially written line, and their size in bytes."""
+    records = {}
+    valid_size = 0
+    with open(candidates_file, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            records[record["id"]] = record
+            valid_size += len(line)
+    return records, valid_size
+
+
+class CandidatesWriter:
+    """
+    Streams generated candidates to a JSON Lines file, one record per source entity.
+
+    Every record is flushed as soon as it is written, so an interrupted run keeps everything written so far.
+    With resume=True the existing records are kept (a partially written last line is cut off) and exposed
+    in existing_records, so the caller can skip those source ids; otherwise the file is truncated.
+    With incremental=True the existing records are exposed as well, but all records are written to a new file
+    that replaces the existing one in commit, an unfinished run leaves the existing file untouched.
+
+    The run settings in run_info (e.g. the index name) are written to the summary sidecar when a run starts
+    writing to the file. Existing records written with other settings are not kept, the run starts over.
+    """
+
+    def __init__(self, candidates_file, resume=False, incremental=False, run_info=None):
+        self.candidates_file = candidates_file
+        self.run_info = run_info or {}
+        self.existing_records = {}
+        self._rewrite_file = None
+
+        os.makedirs(os.path.dirname(candidates_file) or ".", exist_ok=True)
+        reuse = (resume or incremental) and os.path.exists(candidates_file)
+        if reuse and not self._same_run_info():
+            print(f"Previous candidates of {candidates_file} were not generated with {self.run_info}, starting over")
+            reuse = False
+
+        if incremental:
+            if reuse:
+                self.existing_records, _ = _read_complete_records(candidates_file)
+                print(f"Updating {candidates_file} with {len(self.existing_records)} previous entries")
+            self._rewrite_file = candidates_file + ".tmp"
+            self._file = open(self._rewrite_file, "w", encoding="utf-8")
+        elif reuse:
+            self.existing_records, valid_size = _read_complete_records(candidates_file)
+            with open(candidates_file, "r+b") as f:
+                f.truncate(valid_size)
+            print(f"Resuming {candidates_file} with {len(self.existing_records)} written entries")
+            self._file = open(candidates_file, "a", encoding="utf-8")
+        else:
+            self._file = open(candidates_file, "w", encoding="utf-8")
+        # an interrupted run leaves its settings to be checked by the run resuming it
+        if not incremental:
+            self.write_summary(self.run_info)
+
+    def _same_run_info(self):
+        # files written without run settings are assumed to match
+        previous = read_summary(self.candidates_file)
+        return all(previous.get(key, value) == value for key, value in self.run_info.items())
+
+    def write(self, kg1_id, entry):
+        record = {"id": kg1_id, **entry}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def write_summary(self, summary):
+        with open(summary_file_for(self.candidates_file), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    def commit(self):
+        """Closes the file, in incremental mode the rewritten file replaces the existing one."""
+        self._file.close()
+        if self._rewrite_file:
+            os.replace(self._rewrite_file, self.candidates_file)
+            self._rewrite_file = None
+
+    def close(self):
+        self._file.close()
+        if self._rewrite_file and os.path.exists(self._rewrite_file):
+            os.remove(self._rewrite_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_candidates(candidates_file):
+    """
+    Yields (source id, entry) pairs from a JSON Lines candidates file, or from a legacy .json candidates file.
+    A partially written last line of an interrupted run is skipped.
+    """
+    if candidates_file.endswith(".json"):
+        with open(candidates_file, "r", encoding="utf-8") as f:
+            yield from json.load(f).get("candidates", {}).items()
+        return
+
+    with open(candidates_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield record.pop("id"), record
+
+
+def read_candidates(candidates_file):
+    """
+    Reads a candidates file written by calculate_hits_at_n.
+
+    Returns:
+    - A dictionary with the Hits@K summary (empty when the run did not finish).
+    - A dictionary of source id to candidates entry.
+    """
+    if candidates_file.endswith(".json"):
+        with open(candidates_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {k: v for k, v in data.items() if k != "candidates"}, data.get("candidates", {})
+
+    return read_summary(candidates_file), dict(iter_candidates(candidates_file))
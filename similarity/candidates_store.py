@@ -0,0 +1,185 @@
+import json
+import os
+from array import array
+
+import numpy as np
+
+from .candidates_io import iter_candidates
+from .versioned_dir import current_version_dir, new_build_dir, publish_build_dir
+
+NO_STRING = -1
+
+
+def store_dir_for(candidates_file):
+    """Returns the directory of the columnar store built from a candidates file."""
+    return os.path.splitext(candidates_file)[0] + ".store"
+
+
+class _StringTableBuilder:
+    """Interns strings into a table of utf-8 bytes plus offsets."""
+
+    def __init__(self):
+        self.index = {}
+        self.data = bytearray()
+        self.offsets = array("q", [0])
+
+    def intern(self, value):
+        if value is None:
+            return NO_STRING
+        position = self.index.get(value)
+        if position is None:
+            position = len(self.index)
+            self.index[value] = position
+            self.data += value.encode("utf-8")
+            self.offsets.append(len(self.data))
+        return position
+
+
+class CandidatesStore:
+    """
+    Columnar, memory-mapped view of a candidates file for paging in the LLM classification tab.
+
+    Ids and labels are interned into one string table, the per-entry and per-candidate columns are NumPy arrays
+    of string table positions (and float32 scores) loaded with mmap_mode="r". The positions of the entries whose
+    equivalent id is among their candidates are precomputed, so loading a page only touches that page's rows.
+    """
+
+    _ENTRY_COLUMNS = ("source_ids", "labels", "equivalent_ids", "equivalent_id_labels")
+    _CANDIDATE_COLUMNS = ("candidate_ids", "candidate_labels", "candidate_scores")
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.target_id_name = self.meta["target_id_name"]
+
+        def load(name):
+            return np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r")
+
+        self._strings = np.memmap(os.path.join(store_dir, "strings.bin"), dtype=np.uint8, mode="r") \
+            if os.path.getsize(os.path.join(store_dir, "strings.bin")) else np.zeros(0, dtype=np.uint8)
+        self._string_offsets = load("string_offsets")
+        self._entries = {name: load(name) for name in self._ENTRY_COLUMNS}
+        self._candidate_offsets = load("candidate_offsets")
+        self._candidates = {name: load(name) for name in self._CANDIDATE_COLUMNS}
+        self.classifiable = load("classifiable")
+
+    def __len__(self):
+        return len(self._entries["source_ids"])
+
+    @property
+    def num_classifiable(self):
+        return len(self.classifiable)
+
+    def _string(self, position):
+        if position == NO_STRING:
+            return None
+        start, end = self._string_offsets[position], self._string_offsets[position + 1]
+        return self._strings[start:end].tobytes().decode("utf-8")
+
+    def entry(self, row):
+        """Returns (source id, entry) for a row, in the shape written by calculate_hits_at_n."""
+        start, end = self._candidate_offsets[row], self._candidate_offsets[row + 1]
+        candidates = [{self.target_id_name: self._string(kg2_id), "label": self._string(label),
+                       "score": round(float(score), 4)}
+                      for kg2_id, label, score in zip(self._candidates["candidate_ids"][start:end],
+                                                      self._candidates["candidate_labels"][start:end],
+                                                      self._candidates["candidate_scores"][start:end])]
+        return self._string(self._entries["source_ids"][row]), {
+            "label": self._string(self._entries["labels"][row]),
+            "equivalent_id": self._string(self._entries["equivalent_ids"][row]),
+            "equivalent_id_label": self._string(self._entries["equivalent_id_labels"][row]),
+            "candidates": candidates,
+        }
+
+    def page(self, offset, limit, classifiable_only=True):
+        """Returns a dictionary of source id to entry for limit entries starting at offset."""
+        if classifiable_only:
+            rows = self.classifiable[offset:offset + limit]
+        else:
+            rows = range(offset, min(offset + limit, len(self)))
+        return dict(self.entry(int(row)) for row in rows)
+
+    @classmethod
+    def build(cls, candidates_file, store_dir=None):
+        """
+        Converts a candidates file (JSON Lines or legacy .json) into a columnar store, published as a new version
+        of store_dir (see versioned_dir.py) so stores opened before keep reading the files they mapped.
+        """
+        store_dir = store_dir or store_dir_for(candidates_file)
+        strings = _StringTableBuilder()
+        entries = {name: array("i") for name in cls._ENTRY_COLUMNS}
+        candidate_offsets = array("q", [0])
+        candidates = {"candidate_ids": array("i"), "candidate_labels": array("i"), "candidate_scores": array("f")}
+        classifiable = []
+        # a resumed run can append a newer record for a source id, only the latest one is classifiable
+        latest_row = {}
+        target_id_name = None
+
+        for row, (source_id, entry) in enumerate(iter_candidates(candidates_file)):
+            entries["source_ids"].append(strings.intern(source_id))
+            entries["labels"].append(strings.intern(entry.get("label")))
+            entries["equivalent_ids"].append(strings.intern(entry.get("equivalent_id")))
+            entries["equivalent_id_labels"].append(strings.intern(entry.get("equivalent_id_label")))
+
+            candidate_ids = set()
+            for c in entry.get("candidates", []):
+                if target_id_name is None:
+                    target_id_name = next(k for k in c if k not in ("label", "score"))
+                candidate_ids.add(c[target_id_name])
+                candidates["candidate_ids"].append(strings.intern(c[target_id_name]))
+                candidates["candidate_labels"].append(strings.intern(c.get("label")))
+                candidates["candidate_scores"].append(c["score"])
+            candidate_offsets.append(len(candidates["candidate_ids"]))
+
+            latest_row[source_id] = row
+            if entry.get("equivalent_id") in candidate_ids:
+                classifiable.append((source_id, row))
+
+        classifiable = array("i", [row for source_id, row in classifiable if latest_row[source_id] == row])
+
+        build_dir = new_build_dir(store_dir)
+        with open(os.path.join(build_dir, "strings.bin"), "wb") as f:
+            f.write(strings.data)
+        np.save(os.path.join(build_dir, "string_offsets.npy"), np.frombuffer(strings.offsets, dtype=np.int64))
+        for name, values in entries.items():
+            np.save(os.path.join(build_dir, name + ".npy"), np.frombuffer(values, dtype=np.int32))
+        np.save(os.path.join(build_dir, "candidate_offsets.npy"), np.frombuffer(candidate_offsets, dtype=np.int64))
+        np.save(os.path.join(build_dir, "candidate_ids.npy"), np.frombuffer(candidates["candidate_ids"], dtype=np.int32))
+        np.save(os.path.join(build_dir, "candidate_labels.npy"),
+                np.frombuffer(candidates["candidate_labels"], dtype=np.int32))
+        np.save(os.path.join(build_dir, "candidate_scores.npy"),
+                np.frombuffer(candidates["candidate_scores"], dtype=np.float32))
+        np.save(os.path.join(build_dir, "classifiable.npy"), np.frombuffer(classifiable, dtype=np.int32))
+        with open(os.path.join(build_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"target_id_name": target_id_name,
+                       "source_file": os.path.basename(candidates_file),
+                       "source_mtime": os.path.getmtime(candidates_file),
+                       "source_size": os.path.getsize(candidates_file)}, f)
+
+        # the files are mapped before publishing, a concurrent build may remove this version right after
+        store = cls(build_dir)
+        store.store_dir = publish_build_dir(store_dir, build_dir)
+
+        print(f"Candidates store with {len(entries['source_ids'])} entries "
+              f"({len(classifiable)} classifiable) written to {store_dir}")
+        return store
+
+
+def open_candidates_store(candidates_file):
+    """
+    Opens the columnar store of a candidates file, (re)building it when it is missing or the file changed.
+    """
+    store_dir = store_dir_for(candidates_file)
+    version_dir = current_version_dir(store_dir)
+    if version_dir is not None:
+        try:
+            with open(os.path.join(version_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if (meta["source_mtime"] == os.path.getmtime(candidates_file)
+                    and meta["source_size"] == os.path.getsize(candidates_file)):
+                return CandidatesStore(version_dir)
+        except FileNotFoundError:
+            # the version was replaced and removed by a concurrent build
+            pass
+    return CandidatesStore.build(candidates_file, store_dir)
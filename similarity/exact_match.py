@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+from .label_table import load_labels, table_dir_for
+from .versioned_dir import current_version_dir, new_build_dir, publish_build_dir
+from instrumentation import registry as metrics
+
+_PUNCTUATION = re.compile(r"[^\w\s]|_")
+
+
+def normalize_label(label):
+    """Case, accent, punctuation and word order insensitive form of a label, e.g. "Diabetes, Type 1" -> "1 diabetes type"."""
+    text = "".join(c for c in unicodedata.normalize("NFKD", label) if not unicodedata.combining(c)).casefold()
+    return " ".join(sorted(_PUNCTUATION.sub(" ", text).split()))
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _hash_index(hashes):
+    """Sorted unique hashes and the label table position per hash, -1 for hashes shared by several positions."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    unique_hashes, first, counts = np.unique(hashes, return_index=True, return_counts=True)
+    return unique_hashes, np.where(counts > 1, -1, first).astype(np.int32)
+
+
+def index_dir_for(ontology_file):
+    """Returns the directory of the exact match index of an ontology csv, next to its label table."""
+    return os.path.splitext(table_dir_for(ontology_file))[0] + ".exact"
+
+
+class ExactMatchIndex:
+    """
+    Hash index of the target labels resolving a source label to the single target id with the same label,
+    first comparing the labels as they are, then their normalized forms (see normalize_label).
+    Labels (or normalized labels) shared by several target ids are ambiguous and not resolved.
+
+    The 64-bit hashes of both forms are sorted arrays mapping to positions in the label table, memory-mapped
+    from the index directory. Hits are checked against the label table, so a hash collision is not resolved.
+    """
+
+    _ARRAYS = ("exact_hashes", "exact_positions", "normalized_hashes", "normalized_positions")
+
+    def __init__(self, index_dir, id_to_label):
+        """
+        :param id_to_label: Label table the index was built from, as returned by load_labels
+        """
+        self.index_dir = index_dir
+        self.id_to_label = id_to_label
+        for name in self._ARRAYS:
+            setattr(self, "_" + name, np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r"))
+
+    @classmethod
+    def build(cls, ontology_file, id_to_label, index_dir=None):
+        """Hashes the labels of the label table of ontology_file and writes them as a new version of the index."""
+        index_dir = index_dir or index_dir_for(ontology_file)
+        exact_hashes = []
+        normalized_hashes = []
+        for _, label in id_to_label.items():
+            exact_hashes.append(_key_hash(label))
+            normalized_hashes.append(_key_hash(normalize_label(label)))
+
+        build_dir = new_build_dir(index_dir)
+        arrays = dict(zip(cls._ARRAYS, (*_hash_index(exact_hashes), *_hash_index(normalized_hashes))))
+        for name, values in arrays.items():
+            np.save(os.path.join(build_dir, name + ".npy"), values)
+        with open(os.path.join(build_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"source_file": os.path.basename(ontology_file),
+                       "source_mtime": os.path.getmtime(ontology_file),
+                       "source_size": os.path.getsize(ontology_file)}, f)
+
+        index = cls(build_dir, id_to_label)
+        index.index_dir = publish_build_dir(index_dir, build_dir)
+        print(f"Exact match index of {len(exact_hashes)} labels written to {index_dir}")
+        return index
+
+    @staticmethod
+    def _position(hashes, positions, key):
+        """Label table position of key, -1 when it is ambiguous and None when it is not in the index."""
+        key_hash = np.uint64(_key_hash(key))
+        i = int(np.searchsorted(hashes, key_hash))
+        if i < len(hashes) and hashes[i] == key_hash:
+            return int(positions[i])
+        return None
+
+    def lookup(self, label):
+        """Returns the target id with the same (or same normalized) label, None when there is none or several."""
+        position = self._position(self._exact_hashes, self._exact_positions, label)
+        if position == -1:
+            return None
+        if position is not None:
+            class_id, target_label = self.id_to_label.item_at(position)
+            if target_label == label:
+                return class_id
+
+        normalized = normalize_label(label)
+        position = self._position(self._normalized_hashes, self._normalized_positions, normalized)
+        if position is None or position == -1:
+            return None
+        class_id, target_label = self.id_to_label.item_at(position)
+        return class_id if normalize_label(target_label) == normalized else None
+
+    def resolve(self, labels, stage):
+        """
+        Looks up every label and counts the resolved ones in the exact_match_fast_path_total metric of stage.
+
+        :return: List of the target id per label, None for labels that still need the similarity search or LLM
+        """
+        class_ids = [self.lookup(label) for label in labels]
+        resolved = sum(class_id is not None for class_id in class_ids)
+        metrics.inc("exact_match_fast_path_total", resolved, stage=stage, result="resolved")
+        metrics.inc("exact_match_fast_path_total", len(labels) - resolved, stage=stage, result="unresolved")
+        return class_ids
+
+
+_indices = {}
+
+
+def load_exact_match_index(ontology_file):
+    """
+    Returns the exact match index of an ontology csv, (re)building it when it is missing or the csv changed.
+    Indices are opened once per process and csv version.
+    """
+    fingerprint = (os.path.getmtime(ontology_file), os.path.getsize(ontology_file))
+    cached = _indices.get(ontology_file)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    id_to_label = load_labels(ontology_file)
+    index_dir = index_dir_for(ontology_file)
+    version_dir = current_version_dir(index_dir)
+    index = None
+    if version_dir is not None:
+        try:
+            with open(os.path.join(version_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if (meta["source_mtime"], meta["source_size"]) == fingerprint:
+                index = ExactMatchIndex(version_dir, id_to_label)
+        except FileNotFoundError:
+            # the version was replaced and removed by a concurrent build
+            pass
+    if index is None:
+        with metrics.timer("exact_match_index_build_seconds"):
+            index = ExactMatchIndex.build(ontology_file, id_to_label, index_dir)
+
+    _indices[ontology_file] = (fingerprint, index)
+    return index
@@ -0,0 +1,87 @@
+import threading
+import time
+import traceback
+
+from .similarity_utils import compute_hits_at_n
+
+
+class HitsAtKJob:
+    """
+    Hits@K evaluation of one (pair, mapping) running compute_hits_at_n in a worker thread.
+
+    The job records the progress reported by compute_hits_at_n, snapshot returns a consistent copy of it
+    that can be read from any thread while the evaluation runs.
+    """
+
+    def __init__(self, selected_pair, selected_mapping, **options):
+        """
+        :param options: Keyword arguments of compute_hits_at_n (save_candidates, max_workers, ...)
+        """
+        self.selected_pair = selected_pair
+        self.selected_mapping = selected_mapping
+        self.options = options
+        self._lock = threading.Lock()
+        self._state = {"status": "running", "done": 0, "total": 0, "partial_hits": {}, "partial_mrr": 0.0,
+                       "result": None, "error": None, "started_at": time.time(), "finished_at": None}
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"hits-at-k-{selected_pair}-{selected_mapping}")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._state)
+
+    def _update(self, **values):
+        with self._lock:
+            self._state.update(values)
+
+    def _on_progress(self, done, total, partial_hits, partial_mrr):
+        self._update(done=done, total=total, partial_hits=partial_hits, partial_mrr=partial_mrr)
+
+    def _run(self):
+        try:
+            result = compute_hits_at_n(self.selected_pair, self.selected_mapping,
+                                       progress_callback=self._on_progress, **self.options)
+            self._update(status="finished", result=result, finished_at=time.time())
+        except Exception as e:
+            traceback.print_exc()
+            self._update(status="failed", error=str(e), finished_at=time.time())
+
+
+class JobRegistry:
+    """
+    Keeps the latest Hits@K job of every (pair, mapping).
+
+    Submitting while the job of the same (pair, mapping) is still running returns that job instead of starting
+    another one, so every user asking for the same evaluation follows one run. Finished jobs stay available
+    until the next submission for their (pair, mapping).
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, selected_pair, selected_mapping, **options):
+        """Returns the running job of (selected_pair, selected_mapping), or starts one with options."""
+        key = (selected_pair, selected_mapping)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or not job.running:
+                job = HitsAtKJob(selected_pair, selected_mapping, **options).start()
+                self._jobs[key] = job
+            return job
+
+    def get(self, selected_pair, selected_mapping):
+        """Returns the latest job of (selected_pair, selected_mapping), or None."""
+        with self._lock:
+            return self._jobs.get((selected_pair, selected_mapping))
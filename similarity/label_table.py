@@ -0,0 +1,166 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+from .versioned_dir import current_version_dir, new_build_dir, publish_build_dir
+from instrumentation import registry as metrics
+
+LABEL_TABLE_DIR = "../data/labels/"
+
+ID_COLUMN = "Class ID"
+LABEL_COLUMN = "Preferred Label"
+
+
+def table_dir_for(ontology_file):
+    """Returns the directory of the label table built from an ontology csv."""
+    return os.path.join(LABEL_TABLE_DIR, os.path.splitext(os.path.basename(ontology_file))[0] + ".labels")
+
+
+class LabelTable(Mapping):
+    """
+    Compact, memory-mapped class id to preferred label mapping of an ontology csv.
+
+    The ids are a sorted fixed-width byte array looked up with binary search, the labels are one utf-8 blob
+    plus offsets in id order. It can be used wherever the dictionary of read_class_id_to_pref_label is used,
+    iteration is in id order.
+    """
+
+    def __init__(self, table_dir):
+        self.table_dir = table_dir
+        self._ids = np.load(os.path.join(table_dir, "ids.npy"), mmap_mode="r")
+        self._label_offsets = np.load(os.path.join(table_dir, "label_offsets.npy"), mmap_mode="r")
+        labels_file = os.path.join(table_dir, "labels.bin")
+        self._labels = np.memmap(labels_file, dtype=np.uint8, mode="r") \
+            if os.path.getsize(labels_file) else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for class_id in self._ids:
+            yield class_id.decode("utf-8")
+
+    def _position(self, class_id):
+        if not isinstance(class_id, str):
+            return -1
+        key = class_id.encode("utf-8")
+        position = int(np.searchsorted(self._ids, key))
+        if position < len(self._ids) and self._ids[position] == key:
+            return position
+        return -1
+
+    def _label(self, position):
+        start, end = self._label_offsets[position], self._label_offsets[position + 1]
+        return self._labels[start:end].tobytes().decode("utf-8")
+
+    def __getitem__(self, class_id):
+        position = self._position(class_id)
+        if position < 0:
+            raise KeyError(class_id)
+        return self._label(position)
+
+    def __contains__(self, class_id):
+        return self._position(class_id) >= 0
+
+    def get_many(self, class_ids):
+        """Returns the label of every id (None for unknown ids), with one binary search for all of them."""
+        if not len(self._ids):
+            return [None] * len(class_ids)
+        encoded = [class_id.encode("utf-8") if isinstance(class_id, str) else b"" for class_id in class_ids]
+        # ids longer than the stored width would be truncated by the conversion, they cannot be in the table
+        fits = np.array([0 < len(key) <= self._ids.dtype.itemsize for key in encoded], dtype=bool)
+        keys = np.array(encoded, dtype=self._ids.dtype)
+        positions = np.minimum(np.searchsorted(self._ids, keys), len(self._ids) - 1)
+        found = fits & (self._ids[positions] == keys)
+        starts = self._label_offsets[positions].tolist()
+        ends = self._label_offsets[positions + 1].tolist()
+        labels = memoryview(self._labels)
+        return [str(labels[start:end], "utf-8") if hit else None
+                for start, end, hit in zip(starts, ends, found.tolist())]
+
+    def items(self):
+        for position, class_id in enumerate(self._ids):
+            yield class_id.decode("utf-8"), self._label(position)
+
+    def item_at(self, position):
+        """Returns the (id, label) at a position of the id order, as yielded by items."""
+        return self._ids[position].decode("utf-8"), self._label(position)
+
+    @classmethod
+    @metrics.timed("label_loading_seconds", method="label_table_build")
+    def build(cls, ontology_file, table_dir=None):
+        """
+        Reads the id and label columns of an ontology csv and writes them as a new version of the label table
+        (see versioned_dir.py), so tables opened before, also by other processes, keep reading the files they mapped.
+        """
+        table_dir = table_dir or table_dir_for(ontology_file)
+
+        # only the two needed columns are converted, with the multithreaded columnar pyarrow reader
+        # (definitions in BioPortal csvs span several lines)
+        table = pa_csv.read_csv(
+            ontology_file,
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(include_columns=[ID_COLUMN, LABEL_COLUMN],
+                                                  column_types={ID_COLUMN: pa.string(), LABEL_COLUMN: pa.string()},
+                                                  strings_can_be_null=False))
+        df = table.to_pandas()
+        # like the dictionary of read_class_id_to_pref_label, the last row of a duplicate id wins
+        df = df.drop_duplicates(subset=ID_COLUMN, keep="last").sort_values(ID_COLUMN)
+
+        ids = np.array([class_id.encode("utf-8") for class_id in df[ID_COLUMN]], dtype=bytes)
+        encoded_labels = [label.encode("utf-8") for label in df[LABEL_COLUMN]]
+        label_offsets = np.zeros(len(encoded_labels) + 1, dtype=np.int64)
+        np.cumsum([len(label) for label in encoded_labels], out=label_offsets[1:])
+
+        build_dir = new_build_dir(table_dir)
+        np.save(os.path.join(build_dir, "ids.npy"), ids)
+        np.save(os.path.join(build_dir, "label_offsets.npy"), label_offsets)
+        with open(os.path.join(build_dir, "labels.bin"), "wb") as f:
+            f.write(b"".join(encoded_labels))
+        with open(os.path.join(build_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"source_file": os.path.basename(ontology_file),
+                       "source_mtime": os.path.getmtime(ontology_file),
+                       "source_size": os.path.getsize(ontology_file)}, f)
+
+        # mapped before publishing, a concurrent build of another process may remove this version right after
+        label_table = cls(build_dir)
+        label_table.table_dir = publish_build_dir(table_dir, build_dir)
+        print(f"Label table with {len(ids)} ids written to {table_dir}")
+        return label_table
+
+
+_open_tables = {}
+
+
+def load_labels(ontology_file):
+    """
+    Returns the label table of an ontology csv, (re)building it when it is missing or the csv changed.
+    Tables are opened once per process and csv version.
+    """
+    fingerprint = (os.path.getmtime(ontology_file), os.path.getsize(ontology_file))
+    cached = _open_tables.get(ontology_file)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    table_dir = table_dir_for(ontology_file)
+    version_dir = current_version_dir(table_dir)
+    table = None
+    if version_dir is not None:
+        try:
+            with open(os.path.join(version_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if (meta["source_mtime"], meta["source_size"]) == fingerprint:
+                with metrics.timer("label_loading_seconds", method="label_table_open"):
+                    table = LabelTable(version_dir)
+        except FileNotFoundError:
+            # the version was replaced and removed by a concurrent build
+            pass
+    if table is None:
+        table = LabelTable.build(ontology_file, table_dir)
+
+    _open_tables[ontology_file] = (fingerprint, table)
+    return table
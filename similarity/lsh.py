@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from .backends import LOCAL_INDEX_DIR, SearchBackend
+from .label_table import load_labels
+from instrumentation import registry as metrics
+
+# Index names with this prefix are served by MinHashLshBackend, e.g. similarity_indices = {"MESH": "lsh:mesh_lsh"}
+# loads the index from ../data/indices/mesh_lsh/
+LSH_INDEX_PREFIX = "lsh:"
+
+
+def _mix64(values):
+    """splitmix64 finalizer, spreads the bits of uint64 values."""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _shingle_hashes(labels, shingle_size):
+    """
+    Returns the uint64 hashes of the character shingles (over the utf-8 bytes of the normalized label) of all labels
+    and the offset of the first shingle of every label. Every label has at least one shingle.
+    """
+    encoded = [(" " + " ".join(label.lower().split()) + " ").encode("utf-8").ljust(shingle_size)
+               for label in labels]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+
+    shingle_counts = lengths - shingle_size + 1
+    label_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    shingle_offsets = np.concatenate(([0], np.cumsum(shingle_counts)[:-1]))
+    # byte position of every shingle: start of its label plus its position within the label
+    positions = np.repeat(label_starts - shingle_offsets, shingle_counts) + np.arange(shingle_counts.sum())
+
+    hashes = np.zeros(len(positions), dtype=np.uint64)
+    for j in range(shingle_size):
+        hashes = hashes * np.uint64(257) + data[positions + j]
+    return _mix64(hashes), shingle_offsets
+
+
+def _band_keys(signatures, bands, rows):
+    """Returns one uint64 key per label and band, hashing the rows of the signature in the band."""
+    band_rows = np.asarray(signatures[:, :bands * rows], dtype=np.uint64).reshape(len(signatures), bands, rows)
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    for row in range(rows):
+        keys = _mix64(keys ^ band_rows[:, :, row] ^ np.uint64(row + 1))
+    return keys
+
+
+class MinHashSignatures:
+    """MinHash signatures of labels, each of the num_perm hash functions is a multiply-shift hash of the shingles."""
+
+    def __init__(self, num_perm=128, shingle_size=3, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        random_state = np.random.RandomState(seed)
+        # the upper 32 bits of (a * x + b) mod 2^64 with odd a are the hash value, the (a, b) pairs are drawn
+        # together so the first n hash functions are the same for any num_perm >= n
+        parameters = random_state.randint(0, 2 ** 62, size=(num_perm, 2), dtype=np.int64).astype(np.uint64)
+        self._a = parameters[:, 0] * np.uint64(2) + np.uint64(1)
+        self._b = parameters[:, 1]
+
+    def compute(self, labels, chunk_size=2000):
+        """Returns the uint32 signatures of labels, one row per label."""
+        signatures = np.empty((len(labels), self.num_perm), dtype=np.uint32)
+        for start in range(0, len(labels), chunk_size):
+            hashes, offsets = _shingle_hashes(labels[start:start + chunk_size], self.shingle_size)
+            permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) >> np.uint64(32)
+            signatures[start:start + chunk_size] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        return signatures
+
+
+class MinHashLshBackend(SearchBackend):
+    """
+    In-process backend generating candidates by MinHash LSH blocking.
+
+    The signature of every label is cut into bands of rows, labels sharing the key of at least one band with
+    the query form its candidate block. The bands are tables of sorted keys, so a block is found with one binary
+    search per band instead of scoring all labels. Candidates are ranked by their estimated Jaccard similarity
+    (share of equal signature rows) to the query.
+    """
+
+    default_batch_size = 256
+
+    def __init__(self, ids, labels, signatures, band_keys, band_members, bands, rows, shingle_size=3, seed=1,
+                 max_block_size=2000):
+        """
+        :param band_keys: Sorted keys of every band, shape (bands, labels)
+        :param band_members: Label position of every key in band_keys
+        :param max_block_size: Blocks are cut to the labels colliding in the most bands
+        """
+        self.ids = np.asarray(ids, dtype=object)
+        self.labels = np.asarray(labels, dtype=object)
+        self.signatures = signatures
+        self.band_keys = band_keys
+        self.band_members = band_members
+        self.bands = bands
+        self.rows = rows
+        self.max_block_size = max_block_size
+        self.minhash = MinHashSignatures(signatures.shape[1], shingle_size, seed)
+
+    @classmethod
+    def build(cls, id_to_label, bands=32, rows=4, shingle_size=3, seed=1, signatures=None):
+        """
+        Builds the index from a class id to label dictionary, as returned by read_class_id_to_pref_label.
+
+        :param signatures: Precomputed signatures of the labels with at least bands * rows rows
+        """
+        ids = list(id_to_label.keys())
+        labels = [id_to_label[class_id] for class_id in ids]
+        if signatures is None:
+            signatures = MinHashSignatures(bands * rows, shingle_size, seed).compute(labels)
+        signatures = signatures[:, :bands * rows]
+
+        keys = _band_keys(signatures, bands, rows).T
+        order = np.argsort(keys, axis=1, kind="stable")
+        band_keys = np.take_along_axis(keys, order, axis=1)
+        return cls(ids, labels, signatures, band_keys, order.astype(np.int32), bands, rows, shingle_size, seed)
+
+    def block(self, signatures):
+        """Returns the candidate block (label positions) of every query signature."""
+        query_keys = _band_keys(signatures, self.bands, self.rows)
+        bounds = [(np.searchsorted(self.band_keys[band], query_keys[:, band], side="left"),
+                   np.searchsorted(self.band_keys[band], query_keys[:, band], side="right"))
+                  for band in range(self.bands)]
+
+        blocks = []
+        for i in range(len(signatures)):
+            members = [self.band_members[band, lo[i]:hi[i]] for band, (lo, hi) in enumerate(bounds) if hi[i] > lo[i]]
+            if not members:
+                blocks.append(np.empty(0, dtype=np.int32))
+                continue
+            candidates, collisions = np.unique(np.concatenate(members), return_counts=True)
+            if len(candidates) > self.max_block_size:
+                candidates = candidates[np.argsort(-collisions, kind="stable")[:self.max_block_size]]
+            blocks.append(candidates)
+        return blocks
+
+    def search_rows(self, search_term, index_name, top_k=10):
+        return self.search_rows_batch([search_term], index_name, top_k=top_k)[search_term]
+
+    def search_rows_batch(self, search_terms, index_name, top_k=10, batch_size=256):
+        unique_terms = list(dict.fromkeys(search_terms))
+        results_by_term = {}
+        for start in range(0, len(unique_terms), batch_size):
+            chunk = unique_terms[start:start + batch_size]
+            with metrics.timer("lsh_similarity_search_seconds", index=index_name):
+                query_signatures = self.minhash.compute(chunk)
+                for term, signature, candidates in zip(chunk, query_signatures, self.block(query_signatures)):
+                    scores = (self.signatures[candidates] == signature).mean(axis=1)
+                    order = np.argsort(-scores, kind="stable")[:top_k]
+                    results_by_term[term] = list(zip(self.ids[candidates[order]].tolist(),
+                                                     self.labels[candidates[order]].tolist(),
+                                                     scores[order].astype(float).tolist()))
+        return results_by_term
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "signatures.npy"), self.signatures)
+        np.save(os.path.join(directory, "band_keys.npy"), self.band_keys)
+        np.save(os.path.join(directory, "band_members.npy"), self.band_members)
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"type": "minhash_lsh",
+                       "bands": self.bands,
+                       "rows": self.rows,
+                       "shingle_size": self.minhash.shingle_size,
+                       "seed": self.minhash.seed,
+                       "ids": self.ids.tolist(),
+                       "labels": self.labels.tolist()}, f, ensure_ascii=False)
+        print(f"MinHash LSH index with {len(self.ids)} labels ({self.bands} bands of {self.rows} rows) "
+              f"written to {directory}")
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return cls(index["ids"], index["labels"],
+                   np.load(os.path.join(directory, "signatures.npy"), mmap_mode="r"),
+                   np.load(os.path.join(directory, "band_keys.npy"), mmap_mode="r"),
+                   np.load(os.path.join(directory, "band_members.npy"), mmap_mode="r"),
+                   index["bands"], index["rows"], index["shingle_size"], index["seed"])
+
+
+def build_lsh_index(ontology, index_name, bands=32, rows=4, shingle_size=3):
+    """
+    Builds a MinHash LSH index from ../data/datasets/csv/<ontology>.csv and saves it under
+    ../data/indices/<index_name>/.
+    """
+    id_to_label = load_labels("../data/datasets/csv/" + ontology + ".csv")
+    backend = MinHashLshBackend.build(id_to_label, bands, rows, shingle_size)
+    backend.save(os.path.join(LOCAL_INDEX_DIR, index_name))
+    return backend
+
+
+def evaluate_band_configurations(selected_pair, selected_mapping, configurations, shingle_size=3, top_k=100):
+    """
+    Reports the recall/speed trade-off of band configurations on the seed mappings of a pair.
+
+    Parameters:
+    - selected_pair (str): The pair of ontologies, e.g. "DOID-MESH".
+    - selected_mapping (str): The mappings csv under data/mappings/.
+    - configurations (list): (bands, rows) tuples, the signatures are computed once for the largest bands * rows.
+    - shingle_size (int, optional): Length of the character shingles (default: 3).
+    - top_k (int, optional): Number of scored candidates for Hits@K (default: 100).
+
+    Returns:
+    - pandas.DataFrame: One row per configuration with the similarity threshold (1/bands)^(1/rows), the blocking
+      recall (share of queries whose correct id is in the block), block sizes, Hits@1/10 of the scored
+      candidates, and build and query times.
+    """
+    kg_1, kg_2 = selected_pair.split("-")
+    mappings_df = pd.read_csv("../data/mappings/" + selected_mapping, sep=",", dtype=str)
+    kg_1_id_to_label = load_labels("../data/datasets/csv/" + kg_1 + ".csv")
+    kg_2_id_to_label = load_labels("../data/datasets/csv/" + kg_2 + ".csv")
+
+    queries = [(kg_1_id_to_label[id1], id2) for id1, id2 in zip(mappings_df[kg_1], mappings_df[kg_2])
+               if id1 in kg_1_id_to_label]
+    query_labels = [label for label, _ in queries]
+    target_ids = list(kg_2_id_to_label.keys())
+    target_labels = [kg_2_id_to_label[class_id] for class_id in target_ids]
+
+    num_perm = max(bands * rows for bands, rows in configurations)
+    minhash = MinHashSignatures(num_perm, shingle_size)
+    start_time = time.perf_counter()
+    signatures = minhash.compute(target_labels)
+    signature_seconds = time.perf_counter() - start_time
+    query_signatures = minhash.compute(query_labels)
+
+    report = []
+    for bands, rows in configurations:
+        start_time = time.perf_counter()
+        backend = MinHashLshBackend.build(kg_2_id_to_label, bands, rows, shingle_size, signatures=signatures)
+        build_seconds = time.perf_counter() - start_time + signature_seconds
+
+        start_time = time.perf_counter()
+        blocks = backend.block(query_signatures[:, :bands * rows])
+        block_seconds = time.perf_counter() - start_time
+
+        # single label searches (signature, block and scoring), as sent by calculate_hits_at_n without batching
+        latencies, ranks = [], []
+        for label, correct_id in queries[:1000]:
+            search_start = time.perf_counter()
+            retrieved = [row[0] for row in backend.search_rows(label, "evaluation", top_k=top_k)]
+            latencies.append(time.perf_counter() - search_start)
+            ranks.append(retrieved.index(correct_id) + 1 if correct_id in retrieved else 0)
+        ranks = np.array(ranks)
+
+        block_sizes = np.array([len(block) for block in blocks])
+        in_block = np.array([correct_id in set(backend.ids[block]) for (_, correct_id), block in zip(queries, blocks)])
+
+        row = {"bands": bands,
+               "rows": rows,
+               "threshold": round((1 / bands) ** (1 / rows), 3),
+               "recall": round(float(in_block.mean()) * 100, 2),
+               "mean block": round(float(block_sizes.mean()), 1),
+               "p99 block": int(np.percentile(block_sizes, 99)),
+               "share scored %": round(float(block_sizes.mean()) / len(target_ids) * 100, 3),
+               "Hits@1": round(float(((ranks > 0) & (ranks <= 1)).mean()) * 100, 2),
+               "Hits@10": round(float(((ranks > 0) & (ranks <= 10)).mean()) * 100, 2),
+               "build s": round(build_seconds, 2),
+               "block ms/query": round(block_seconds / len(queries) * 1000, 4),
+               "search p50 ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+               "search p99 ms": round(float(np.percentile(latencies, 99)) * 1000, 3)}
+        print(row)
+        report.append(row)
+
+    report_df = pd.DataFrame(report)
+    print(f"\n{len(queries)} queries against {len(target_ids)} {kg_2} labels "
+          f"(Hits@K and search latency over the first {min(len(queries), 1000)} queries)")
+    print(report_df.to_string(index=False))
+    return report_df
+
+
+def _configuration(value):
+    bands, rows = value.lower().split("x")
+    return int(bands), int(rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build and evaluate MinHash LSH blocking indices")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build an index under data/indices/")
+    build_parser.add_argument("ontology", help="Ontology csv under data/datasets/csv/, e.g. MESH")
+    build_parser.add_argument("index_name", help="Index folder name, used as lsh:<index_name>")
+    build_parser.add_argument("--bands", type=int, default=32)
+    build_parser.add_argument("--rows", type=int, default=4)
+    build_parser.add_argument("--shingle-size", type=int, default=3)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Report recall and speed per band configuration")
+    evaluate_parser.add_argument("pair", help="Pair of ontologies, e.g. DOID-MESH")
+    evaluate_parser.add_argument("mapping", help="Mappings csv under data/mappings/")
+    evaluate_parser.add_argument("--configurations", type=_configuration, nargs="+",
+                                 default=[(16, 8), (32, 4), (64, 2), (20, 5), (42, 3)],
+                                 help="Band configurations as <bands>x<rows>")
+    evaluate_parser.add_argument("--shingle-size", type=int, default=3)
+    evaluate_parser.add_argument("--output", default=None, help="csv file for the report")
+    return parser.parse_args(argv)
+
+
+# Example usage (from the app folder):
+#   PYTHONPATH=.. python -m similarity.lsh build MESH mesh_lsh --bands 32 --rows 4
+#   PYTHONPATH=.. python -m similarity.lsh evaluate DOID-MESH <mapping csv> --configurations 16x8 32x4 64x2
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "build":
+        build_lsh_index(args.ontology, args.index_name, args.bands, args.rows, args.shingle_size)
+    else:
+        report_df = evaluate_band_configurations(args.pair, args.mapping, args.configurations, args.shingle_size)
+        if args.output:
+            report_df.to_csv(args.output, index=False)
@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_FILE = "../data/cache/similarity_search_cache.sqlite"
+
+
+def normalize_search_term(search_term):
+    """Normalizes a search term for use as a cache key (case and whitespace insensitive)."""
+    return " ".join(search_term.split()).casefold()
+
+
+class SearchCache:
+    """
+    Persistent SQLite cache for similarity search results.
+
+    Entries are keyed by (endpoint, index_name, normalized term) and remember the top_k they were fetched with,
+    so a request for top_k=10 is answered from an entry stored with top_k=100.
+    Entries older than max_age_seconds are ignored and evicted, and when the cache holds more than max_entries
+    the least recently used entries are removed.
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_entries=500_000, max_age_seconds=30 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._puts_since_eviction = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_results (
+                endpoint TEXT NOT NULL,
+                index_name TEXT NOT NULL,
+                term TEXT NOT NULL,
+                top_k INTEGER NOT NULL,
+                rows TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (endpoint, index_name, term)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON search_results (last_access)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, endpoint, index_name, search_term, top_k):
+        """
+        Returns the cached rows (list of (id, label, score) tuples) for the term, or None on a miss.
+        """
+        key = (endpoint, index_name, normalize_search_term(search_term))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT top_k, rows, created_at FROM search_results WHERE endpoint=? AND index_name=? AND term=?",
+                key).fetchone()
+            if row is None:
+                return None
+            cached_top_k, rows_json, created_at = row
+            if now - created_at > self.max_age_seconds:
+                return None
+            rows = json.loads(rows_json)
+            # a result shorter than its top_k is complete, so it can answer any top_k
+            if cached_top_k < top_k and len(rows) >= cached_top_k:
+                return None
+            self._conn.execute(
+                "UPDATE search_results SET last_access=? WHERE endpoint=? AND index_name=? AND term=?",
+                (now, *key))
+            self._conn.commit()
+        return [tuple(r) for r in rows[:top_k]]
+
+    def put(self, endpoint, index_name, search_term, top_k, rows):
+        """
+        Stores the rows (list of (id, label, score) tuples) of a search executed with top_k.
+        An existing entry fetched with a larger top_k is kept.
+        """
+        key = (endpoint, index_name, normalize_search_term(search_term))
+        now = time.time()
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO search_results (endpoint, index_name, term, top_k, rows, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (endpoint, index_name, term) DO UPDATE SET
+                    top_k=excluded.top_k, rows=excluded.rows,
+                    created_at=excluded.created_at, last_access=excluded.last_access
+                WHERE excluded.top_k >= search_results.top_k
+                   OR search_results.created_at < ?
+            """, (*key, top_k, json.dumps(rows, ensure_ascii=False), now, now, now - self.max_age_seconds))
+            self._conn.commit()
+            self._puts_since_eviction += 1
+            evict = self._puts_since_eviction >= 1000
+        if evict:
+            self.evict()
+
+    def invalidate_index(self, index_name, endpoint=None):
+        """
+        Removes all entries of a similarity index, e.g. after doid_labels or mesh_labels has been rebuilt.
+        Returns the number of removed entries.
+        """
+        with self._lock:
+            if endpoint is None:
+                cursor = self._conn.execute("DELETE FROM search_results WHERE index_name=?", (index_name,))
+            else:
+                cursor = self._conn.execute("DELETE FROM search_results WHERE index_name=? AND endpoint=?",
+                                            (index_name, endpoint))
+            self._conn.commit()
+        print(f"Invalidated {cursor.rowcount} cached searches for index {index_name}")
+        return cursor.rowcount
+
+    def evict(self):
+        """Removes expired entries and, above max_entries, the least recently used ones."""
+        with self._lock:
+            self._conn.execute("DELETE FROM search_results WHERE created_at < ?",
+                               (time.time() - self.max_age_seconds,))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM search_results").fetchone()
+            if count > self.max_entries:
+                self._conn.execute("""
+                    DELETE FROM search_results WHERE rowid IN (
+                        SELECT rowid FROM search_results ORDER BY last_access LIMIT ?
+                    )
+                """, (count - self.max_entries,))
+            self._conn.commit()
+            self._puts_since_eviction = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def invalidate_index(index_name, path=DEFAULT_CACHE_FILE):
+    """Invalidation hook to call when a similarity index is rebuilt."""
+    cache = SearchCache(path)
+    try:
+        return cache.invalidate_index(index_name)
+    finally:
+        cache.close()
@@ -1,26 +1,48 @@
-from SPARQLWrapper import SPARQLWrapper, JSON
 import pandas as pd
+import numpy as np
 import csv
 import sys
 import time
-import json
-import os
-
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+from .search_cache import SearchCache
+from .candidates_io import CandidatesWriter
+from .label_table import LabelTable, load_labels
+from .exact_match import load_exact_match_index
+from .backends import get_search_backend
+from .sparql_client import DEFAULT_ENDPOINT, get_sparql_client
+from instrumentation import registry as metrics
+
+# Similarity index per target ontology, a "local:" prefix selects an in-process index (see backends.py)
 similarity_indices = {"DOID": "doid_labels", "MESH": "mesh_labels"}
 
-def search_rdf_index(search_term, index_name, result_column_name, top_k=10, endpoint="http://localhost:7200/repositories/WeVerify"):
+def search_rdf_index_rows(search_term, index_name, top_k=10, endpoint=DEFAULT_ENDPOINT,
+                          cache=None, id_to_label=None):
     """
     Executes a SPARQL similarity search query on the given RDF repository.
+    With id_to_label, GraphDB only returns the ids and scores and the labels are taken from id_to_label
+    instead of being joined in the query (see _attach_labels).
 
     Parameters:
     - search_term (str): The term to search for in the RDF similarity index.
     - index_name (str): The name of the similarity index.
     - top_k (int, optional): The maximum number of results to return (default: 10).
     - endpoint (str, optional): The URL of the SPARQL endpoint (default: GraphDB local instance).
+    - cache (SearchCache, optional): Persistent cache consulted before querying the endpoint.
+    - id_to_label (mapping, optional): Label table of the ontology of the index, as returned by load_labels.
 
     Returns:
-    - pandas.DataFrame: DataFrame containing 'doid_id' and 'score' columns.
+    - list: (id, label, score) tuples ordered by descending score.
     """
+    if cache is not None:
+        cached_rows = cache.get(endpoint, index_name, search_term, top_k)
+        metrics.inc("search_cache_lookups_total", result="hit" if cached_rows is not None else "miss")
+        if cached_rows is not None:
+            return _attach_labels(cached_rows, id_to_label)
+
+    label_variable, label_patterns = _label_query_parts(id_to_label)
+
     # Define the SPARQL query
     query = f"""
     PREFIX : <http://www.ontotext.com/graphdb/similarity/>
@@ -29,36 +51,180 @@ def search_rdf_index(search_term, index_name, result_column_name, top_k=10, endp
     PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 
-    SELECT ?documentID ?label ?score WHERE {{
+    SELECT ?documentID {label_variable}?score WHERE {{
         ?search a similarity-index:{index_name} ;
-                :searchTerm "{search_term}" ;
+                :searchTerm "{_escape_sparql_literal(search_term)}" ;
                 :searchParameters "" ;
                 :documentResult ?result .
         ?result :value ?documentID ;
                 :score ?score.
-        optional {{ ?documentID rdfs:label ?label }}
-        optional {{ ?documentID skos:prefLabel ?label }}
+        {label_patterns}
     }} ORDER BY DESC(?score) LIMIT {top_k}
     """
 
-    # Initialize the SPARQL endpoint
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(query)
-    sparql.setReturnFormat(JSON)
-
-    # Execute the query
+    # Execute the query on the pooled connection of this thread
     try:
-        results = sparql.query().convert()
-        data = [(res["documentID"]["value"], res["label"]["value"],float(res["score"]["value"])) for res in results["results"]["bindings"]]
-
-        # Convert to Pandas DataFrame
-        df = pd.DataFrame(data, columns=[result_column_name, "label", "score"])
-        return df
+        with metrics.timer("sparql_similarity_query_seconds", index=index_name, batched=False,
+                           labels="local" if id_to_label is not None else "sparql"):
+            results = get_sparql_client(endpoint).select(query)
+        data = _attach_labels([(res["documentID"], res.get("label"), float(res["score"])) for res in results],
+                              id_to_label)
+        if cache is not None:
+            cache.put(endpoint, index_name, search_term, top_k, data)
+        return data
     except Exception as e:
         print("Error executing SPARQL query:", e)
-        return pd.DataFrame(columns=[result_column_name, "score"])
+        metrics.inc("sparql_query_errors_total", query="similarity")
+        return []
+
+
+def search_rdf_index(search_term, index_name, result_column_name, top_k=10, endpoint=DEFAULT_ENDPOINT,
+                     cache=None, id_to_label=None):
+    """
+    Executes a SPARQL similarity search query on the given RDF repository.
+
+    Parameters:
+    - search_term (str): The term to search for in the RDF similarity index.
+    - index_name (str): The name of the similarity index.
+    - result_column_name (str): The name of the id column in the returned DataFrame.
+    - top_k (int, optional): The maximum number of results to return (default: 10).
+    - endpoint (str, optional): The URL of the SPARQL endpoint (default: GraphDB local instance).
+    - cache (SearchCache, optional): Persistent cache consulted before querying the endpoint.
+    - id_to_label (mapping, optional): Label table the labels are taken from instead of the query.
+
+    Returns:
+    - pandas.DataFrame: DataFrame containing result_column_name, 'label' and 'score' columns.
+    """
+    rows = search_rdf_index_rows(search_term, index_name, top_k=top_k, endpoint=endpoint, cache=cache,
+                                 id_to_label=id_to_label)
+    return pd.DataFrame(rows, columns=[result_column_name, "label", "score"])
+
+
+def _label_query_parts(id_to_label):
+    """Returns the label variable and patterns of a similarity query, empty when labels come from id_to_label."""
+    if id_to_label is not None:
+        return "", ""
+    return "?label ", "optional { ?documentID rdfs:label ?label }\n        optional { ?documentID skos:prefLabel ?label }"
+
+
+def _attach_labels(rows, id_to_label):
+    """
+    Replaces the labels of (id, label, score) rows with those of the id_to_label table (None for unknown ids),
+    so candidates carry the same labels as the rest of the evaluation. Rows are returned as they are without a table.
+    """
+    if id_to_label is None:
+        return rows
+    class_ids = [class_id for class_id, _, _ in rows]
+    labels = id_to_label.get_many(class_ids) if isinstance(id_to_label, LabelTable) \
+        else [id_to_label.get(class_id) for class_id in class_ids]
+    return [(class_id, label, score) for (class_id, _, score), label in zip(rows, labels)]
+
+
+def _escape_sparql_literal(value):
+    """Escapes a string so it can be embedded in a double-quoted SPARQL literal."""
+    return (value.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def search_rdf_index_batch_rows(search_terms, index_name, top_k=10, batch_size=50,
+                                endpoint=DEFAULT_ENDPOINT, cache=None, id_to_label=None):
+    """
+    Executes the similarity search for many terms, sending one SPARQL request per chunk of batch_size terms.
+
+    Each term gets its own ORDER BY/LIMIT sub-select, the sub-selects are combined with UNION
+    and tagged with the position of the term, so the rows can be split back per term.
+
+    Parameters:
+    - search_terms (list): The terms to search for in the RDF similarity index.
+    - index_name (str): The name of the similarity index.
+    - top_k (int, optional): The maximum number of results to return per term (default: 10).
+    - batch_size (int, optional): The maximum number of terms sent in a single request (default: 50).
+    - endpoint (str, optional): The URL of the SPARQL endpoint (default: GraphDB local instance).
+    - cache (SearchCache, optional): Persistent cache consulted before querying the endpoint, only misses are sent.
+    - id_to_label (mapping, optional): Label table the labels are taken from instead of the query.
 
+    Returns:
+    - dict: Search term to a list of (id, label, score) tuples ordered by descending score.
+    """
+    unique_terms = list(dict.fromkeys(search_terms))
+    results_by_term = {}
+    label_variable, label_patterns = _label_query_parts(id_to_label)
+
+    if cache is not None:
+        missing_terms = []
+        for term in unique_terms:
+            cached_rows = cache.get(endpoint, index_name, term, top_k)
+            if cached_rows is None:
+                missing_terms.append(term)
+            else:
+                results_by_term[term] = _attach_labels(cached_rows, id_to_label)
+        metrics.inc("search_cache_lookups_total", len(unique_terms) - len(missing_terms), result="hit")
+        metrics.inc("search_cache_lookups_total", len(missing_terms), result="miss")
+        unique_terms = missing_terms
+
+    for start in range(0, len(unique_terms), batch_size):
+        chunk = unique_terms[start:start + batch_size]
+
+        sub_selects = " UNION ".join(f"""
+        {{ SELECT ?termIndex ?documentID ?score WHERE {{
+            BIND({i} AS ?termIndex)
+            ?search a similarity-index:{index_name} ;
+                    :searchTerm "{_escape_sparql_literal(term)}" ;
+                    :searchParameters "" ;
+                    :documentResult ?result .
+            ?result :value ?documentID ;
+                    :score ?score.
+        }} ORDER BY DESC(?score) LIMIT {top_k} }}""" for i, term in enumerate(chunk))
+
+        query = f"""
+        PREFIX : <http://www.ontotext.com/graphdb/similarity/>
+        PREFIX similarity-index: <http://www.ontotext.com/graphdb/similarity/instance/>
+        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+        SELECT ?termIndex ?documentID {label_variable}?score WHERE {{
+            {sub_selects}
+            {label_patterns}
+        }} ORDER BY ?termIndex DESC(?score)
+        """
+
+        rows_by_index = {i: [] for i in range(len(chunk))}
+        try:
+            with metrics.timer("sparql_similarity_query_seconds", index=index_name, batched=True,
+                               labels="local" if id_to_label is not None else "sparql"):
+                results = get_sparql_client(endpoint).select(query)
+            for res in results:
+                rows_by_index[int(res["termIndex"])].append((res["documentID"], res.get("label"), float(res["score"])))
+            for i in rows_by_index:
+                rows_by_index[i] = _attach_labels(rows_by_index[i], id_to_label)
+            if cache is not None:
+                for i, term in enumerate(chunk):
+                    cache.put(endpoint, index_name, term, top_k, rows_by_index[i])
+        except Exception as e:
+            print("Error executing batched SPARQL query:", e)
+            metrics.inc("sparql_query_errors_total", query="similarity")
+
+        for i, term in enumerate(chunk):
+            results_by_term[term] = rows_by_index[i]
+
+    return results_by_term
+
+
+def search_rdf_index_batch(search_terms, index_name, result_column_name, top_k=10, batch_size=50,
+                           endpoint=DEFAULT_ENDPOINT, cache=None, id_to_label=None):
+    """
+    DataFrame variant of search_rdf_index_batch_rows.
 
+    Returns:
+    - dict: Search term to pandas.DataFrame with the same columns as search_rdf_index.
+    """
+    rows_by_term = search_rdf_index_batch_rows(search_terms, index_name, top_k=top_k, batch_size=batch_size,
+                                               endpoint=endpoint, cache=cache, id_to_label=id_to_label)
+    return {term: pd.DataFrame(rows, columns=[result_column_name, "label", "score"])
+            for term, rows in rows_by_term.items()}
+
+
+@metrics.timed("label_loading_seconds", method="csv")
 def read_class_id_to_pref_label(file_name):
     class_id_to_label = {}
 
@@ -79,7 +245,14 @@ def read_class_id_to_pref_label(file_name):
 
     return class_id_to_label
 
-def compute_hits_at_n(selected_pair, selected_mapping, save_candidates):
+def candidates_file_for(selected_pair, selected_mapping):
+    """Returns the candidates file written by compute_hits_at_n for a pair and mapping."""
+    return ("../data/candidates/" + selected_pair + "_" + selected_mapping).replace(".csv", ".jsonl")
+
+
+def compute_hits_at_n(selected_pair, selected_mapping, save_candidates, max_workers=1, batch_size=None,
+                      use_cache=False, resume=False, incremental=False, progress_callback=None, exact_match=False,
+                      local_labels=False):
     start_time = time.time()
 
     kg_1, kg_2 = selected_pair.split("-")
@@ -90,118 +263,244 @@ def compute_hits_at_n(selected_pair, selected_mapping, save_candidates):
 
     kg_1_to_kg_2 = mappings_df.set_index(kg_1)[kg_2].to_dict()
 
-    index_name = similarity_indices[kg_2]
-    if not index_name:
+    if not similarity_indices.get(kg_2):
         print("No similarity index found for {}".format(kg_2))
         return
 
-    result_column_name = index_name.replace("_labels", "_id")
-
-
-    kg_1_id_to_label = read_class_id_to_pref_label("../data/datasets/csv/" + kg_1 + ".csv")
+    kg_1_id_to_label = load_labels("../data/datasets/csv/" + kg_1 + ".csv")
     print(f' {kg_1} has {len(kg_1_id_to_label)} ids')
 
-    # this is needed just for caching the correct label id from kg_2
-    kg_2_id_to_label = read_class_id_to_pref_label("../data/datasets/csv/" + kg_2 + ".csv")
+    # needed for the label of the correct kg_2 id, and for the candidate labels with local_labels
+    kg_2_id_to_label = load_labels("../data/datasets/csv/" + kg_2 + ".csv")
     print(f' {kg_2} has {len(kg_2_id_to_label)} ids')
 
+    cache = SearchCache() if use_cache else None
+    backend, index_name = get_search_backend(similarity_indices[kg_2], cache=cache,
+                                             id_to_label=kg_2_id_to_label if local_labels else None)
+    batch_size = batch_size or backend.default_batch_size
+
+    # the LLM prompts look the candidate ids up by target ontology, whatever the index is called
+    result_column_name = kg_2.lower() + "_id"
+
+    exact_match_index = load_exact_match_index("../data/datasets/csv/" + kg_2 + ".csv") if exact_match else None
+
+    # only the mapped ids are looked up in the label table
     kg_1_label_to_kg_2 = {
-        (id1, label_1): kg_1_to_kg_2[id1]
-        for id1, label_1 in kg_1_id_to_label.items()
-        if id1 in kg_1_to_kg_2
+        (id1, kg_1_id_to_label[id1]): id2
+        for id1, id2 in kg_1_to_kg_2.items()
+        if id1 in kg_1_id_to_label
     }
 
-    generated_candidates_file = None
-    if save_candidates:
-        generated_candidates_file = ("../data/candidates/" + selected_pair + "_" + selected_mapping).replace(".csv",
-                                                                                                             ".json")
-
-    hits_at_n_results, _ = calculate_hits_at_n(kg_1_label_to_kg_2, search_rdf_index, kg_2_id_to_label=kg_2_id_to_label,
-                                               index_name=index_name,
-                                               result_column_name=result_column_name,
-                                               generated_candidates_file=generated_candidates_file,
-                                               k_values=[1, 3, 5, 10, 20, 40])
+    generated_candidates_file = candidates_file_for(selected_pair, selected_mapping) if save_candidates else None
+
+    hits_at_n_results, _, mrr = calculate_hits_at_n(kg_1_label_to_kg_2, backend.search_rows,
+                                                    kg_2_id_to_label=kg_2_id_to_label,
+                                                    index_name=index_name,
+                                                    result_column_name=result_column_name,
+                                                    generated_candidates_file=generated_candidates_file,
+                                                    k_values=[1, 3, 5, 10, 20, 40],
+                                                    max_workers=max_workers,
+                                                    search_rdf_index_batch=backend.search_rows_batch if batch_size else None,
+                                                    batch_size=batch_size,
+                                                    resume=resume,
+                                                    incremental=incremental,
+                                                    progress_callback=progress_callback,
+                                                    exact_match_index=exact_match_index)
+    if cache is not None:
+        cache.close()
     elapsed_time = time.time() - start_time
 
-    return hits_at_n_results, len(mappings_df), elapsed_time
+    return hits_at_n_results, len(mappings_df), elapsed_time, mrr
 
 
-def calculate_hits_at_n(kg1_label_to_kg2, search_rdf_index, kg_2_id_to_label, index_name, result_column_name,
-                        generated_candidates_file,
-                        k_values=[1, 3, 5, 10]):
+def _rank_of(retrieved_kg2_ids, correct_kg2_id):
+    """Returns the 1-based rank of correct_kg2_id among the retrieved ids, or 0 if it is not found."""
+    return next((rank for rank, kg2_id in enumerate(retrieved_kg2_ids, 1) if kg2_id == correct_kg2_id), 0)
+
+
+def compute_rank_metrics(ranks, k_values):
     """
-    Computes Hits@N metric for each entry in kg1_label_to_kg2.
-    Optionally it persists the generated candidates in generated_candidates_file.
+    Computes Hits@K for all K and the mean reciprocal rank in one pass over the rank array.
 
     Parameters:
-    - kg1_label_to_kg2 (dict): A dictionary mapping ICD-10 labels to DOID IDs.
-    - search_rdf_index (function): A function that executes SPARQL search and returns a DataFrame with id, label and score columns
+    - ranks (array-like): 1-based rank of the correct id per query, 0 when it was not retrieved.
+    - k_values (list): The K values to compute Hits@K for.
 
     Returns:
-    - A dictionary with Hits@1, Hits@3, Hits@5, and Hits@10 scores.
-    - A list of failed search queries (ICD-10 labels that didn't match in top 10 results).
+    - A dictionary with Hits@K percentages per K.
+    - The mean reciprocal rank.
     """
-    hits_at_n = {k: 0 for k in k_values}  # Track hits
-    total_queries = len(kg1_label_to_kg2)  # Total number of queries
-    failed_searches = []  # List to store failed queries
-    all_candidates = {}
+    ranks = np.asarray(ranks, dtype=np.int64)
+    total_queries = len(ranks)
+    if total_queries == 0:
+        return {k: 0.0 for k in k_values}, 0.0
 
+    max_k = max(k_values)
+    # ranks beyond max_k are folded into one bucket, bucket 0 holds the queries without a hit
+    rank_counts = np.bincount(np.minimum(ranks, max_k + 1), minlength=max_k + 2)
+    cumulative_hits = np.cumsum(rank_counts[1:max_k + 1])
 
-    for (kg1_id, kg1_label), correct_kg2_id in kg1_label_to_kg2.items():
-        # Call search function and get results
-        search_results = search_rdf_index(kg1_label, index_name, result_column_name, top_k=100)
+    hits_at_n = {k: round((int(cumulative_hits[k - 1]) / total_queries) * 100, 2) for k in k_values}
+    found = ranks > 0
+    mrr = round(float(np.sum(1.0 / ranks[found])) / total_queries, 4)
+    return hits_at_n, mrr
 
-        # limit the score up to the 4th decimal point to save space in the persisted files
-        search_results["score"] = search_results["score"].round(4)
 
+def calculate_hits_at_n(kg1_label_to_kg2, search_rdf_index, kg_2_id_to_label, index_name, result_column_name,
+                        generated_candidates_file,
+                        k_values=[1, 3, 5, 10], max_workers=1, search_rdf_index_batch=None, batch_size=50,
+                        resume=False, incremental=False, progress_callback=None, exact_match_index=None):
+    """
+    Computes Hits@N metric for each entry in kg1_label_to_kg2.
+    Optionally it streams the generated candidates to generated_candidates_file (JSON Lines, one record per
+    source id, written as soon as its search finishes) and the Hits@K summary to a sidecar file.
+
+    Parameters:
+    - kg1_label_to_kg2 (dict): A dictionary mapping ICD-10 labels to DOID IDs.
+    - search_rdf_index (function): A function with the signature of search_rdf_index_rows, returning (id, label, score) rows
+    - max_workers (int, optional): Number of searches dispatched in parallel (default: 1, i.e. serial execution).
+      Results are consumed in input order, so Hits@K and the candidates file do not depend on this value.
+    - search_rdf_index_batch (function, optional): A function with the signature of search_rdf_index_batch_rows.
+      When given, labels are searched in chunks of batch_size per request instead of one request per label.
+    - batch_size (int, optional): Number of labels per batched request (default: 50).
+    - resume (bool, optional): Keep the records already in generated_candidates_file and only search the
+      source ids that are missing (or whose label or correct id changed). Records of a previous run on another
+      index or with another number of candidates are not kept (default: False).
+    - incremental (bool, optional): Like resume, but generated_candidates_file is rewritten with exactly one record
+      per query in input order (records of removed source ids are dropped), the same file a full run writes
+      (default: False).
+    - progress_callback (function, optional): Called about every 1% of the searches with the number of finished
+      queries, the total number of queries and the Hits@K dictionary and MRR of the finished queries.
+    - exact_match_index (ExactMatchIndex, optional): Labels it resolves to a single target id are not searched,
+      that id becomes their only candidate (score 1.0) and their record is marked "resolved_by": "exact_match".
+      Resumed and incremental runs only reuse records resolved the same way, so they match a full run.
+
+    Returns:
+    - A dictionary with Hits@K scores for each K in k_values.
+    - A list of failed search queries (labels whose correct id is not in the top max(k_values) results).
+    - The mean reciprocal rank.
+    """
+    queries = list(kg1_label_to_kg2.items())
+    # 1-based rank of the correct id per query, 0 when it was not retrieved
+    ranks = np.zeros(len(queries), dtype=np.int32)
+
+    # candidates searched and written per query
+    top_k = 100
+    run_info = {"index_name": index_name, "top_k": top_k}
+    writer = CandidatesWriter(generated_candidates_file, resume=resume, incremental=incremental, run_info=run_info) \
+        if generated_candidates_file else None
+    previous_records = writer.existing_records if writer else {}
+
+    # queries resolved by the exact match fast path get the matched id as their only candidate
+    exact_matches = {}
+    if exact_match_index is not None:
+        matched_ids = exact_match_index.resolve([kg1_label for (_, kg1_label), _ in queries], stage="search")
+        for i, kg2_id in enumerate(matched_ids):
+            if kg2_id is not None:
+                exact_matches[i] = [(kg2_id, kg_2_id_to_label.get(kg2_id), 1.0)]
+        print(f"Exact match fast path resolved {len(exact_matches)} of {len(queries)} queries")
+
+    # positions of the queries that need a search or exact match, the ranks of the others come from the
+    # previous records; records of the fast path are not reused by runs without it and vice versa
+    pending = []
+    for i, ((kg1_id, kg1_label), correct_kg2_id) in enumerate(queries):
+        record = previous_records.get(kg1_id)
+        if record and record["label"] == kg1_label and record["equivalent_id"] == correct_kg2_id \
+                and i not in exact_matches and record.get("resolved_by") != "exact_match":
+            ranks[i] = _rank_of((c[result_column_name] for c in record["candidates"]), correct_kg2_id)
+        else:
+            pending.append(i)
+    searches = [i for i in pending if i not in exact_matches]
+    if incremental:
+        print(f"Searching {len(searches)} new or changed of {len(queries)} ids")
+
+    finished = np.ones(len(queries), dtype=bool)
+    finished[pending] = False
+    report_every = max(1, len(pending) // 100)
+
+    def report_progress():
+        partial_hits, partial_mrr = compute_rank_metrics(ranks[finished], k_values)
+        progress_callback(int(finished.sum()), len(queries), partial_hits, partial_mrr)
+
+    if progress_callback:
+        report_progress()
+
+    def run_search(i):
+        (_, kg1_label), _ = queries[i]
+        return search_rdf_index(kg1_label, index_name, top_k=top_k)
+
+    def run_batch_search(chunk):
+        labels = [queries[i][0][1] for i in chunk]
+        results = search_rdf_index_batch(labels, index_name, top_k=top_k, batch_size=batch_size)
+        return [results[kg1_label] for kg1_label in labels]
+
+    if search_rdf_index_batch:
+        tasks = [searches[i:i + batch_size] for i in range(0, len(searches), batch_size)]
+        task_fn = run_batch_search
+    else:
+        tasks = searches
+        task_fn = run_search
+
+    def write_record(i, candidates):
+        (kg1_id, kg1_label), correct_kg2_id = queries[i]
         equivalent_id_label = None
-        if generated_candidates_file:
-            if correct_kg2_id not in kg_2_id_to_label:
-                print("There is no label for correct target id {}".format(correct_kg2_id))
-            else:
-                equivalent_id_label = kg_2_id_to_label[correct_kg2_id]
-
-            all_candidates[kg1_id] = {"label": kg1_label,
-                                      "equivalent_id": correct_kg2_id,
-                                      "equivalent_id_label": equivalent_id_label,
-                                      "candidates": search_results.to_dict(orient="records")
-                                      }
-
-        # Extract top-N KG2 IDs from results
-        retrieved_kg2_ids = search_results[result_column_name].tolist()
-
-        # Debug print for verification
-        # print(f"Search Query: '{kg1_label}'")
-        # print(f"Expected {result_column_name}: {correct_kg2_id}")
-        # print(f"Retrieved {result_column_name} IDs (Top 10): {retrieved_kg2_ids[:10]}")
-
-        # Track if at least one hit was found in the top 10
-        match_found = False
-
-        # Check if correct_kg2_id appears in the top N results
-        for N in k_values:
-            # Ensure N doesn't exceed available results
-            retrieved_subset = retrieved_kg2_ids[:min(N, len(retrieved_kg2_ids))]
-
-            if correct_kg2_id in retrieved_subset:
-                hits_at_n[N] += 1  # Increase hit count for this N
-                match_found = True  # Mark match as found
-
-        # If no match found in the top 10, add to failed searches list
-        if not match_found:
-            failed_searches.append(kg1_label)
-
-    # Normalize counts into percentages
-    hits_at_n = {N: round((hits_at_n[N] / total_queries) * 100, 2) for N in hits_at_n}
-
-    if generated_candidates_file:
-        # Persists candidates
-        os.makedirs(os.path.dirname(generated_candidates_file), exist_ok=True)
-        result_json = {"hits_at_k": hits_at_n,
-                       "candidates": all_candidates
-                       }
-        with open(generated_candidates_file, "w", encoding="utf-8") as f:
-            json.dump(result_json, f, indent=2, ensure_ascii=False)
+        if correct_kg2_id not in kg_2_id_to_label:
+            print("There is no label for correct target id {}".format(correct_kg2_id))
+        else:
+            equivalent_id_label = kg_2_id_to_label[correct_kg2_id]
+
+        record = {"label": kg1_label,
+                  "equivalent_id": correct_kg2_id,
+                  "equivalent_id_label": equivalent_id_label,
+                  "candidates": candidates
+                  }
+        if i in exact_matches:
+            record["resolved_by"] = "exact_match"
+        writer.write(kg1_id, record)
+
+    # executor.map yields results in submission order, which keeps the output deterministic
+    executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        task_results = executor.map(task_fn, tasks) if executor else map(task_fn, tasks)
+        all_search_results = chain.from_iterable(task_results) if search_rdf_index_batch else iter(task_results)
+
+        n = 0
+        for i in range(len(queries)):
+            if finished[i]:
+                # an incremental run copies the previous record to its position in the rewritten file
+                if incremental:
+                    write_record(i, previous_records[queries[i][0][0]]["candidates"])
+                continue
+
+            search_results = exact_matches[i] if i in exact_matches else next(all_search_results)
+            ranks[i] = _rank_of((row[0] for row in search_results), queries[i][1])
+            finished[i] = True
+            n += 1
+
+            if writer:
+                # limit the score up to the 4th decimal point to save space in the persisted files
+                write_record(i, [{result_column_name: kg2_id, "label": label, "score": round(score, 4)}
+                                 for kg2_id, label, score in search_results])
+
+            if progress_callback and (n % report_every == 0 or n == len(pending)):
+                report_progress()
+        if writer:
+            writer.commit()
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if writer:
+            writer.close()
+
+    hits_at_n, mrr = compute_rank_metrics(ranks, k_values)
+
+    # Queries without a hit in the top max(k_values) results
+    failed = (ranks == 0) | (ranks > max(k_values))
+    failed_searches = [queries[i][0][1] for i in np.flatnonzero(failed)]
+
+    if writer:
+        writer.write_summary({"hits_at_k": hits_at_n, "mrr": mrr, "total_queries": len(queries),
+                              **run_info, "exact_matches": len(exact_matches)})
         print("Candidates written to {}".format(generated_candidates_file))
 
-    return hits_at_n, failed_searches
\ No newline at end of file
+    return hits_at_n, failed_searches, mrr
@@ -0,0 +1,189 @@
+import csv
+import gzip
+import http.client
+import io
+import json
+import threading
+from urllib.parse import urlsplit
+
+DEFAULT_ENDPOINT = "http://localhost:7200/repositories/WeVerify"
+
+# TSV keeps the full value of every term and is decoded line by line, much cheaper than the verbose JSON format
+DEFAULT_RESULT_FORMAT = "tsv"
+
+RESULT_FORMATS = {"json": "application/sparql-results+json",
+                  "tsv": "text/tab-separated-values",
+                  "csv": "text/csv"}
+
+# errors of a keep-alive connection the server closed in the meantime, the request is sent again once
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                            http.client.ResponseNotReady, ConnectionResetError, BrokenPipeError)
+
+
+class SparqlError(Exception):
+    pass
+
+
+_TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", '"': '"', "\\": "\\"}
+
+
+def _decode_tsv_term(term):
+    """Returns the value of an RDF term in SPARQL TSV syntax: the IRI, the lexical form of a literal, or None."""
+    if not term:
+        return None
+    if term[0] == "<" and term[-1] == ">":
+        return term[1:-1]
+    if term[0] == '"':
+        # the lexical form ends at the last quote, a language tag or datatype may follow it
+        value = term[1:term.rindex('"')]
+        return _unescape(value) if "\\" in value else value
+    # numbers and booleans in abbreviated form, blank nodes
+    return term
+
+
+def _unescape(value):
+    result = []
+    i = 0
+    while i < len(value):
+        if value[i] == "\\" and i + 1 < len(value):
+            result.append(_TSV_ESCAPES.get(value[i + 1], value[i:i + 2]))
+            i += 2
+        else:
+            result.append(value[i])
+            i += 1
+    return "".join(result)
+
+
+class SparqlClient:
+    """
+    SPARQL client for one endpoint, shared by all threads.
+
+    Every thread keeps one keep-alive connection to the endpoint, so the queries of a worker thread reuse it
+    instead of connecting per query. Queries are sent with POST (optionally gzip compressed), results are
+    requested gzip compressed in result_format ("tsv", "csv" or "json") and decoded while they are read.
+    Rows are returned as dictionaries of variable name to value (IRI or literal lexical form, None when unbound;
+    the csv format cannot tell unbound from empty values).
+    """
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, result_format=DEFAULT_RESULT_FORMAT, timeout=60,
+                 gzip_requests=False):
+        """
+        :param gzip_requests: Compress the query bodies, only for endpoints accepting Content-Encoding gzip
+        """
+        if result_format not in RESULT_FORMATS:
+            raise ValueError(f"Unsupported result format: {result_format}")
+        self.endpoint = endpoint
+        self.result_format = result_format
+        self.timeout = timeout
+        self.gzip_requests = gzip_requests
+
+        url = urlsplit(endpoint)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self._host, self._port = url.hostname, url.port
+        self._path = url.path or "/"
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connection_class(self._host, self._port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _reset_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def _request(self, method, path, body=None, headers=None):
+        """Sends a request on the connection of this thread, the response has to be read completely."""
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                self._reset_connection()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                self._reset_connection()
+                raise
+            if response.status != 200:
+                message = response.read()[:500].decode("utf-8", "replace")
+                raise SparqlError(f"HTTP {response.status} {response.reason} from {self.endpoint}: {message}")
+            return response
+
+    def select(self, query):
+        """Executes a SELECT query and returns its rows."""
+        body = query.encode("utf-8")
+        headers = {"Content-Type": "application/sparql-query; charset=utf-8",
+                   "Accept": RESULT_FORMATS[self.result_format],
+                   "Accept-Encoding": "gzip"}
+        if self.gzip_requests:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
+        response = self._request("POST", self._path, body, headers)
+        try:
+            stream = gzip.GzipFile(fileobj=response) if response.getheader("Content-Encoding") == "gzip" else response
+            if self.result_format == "tsv":
+                return self._read_tsv(stream)
+            if self.result_format == "csv":
+                return self._read_csv(stream)
+            return self._read_json(stream)
+        except Exception:
+            self._reset_connection()
+            raise
+        finally:
+            response.close()
+
+    def size(self):
+        """Returns the number of statements in the repository (RDF4J/GraphDB /size)."""
+        response = self._request("GET", self._path.rstrip("/") + "/size")
+        try:
+            return int(response.read().decode("utf-8").strip())
+        finally:
+            response.close()
+
+    @staticmethod
+    def _read_tsv(stream):
+        lines = io.TextIOWrapper(stream, encoding="utf-8", newline="\n")
+        header = lines.readline().rstrip("\r\n")
+        if not header:
+            return []
+        variables = [variable.lstrip("?") for variable in header.split("\t")]
+        rows = []
+        for line in lines:
+            values = line.rstrip("\n").rstrip("\r").split("\t")
+            rows.append({variable: _decode_tsv_term(value) for variable, value in zip(variables, values)})
+        return rows
+
+    @staticmethod
+    def _read_csv(stream):
+        reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8", newline=""))
+        variables = next(reader, None)
+        if not variables:
+            return []
+        return [{variable: value or None for variable, value in zip(variables, values)} for values in reader]
+
+    @staticmethod
+    def _read_json(stream):
+        results = json.load(stream)
+        return [{variable: binding.get(variable, {}).get("value") for variable in results["head"]["vars"]}
+                for binding in results["results"]["bindings"]]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_sparql_client(endpoint=DEFAULT_ENDPOINT):
+    """Returns the client of an endpoint shared by the whole process."""
+    with _clients_lock:
+        client = _clients.get(endpoint)
+        if client is None:
+            client = _clients[endpoint] = SparqlClient(endpoint)
+        return client
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import time
+
+# File of a versioned directory naming its current version subdirectory
+CURRENT_FILE = "CURRENT"
+_BUILD_PREFIX = ".build-"
+_VERSION_PREFIX = "v-"
+# unfinished builds older than this were left behind by a crashed process
+_STALE_BUILD_SECONDS = 24 * 3600
+
+
+def current_version_dir(base_dir):
+    """Returns the current version subdirectory of base_dir, None when no version was published yet."""
+    try:
+        with open(os.path.join(base_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return os.path.join(base_dir, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def new_build_dir(base_dir):
+    """Creates an empty directory in base_dir, private to the caller, to write a new version into."""
+    os.makedirs(base_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix=_BUILD_PREFIX, dir=base_dir)
+
+
+def publish_build_dir(base_dir, build_dir):
+    """
+    Renames build_dir to a version subdirectory and makes it the current version of base_dir by atomically
+    replacing CURRENT, then removes the versions that are no longer current.
+
+    Published files are never modified, so readers keep a consistent view of the version they opened: on POSIX
+    removed files stay readable through the memory maps opened before. Readers opening a version removed in
+    the meantime get a FileNotFoundError and should reopen or rebuild.
+
+    :return: The version subdirectory
+    """
+    version = _VERSION_PREFIX + os.path.basename(build_dir)[len(_BUILD_PREFIX):]
+    version_dir = os.path.join(base_dir, version)
+    os.rename(build_dir, version_dir)
+
+    fd, current_tmp = tempfile.mkstemp(prefix=_BUILD_PREFIX, dir=base_dir)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(base_dir, CURRENT_FILE))
+
+    _remove_old_versions(base_dir)
+    return version_dir
+
+
+def _remove_old_versions(base_dir):
+    current = os.path.basename(current_version_dir(base_dir) or "")
+    now = time.time()
+    for name in os.listdir(base_dir):
+        path = os.path.join(base_dir, name)
+        if name in (current, CURRENT_FILE):
+            continue
+        # builds of other processes are still being written, unless they are stale
+        if name.startswith(_BUILD_PREFIX):
+            try:
+                if now - os.path.getmtime(path) < _STALE_BUILD_SECONDS:
+                    continue
+            except OSError:
+                continue
+        # versions, stale builds and the files of the former unversioned layout
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass